@@ -1,7 +1,10 @@
 import os
 import yaml
 import argparse
+import time
+import queue
 import datetime
+import threading
 import requests
 
 from pathlib import Path
@@ -11,10 +14,13 @@ from Common.utils import LoggingUtil, GetDataPullError
 from Common.data_sources import get_available_data_sources
 from Common.exceptions import DataVersionError, GraphSpecError
 from Common.load_manager import SourceDataManager
+from Common.pipeline_scheduler import SourcePipelineScheduler, SourcePipelineJob, SOURCE_PIPELINE_WORKERS
 from Common.kgx_file_merger import KGXFileMerger, DONT_MERGE
-from Common.kgx_validation import validate_graph
+from Common.kgx_validation import GraphQCConsumer
+from Common.graph_analysis import GraphAnalyzer
 from Common.neo4j_tools import create_neo4j_dump
 from Common.memgraph_tools import create_memgraph_dump
+from Common.parquet_tools import create_parquet_dump, PARQUET_DUMP_DIRECTORY
 from Common.kgxmodel import GraphSpec, SubGraphSource, DataSource
 from Common.normalization import NORMALIZATION_CODE_VERSION, NormalizationScheme
 from Common.metadata import Metadata, GraphMetadata, SourceMetadata
@@ -28,11 +34,23 @@ EDGES_FILENAME = 'edges.jsonl'
 REDUNDANT_EDGES_FILENAME = 'redundant_edges.jsonl'
 COLLAPSED_QUALIFIERS_FILENAME = 'collapsed_qualifier_edges.jsonl'
 
+# the sorted runs of the sources of each graph are kept here, in the graph's directory, for incremental merging
+SOURCE_CONTRIBUTIONS_DIRECTORY = 'source_contributions'
+
+# the latest versions of the sources of a graph are retrieved this many at a time
+SOURCE_VERSION_WORKERS = int(os.environ.get('ORION_SOURCE_VERSION_WORKERS', 8))
+# seconds allowed to retrieve the latest version of one source, including retries, before the graph version fails
+SOURCE_VERSION_TIMEOUT = int(os.environ.get('ORION_SOURCE_VERSION_TIMEOUT', 300))
+
 
 class GraphBuilder:
 
     def __init__(self,
-                 graph_specs_dir=None):
+                 graph_specs_dir=None,
+                 incremental_merge: bool = False,
+                 source_pipeline_workers: int = SOURCE_PIPELINE_WORKERS,
+                 source_version_workers: int = SOURCE_VERSION_WORKERS,
+                 source_version_timeout: int = SOURCE_VERSION_TIMEOUT):
 
         self.logger = LoggingUtil.init_logging("ORION.Common.GraphBuilder",
                                                line_format='medium',
@@ -43,6 +61,15 @@ class GraphBuilder:
         self.graph_specs = {}   # graph_id -> GraphSpec all potential graphs that could be built, including sub-graphs
         self.load_graph_specs(graph_specs_dir=graph_specs_dir)
         self.build_results = {}
+        # when True, the sources of a graph are merged incrementally, only the sources that changed since the last
+        # incremental build of the graph are read and sorted again, see SourceContributionIndex
+        self.incremental_merge = incremental_merge
+        # the number of source pipelines run at once when building the dependencies of a graph
+        self.source_pipeline_workers = source_pipeline_workers
+        # source_id -> latest source version, retrieved concurrently for all the sources of a graph and its subgraphs
+        self.latest_source_versions = {}
+        self.source_version_workers = max(source_version_workers, 1)
+        self.source_version_timeout = source_version_timeout
 
     def build_graph(self, graph_spec: GraphSpec):
 
@@ -87,10 +114,13 @@ class GraphBuilder:
             graph_metadata.set_graph_spec(graph_spec.get_metadata_representation())
 
             # merge the sources and write the finalized graph kgx files
+            contribution_index_directory = os.path.join(self.graphs_dir, graph_id, SOURCE_CONTRIBUTIONS_DIRECTORY) \
+                if self.incremental_merge else None
             source_merger = KGXFileMerger(graph_spec=graph_spec,
                                           output_directory=graph_output_dir,
                                           nodes_output_filename=NODES_FILENAME,
-                                          edges_output_filename=EDGES_FILENAME)
+                                          edges_output_filename=EDGES_FILENAME,
+                                          contribution_index_directory=contribution_index_directory)
             source_merger.merge()
             merge_metadata = source_merger.get_merge_metadata()
 
@@ -110,26 +140,42 @@ class GraphBuilder:
         nodes_filepath = os.path.join(graph_output_dir, NODES_FILENAME)
         edges_filepath = os.path.join(graph_output_dir, EDGES_FILENAME)
 
-        if not graph_metadata.has_qc():
-            self.logger.info(f'Running QC for graph {graph_id}...')
-            qc_results = validate_graph(nodes_file_path=nodes_filepath,
-                                        edges_file_path=edges_filepath,
-                                        graph_id=graph_id,
-                                        graph_version=graph_version,
-                                        logger=self.logger)
-            graph_metadata.set_qc_results(qc_results)
-            if qc_results['pass']:
-                self.logger.info(f'QC passed for graph {graph_id}.')
-            else:
-                self.logger.warning(f'QC failed for graph {graph_id}.')
-
+        # QC, the MetaKG, and test data are all generated from a single scan of the nodes and edges files
+        needs_qc = not graph_metadata.has_qc()
         needs_meta_kg = not self.has_meta_kg(graph_directory=graph_output_dir)
         needs_test_data = not self.has_test_data(graph_directory=graph_output_dir)
-        if needs_meta_kg or needs_test_data:
-            self.logger.info(f'Generating MetaKG and test data for {graph_id}...')
-            self.generate_meta_kg_and_test_data(graph_directory=graph_output_dir,
-                                                generate_meta_kg=needs_meta_kg,
-                                                generate_test_data=needs_test_data)
+        if needs_qc or needs_meta_kg or needs_test_data:
+            self.logger.info(f'Analyzing graph {graph_id} (QC: {needs_qc}, MetaKG: {needs_meta_kg}, '
+                             f'test data: {needs_test_data})...')
+            graph_analyzer = GraphAnalyzer(nodes_file_path=nodes_filepath,
+                                           edges_file_path=edges_filepath,
+                                           logger=self.logger)
+            qc_consumer = None
+            if needs_qc:
+                qc_consumer = GraphQCConsumer(graph_id=graph_id,
+                                              graph_version=graph_version,
+                                              logger=self.logger,
+                                              bl_utils=graph_analyzer.bl_utils)
+                graph_analyzer.register_consumer(qc_consumer)
+            meta_kg_builder = None
+            if needs_meta_kg or needs_test_data:
+                meta_kg_builder = MetaKnowledgeGraphBuilder(logger=self.logger,
+                                                            bl_utils=graph_analyzer.bl_utils)
+                graph_analyzer.register_consumer(meta_kg_builder)
+            graph_analyzer.analyze()
+
+            if qc_consumer:
+                qc_results = qc_consumer.get_qc_results()
+                graph_metadata.set_qc_results(qc_results)
+                if qc_results['pass']:
+                    self.logger.info(f'QC passed for graph {graph_id}.')
+                else:
+                    self.logger.warning(f'QC failed for graph {graph_id}.')
+            if meta_kg_builder:
+                self.write_meta_kg_and_test_data(meta_kg_builder,
+                                                 graph_directory=graph_output_dir,
+                                                 generate_meta_kg=needs_meta_kg,
+                                                 generate_test_data=needs_test_data)
 
         output_formats = graph_spec.graph_output_format.lower().split('+') if graph_spec.graph_output_format else []
         graph_output_url = self.get_graph_output_url(graph_id, graph_version)
@@ -211,6 +257,20 @@ class GraphBuilder:
                 graph_metadata.set_dump(dump_type="memgraph",
                                         dump_url=f'{graph_output_url}memgraph_{graph_version}.cypher')
 
+        if 'parquet' in output_formats:
+            self.logger.info(f'Starting parquet dump pipeline for {graph_id}...')
+            dump_success = create_parquet_dump(nodes_filepath=nodes_filepath,
+                                               edges_filepath=edges_filepath,
+                                               output_directory=graph_output_dir,
+                                               graph_id=graph_id,
+                                               graph_version=graph_version,
+                                               node_property_ignore_list=node_property_ignore_list,
+                                               edge_property_ignore_list=edge_property_ignore_list,
+                                               logger=self.logger)
+            if dump_success:
+                graph_metadata.set_dump(dump_type="parquet",
+                                        dump_url=f'{graph_output_url}{PARQUET_DUMP_DIRECTORY}/')
+
         return True
 
     # determine a graph version utilizing versions of data sources, or just return the graph version specified
@@ -219,10 +279,12 @@ class GraphBuilder:
         if graph_spec.graph_version:
             return graph_spec.graph_version
         try:
-            # go out and find the latest version for any data source that doesn't have a version specified
+            # go out and find the latest version for any data source that doesn't have a version specified,
+            # for this graph and any subgraphs that will need one, all at once
+            self.retrieve_latest_source_versions(self.get_unversioned_source_ids(graph_spec))
             for source in graph_spec.sources:
                 if not source.source_version:
-                    source.source_version = self.source_data_manager.get_latest_source_version(source.id)
+                    source.source_version = self.latest_source_versions[source.id]
                 self.logger.info(f'Using {source.id} version: {source.version}')
 
             # for sub-graphs, if a graph version isn't specified,
@@ -257,8 +319,113 @@ class GraphBuilder:
         self.logger.info(f'Version determined for graph {graph_spec.graph_id}: {graph_version} ({composite_version_string})')
         return graph_version
 
+    def get_unversioned_source_ids(self, graph_spec: GraphSpec, source_ids: list = None):
+        # the ids of the data sources without a version in a graph spec, and in the specs of its unversioned subgraphs
+        source_ids = source_ids if source_ids is not None else []
+        if graph_spec.graph_version:
+            return source_ids
+        for source in graph_spec.sources:
+            if not source.source_version and source.id not in source_ids:
+                source_ids.append(source.id)
+        for subgraph in graph_spec.subgraphs:
+            subgraph_graph_spec = self.graph_specs.get(subgraph.id, None)
+            if not subgraph.graph_version and subgraph_graph_spec:
+                self.get_unversioned_source_ids(subgraph_graph_spec, source_ids)
+        return source_ids
+
+    def retrieve_latest_source_versions(self, source_ids: list):
+        """
+        Retrieve the latest versions of data sources using a pool of threads, most of the time is spent waiting on
+        upstream servers. Each source gets source_version_timeout seconds from when it starts, a source that takes
+        longer is treated as failed and its thread is abandoned. The threads are daemon threads, so one that never
+        returns doesn't keep the process from exiting, and another thread is started to take its place.
+
+        :param source_ids: the ids of the sources, versions are stored in self.latest_source_versions
+        """
+        source_ids = [source_id for source_id in source_ids if source_id not in self.latest_source_versions]
+        if not source_ids:
+            return
+        if len(source_ids) == 1 or self.source_version_workers == 1:
+            for source_id in source_ids:
+                self.latest_source_versions[source_id] = self.source_data_manager.get_latest_source_version(source_id)
+            return
+
+        self.logger.info(f'Retrieving latest source versions for {len(source_ids)} sources...')
+        source_id_queue = queue.Queue()
+        for source_id in source_ids:
+            source_id_queue.put(source_id)
+        results_queue = queue.Queue()
+        start_times = {}
+
+        def retrieve_queued_source_versions():
+            while True:
+                try:
+                    queued_source_id = source_id_queue.get_nowait()
+                except queue.Empty:
+                    return
+                start_times[queued_source_id] = time.time()
+                try:
+                    results_queue.put((queued_source_id,
+                                       self.source_data_manager.get_latest_source_version(queued_source_id),
+                                       None))
+                except Exception as e:
+                    results_queue.put((queued_source_id, None, e))
+
+        def start_worker_thread():
+            threading.Thread(target=retrieve_queued_source_versions, daemon=True).start()
+
+        for _ in range(min(self.source_version_workers, len(source_ids))):
+            start_worker_thread()
+
+        failures = {}
+        pending_source_ids = set(source_ids)
+        while pending_source_ids:
+            # wake up when something finishes or when the first running source could time out
+            now = time.time()
+            deadlines = [start_times[source_id] + self.source_version_timeout
+                         for source_id in pending_source_ids if source_id in start_times]
+            try:
+                source_id, latest_source_version, error = \
+                    results_queue.get(timeout=max(min(deadlines) - now, 0) if deadlines else 1)
+                # results of sources that already timed out are ignored
+                if source_id in pending_source_ids:
+                    pending_source_ids.remove(source_id)
+                    if error is None:
+                        self.latest_source_versions[source_id] = latest_source_version
+                    elif isinstance(error, (GetDataPullError, DataVersionError)):
+                        failures[source_id] = error.error_message
+                    else:
+                        failures[source_id] = f'Error while checking for latest source version for {source_id}: ' \
+                                              f'{repr(error)}'
+            except queue.Empty:
+                pass
+            now = time.time()
+            for source_id in list(pending_source_ids):
+                if source_id in start_times and now - start_times[source_id] >= self.source_version_timeout:
+                    pending_source_ids.remove(source_id)
+                    failures[source_id] = f'Timed out after {self.source_version_timeout} seconds while ' \
+                                          f'checking for latest source version for {source_id}.'
+                    # don't wait for it, let another thread take over the remaining sources
+                    start_worker_thread()
+        if failures:
+            # report the first failure in graph spec order so errors are the same from run to run
+            first_failed_source_id = next(source_id for source_id in source_ids if source_id in failures)
+            for source_id in source_ids:
+                if source_id in failures:
+                    self.logger.error(failures[source_id])
+            raise DataVersionError(error_message=failures[first_failed_source_id])
+
     def build_dependencies(self, graph_spec: GraphSpec):
         graph_id = graph_spec.graph_id
+
+        # run the pipelines for every data source that isn't ready, including the ones of subgraphs that need to be
+        # built, all at once up front, so that they can run concurrently
+        if self.source_pipeline_workers > 1:
+            if not self.run_source_pipelines(self.get_source_pipeline_jobs(graph_spec)):
+                self.logger.info(f'While attempting to build {graph_spec.graph_id}, '
+                                 f'data source pipelines failed for dependencies...')
+                return False
+
         for subgraph_source in graph_spec.subgraphs:
             subgraph_id = subgraph_source.id
             subgraph_version = subgraph_source.version
@@ -327,6 +494,46 @@ class GraphBuilder:
                                                                                    data_source.supplementation_version)
         return True
 
+    def get_source_pipeline_jobs(self, graph_spec: GraphSpec, source_pipeline_jobs: dict = None):
+        # find the data sources of a graph, and of any subgraphs that will need to be built for it, that aren't ready
+        if source_pipeline_jobs is None:
+            source_pipeline_jobs = {}
+        for subgraph_source in graph_spec.subgraphs:
+            subgraph_graph_spec = self.graph_specs.get(subgraph_source.id, None)
+            # subgraphs that are already built, or can't be built, don't need their sources
+            if self.check_for_existing_graph_dir(subgraph_source.id, subgraph_source.version) or \
+                    not subgraph_graph_spec or subgraph_source.version != subgraph_graph_spec.graph_version:
+                continue
+            self.get_source_pipeline_jobs(subgraph_graph_spec, source_pipeline_jobs)
+        for data_source in graph_spec.sources:
+            source_metadata = self.source_data_manager.get_source_metadata(data_source.id, data_source.source_version)
+            if source_metadata.get_release_info(data_source.generate_version()) is None:
+                source_pipeline_jobs[(data_source.id, data_source.generate_version())] = SourcePipelineJob(
+                    source_id=data_source.id,
+                    source_version=data_source.source_version,
+                    parsing_version=data_source.parsing_version,
+                    normalization_scheme=data_source.normalization_scheme,
+                    supplementation_version=data_source.supplementation_version)
+        return list(source_pipeline_jobs.values())
+
+    def run_source_pipelines(self, source_pipeline_jobs: list):
+        if not source_pipeline_jobs:
+            return True
+        self.logger.info(f'Running pipelines for {len(source_pipeline_jobs)} data sources that are not ready: '
+                         f'{[job.source_id for job in source_pipeline_jobs]}')
+        scheduler = SourcePipelineScheduler(source_data_manager=self.source_data_manager,
+                                            workers=self.source_pipeline_workers)
+        pipeline_results = scheduler.run(source_pipeline_jobs)
+        # the pipelines updated the metadata files of the sources in other processes, reload them
+        for job in source_pipeline_jobs:
+            self.source_data_manager.get_source_metadata(job.source_id, job.source_version).load_current_metadata()
+        failed_source_ids = [source_id for (source_id, source_version), pipeline_result in pipeline_results.items()
+                             if not pipeline_result]
+        if failed_source_ids:
+            self.logger.warning(f'Data source pipelines failed for: {failed_source_ids}')
+            return False
+        return True
+
     def has_meta_kg(self, graph_directory: str):
         if os.path.exists(os.path.join(graph_directory, META_KG_FILENAME)):
             return True
@@ -349,6 +556,18 @@ class GraphBuilder:
         mkgb = MetaKnowledgeGraphBuilder(nodes_file_path=graph_nodes_file_path,
                                          edges_file_path=graph_edges_file_path,
                                          logger=self.logger)
+        self.write_meta_kg_and_test_data(mkgb,
+                                         graph_directory=graph_directory,
+                                         generate_meta_kg=generate_meta_kg,
+                                         generate_test_data=generate_test_data,
+                                         generate_example_data=generate_example_data)
+
+    @staticmethod
+    def write_meta_kg_and_test_data(mkgb: MetaKnowledgeGraphBuilder,
+                                    graph_directory: str,
+                                    generate_meta_kg: bool = True,
+                                    generate_test_data: bool = True,
+                                    generate_example_data: bool = True):
         if generate_meta_kg:
             meta_kg_file_path = os.path.join(graph_directory, META_KG_FILENAME)
             mkgb.write_meta_kg_to_file(meta_kg_file_path)
@@ -565,11 +784,17 @@ if __name__ == '__main__':
     parser.add_argument('graph_id',
                         help='ID of the graph to build. Must match an ID from the configured Graph Spec.')
     parser.add_argument('--graph_specs_dir', type=str, default=None, help='Graph spec directory.')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Merge incrementally, reusing the sorted sources of previous builds that did not change.')
+    parser.add_argument('-w', '--workers', type=int, default=SOURCE_PIPELINE_WORKERS,
+                        help='The number of data source pipelines to run at once.')
     args = parser.parse_args()
     graph_id_arg = args.graph_id
     graph_specs_dir = args.graph_specs_dir
 
-    graph_builder = GraphBuilder(graph_specs_dir=graph_specs_dir)
+    graph_builder = GraphBuilder(graph_specs_dir=graph_specs_dir,
+                                 incremental_merge=args.incremental,
+                                 source_pipeline_workers=args.workers)
     if graph_id_arg == "all":
         for graph_spec in graph_builder.graph_specs.values():
             graph_builder.build_graph(graph_spec)
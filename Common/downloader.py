@@ -0,0 +1,333 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import requests
+
+from ftplib import FTP, error_perm
+from concurrent.futures import ThreadPoolExecutor
+
+# the number of connections used at once, for the parts of one file or for multiple files
+DOWNLOAD_CONNECTIONS = int(os.environ.get('ORION_DOWNLOAD_CONNECTIONS', 4))
+# http files are downloaded in parts of this many bytes, in parallel when the server supports range requests
+DOWNLOAD_PART_SIZE = int(os.environ.get('ORION_DOWNLOAD_PART_SIZE', 64 * 1024 * 1024))
+
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# bytes read from a connection at a time, what was read of a read that fails part way is lost
+DOWNLOAD_READ_SIZE = 64 * 1024
+# seconds to wait for a server to respond or send more data
+DOWNLOAD_TIMEOUT = 120
+# the progress of http downloads is saved after this many bytes, so an interrupted download can resume close to where
+# it stopped even if the process was killed
+DOWNLOAD_PROGRESS_SAVE_BYTES = 16 * 1024 * 1024
+
+# files are downloaded to a partial file next to the final file, which is renamed when the download completes, so a
+# file that exists was always downloaded completely
+PARTIAL_DOWNLOAD_SUFFIX = '.partial'
+# the progress of a partial http download, used to resume it
+PARTIAL_DOWNLOAD_STATE_SUFFIX = '.partial.json'
+# the url, size and sha256 of every file downloaded to a directory, see SourceMetadata.set_fetch_files
+DOWNLOAD_MANIFEST_FILENAME = '.downloads.json'
+
+# files are saved byte for byte as they are on the server, so no content encoding is requested, and the raw bytes of
+# responses are written even if the server applies one anyway, ie. a .gz file served with Content-Encoding: gzip
+HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+                'Accept-Encoding': 'identity'}
+
+# the manifest of a directory can be updated by multiple download threads
+download_manifest_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    def __init__(self, error_message: str):
+        self.error_message = error_message
+
+    def __str__(self):
+        return self.error_message
+
+
+def get_file_sha256(file_path: str):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as downloaded_file:
+        while buffer := downloaded_file.read(DOWNLOAD_BUFFER_SIZE):
+            sha256.update(buffer)
+    return sha256.hexdigest()
+
+
+def read_download_manifest(data_dir: str):
+    """
+    :param data_dir: a directory files were downloaded to
+    :return: a dict of file name -> {'url': ..., 'size': ..., 'sha256': ...} for the files downloaded there
+    """
+    try:
+        with open(os.path.join(data_dir, DOWNLOAD_MANIFEST_FILENAME)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def record_download(file_path: str, url: str):
+    file_info = {'url': url,
+                 'size': os.path.getsize(file_path),
+                 'sha256': get_file_sha256(file_path)}
+    data_dir, file_name = os.path.split(file_path)
+    with download_manifest_lock:
+        download_manifest = read_download_manifest(data_dir)
+        download_manifest[file_name] = file_info
+        write_json_atomically(download_manifest, os.path.join(data_dir, DOWNLOAD_MANIFEST_FILENAME))
+    return file_info
+
+
+def write_json_atomically(json_object, file_path: str):
+    temp_file_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.temp'
+    with open(temp_file_path, 'w') as temp_file:
+        json.dump(json_object, temp_file, indent=4)
+    os.replace(temp_file_path, file_path)
+
+
+class FileDownloader:
+    """
+    Downloads files over http and ftp. Http files are downloaded in parts with range requests, using multiple
+    connections at once when the server supports them, and multiple files can be downloaded at once with a pool of
+    connections. Downloads go to a partial file that is renamed when it's complete, and an interrupted download resumes
+    where it left off the next time the same file is downloaded. The size and sha256 of every downloaded file is
+    recorded in a manifest in its directory.
+
+    The number of transfers happening at once, across all files, is limited to connections.
+    """
+
+    def __init__(self,
+                 connections: int = DOWNLOAD_CONNECTIONS,
+                 part_size: int = DOWNLOAD_PART_SIZE,
+                 logger: logging.Logger = None):
+        self.connections = max(connections, 1)
+        self.part_size = part_size
+        self.logger = logger if logger is not None else logging.getLogger("ORION.Common.FileDownloader")
+        self.connection_slots = threading.BoundedSemaphore(self.connections)
+
+    def download_http_files(self, urls: list, data_dir: str, file_names: list = None):
+        """
+        Download multiple http files at once.
+
+        :param urls: the urls of the files
+        :param data_dir: the directory to save them in
+        :param file_names: the names to save them as, defaults to the last part of each url
+        :return: a list of the sizes of the files
+        """
+        file_names = file_names if file_names else [url.split('/')[-1] for url in urls]
+        file_paths = [os.path.join(data_dir, file_name) for file_name in file_names]
+        if len(urls) == 1:
+            return [self.download_http(urls[0], file_paths[0])]
+        with ThreadPoolExecutor(max_workers=min(self.connections, len(urls))) as thread_pool:
+            return list(thread_pool.map(self.download_http, urls, file_paths))
+
+    def download_http(self, url: str, file_path: str, headers: dict = None):
+        """
+        Download an http file, resuming a previous partial download of it if there is one.
+
+        :return: the size of the file
+        """
+        headers = {**HTTP_HEADERS, **(headers if headers else {})}
+        partial_file_path = f'{file_path}{PARTIAL_DOWNLOAD_SUFFIX}'
+        state_file_path = f'{file_path}{PARTIAL_DOWNLOAD_STATE_SUFFIX}'
+        try:
+            file_size, supports_ranges, validator = self.get_http_file_info(url, headers)
+            if supports_ranges and file_size:
+                self.download_http_parts(url, headers, partial_file_path, state_file_path, file_size, validator)
+            else:
+                # the file has to be downloaded in one go, there's no way to resume it
+                self.logger.debug(f'Range requests are not supported for {url}, downloading it in one request.')
+                with self.connection_slots, \
+                        requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    response.raise_for_status()
+                    with open(partial_file_path, 'wb') as partial_file:
+                        while buffer := response.raw.read(DOWNLOAD_BUFFER_SIZE, decode_content=False):
+                            partial_file.write(buffer)
+            if file_size and os.path.getsize(partial_file_path) != file_size:
+                raise DownloadError(f'Downloaded {os.path.getsize(partial_file_path)} bytes but the server reported '
+                                    f'{file_size} bytes.')
+        except DownloadError as e:
+            raise DownloadError(f'Download failed for {url}: {e.error_message}')
+        except Exception as e:
+            raise DownloadError(f'Download failed for {url}: {repr(e)}')
+
+        os.replace(partial_file_path, file_path)
+        if os.path.exists(state_file_path):
+            os.remove(state_file_path)
+        file_info = record_download(file_path, url)
+        self.logger.debug(f'Downloaded {url} -> {file_path} ({file_info["size"]} bytes)')
+        return file_info['size']
+
+    @staticmethod
+    def get_http_file_info(url: str, headers: dict):
+        # returns the size of the file, whether the server supports range requests, and something that changes
+        # when the file does (the etag or modification date), or Nones if the server doesn't say or doesn't do HEAD
+        response = requests.head(url, headers=headers, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code >= 400:
+            return None, False, None
+        content_length = response.headers.get('content-length', None)
+        file_size = int(content_length) if content_length and content_length.isdigit() else None
+        supports_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+        validator = response.headers.get('etag', None) or response.headers.get('last-modified', None)
+        return file_size, supports_ranges, validator
+
+    def download_http_parts(self,
+                            url: str,
+                            headers: dict,
+                            partial_file_path: str,
+                            state_file_path: str,
+                            file_size: int,
+                            validator: str):
+        # the state is the file's size and validator, and a list of [start, end, next byte to download] for each part
+        download_state = None
+        if os.path.exists(state_file_path) and os.path.exists(partial_file_path):
+            try:
+                with open(state_file_path) as state_file:
+                    download_state = json.load(state_file)
+            except json.JSONDecodeError:
+                download_state = None
+            if download_state and (download_state['size'] != file_size or download_state['validator'] != validator or
+                                   os.path.getsize(partial_file_path) != file_size):
+                self.logger.info(f'{url} changed since it was partially downloaded, starting over.')
+                download_state = None
+        if download_state is None:
+            download_state = {'url': url,
+                              'size': file_size,
+                              'validator': validator,
+                              'parts': [[start, min(start + self.part_size, file_size) - 1, start]
+                                        for start in range(0, file_size, self.part_size)]}
+            with open(partial_file_path, 'wb') as partial_file:
+                partial_file.truncate(file_size)
+            write_json_atomically(download_state, state_file_path)
+        else:
+            downloaded_bytes = sum(next_byte - start for start, end, next_byte in download_state['parts'])
+            self.logger.info(f'Resuming download of {url} ({downloaded_bytes} of {file_size} bytes downloaded).')
+
+        remaining_parts = [part for part in download_state['parts'] if part[2] <= part[1]]
+        state_lock = threading.Lock()
+
+        def save_part_progress(part: list, next_byte: int):
+            with state_lock:
+                part[2] = next_byte
+                write_json_atomically(download_state, state_file_path)
+
+        def download_part(part: list):
+            start, end, next_byte = part
+            part_headers = {**headers, 'Range': f'bytes={next_byte}-{end}'}
+            unsaved_bytes = 0
+            with self.connection_slots, \
+                    requests.get(url, headers=part_headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response, \
+                    open(partial_file_path, 'r+b') as partial_file:
+                if response.status_code != 206:
+                    raise DownloadError(f'Expected a partial response (206) for bytes {next_byte}-{end}, '
+                                        f'got {response.status_code}.')
+                partial_file.seek(next_byte)
+                try:
+                    while next_byte <= end:
+                        buffer = response.raw.read(min(DOWNLOAD_READ_SIZE, end + 1 - next_byte), decode_content=False)
+                        if not buffer:
+                            break
+                        partial_file.write(buffer)
+                        next_byte += len(buffer)
+                        unsaved_bytes += len(buffer)
+                        if unsaved_bytes >= DOWNLOAD_PROGRESS_SAVE_BYTES:
+                            # make sure the data is written before recording that it was
+                            partial_file.flush()
+                            save_part_progress(part, next_byte)
+                            unsaved_bytes = 0
+                finally:
+                    partial_file.flush()
+                    save_part_progress(part, next_byte)
+            if next_byte <= end:
+                raise DownloadError(f'The connection closed after byte {next_byte - 1} of part {start}-{end}.')
+
+        if len(remaining_parts) == 1 or self.connections == 1:
+            for part in remaining_parts:
+                download_part(part)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.connections, len(remaining_parts))) as thread_pool:
+                # list() so that the first error, if any, is raised once every part is finished or failed
+                list(thread_pool.map(download_part, remaining_parts))
+
+    def download_ftp_files(self, ftp_site: str, ftp_dir: str, ftp_files: list, data_dir: str):
+        """
+        Download multiple files from a directory of an ftp site at once, using a pool of ftp connections.
+
+        :return: a list of the sizes of the files
+        """
+        if not ftp_files:
+            return []
+        ftp_connections = []
+        thread_connections = threading.local()
+
+        def download_ftp_file(ftp_file: str):
+            # each thread logs in once and reuses its connection for every file it downloads
+            if not hasattr(thread_connections, 'ftp'):
+                ftp = FTP(ftp_site, timeout=DOWNLOAD_TIMEOUT)
+                ftp_connections.append(ftp)
+                ftp.login()
+                ftp.cwd(ftp_dir)
+                thread_connections.ftp = ftp
+            return self.download_ftp(thread_connections.ftp,
+                                     ftp_file,
+                                     os.path.join(data_dir, ftp_file),
+                                     url=f'ftp://{ftp_site}{ftp_dir}{"" if ftp_dir.endswith("/") else "/"}{ftp_file}')
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.connections, len(ftp_files))) as thread_pool:
+                return list(thread_pool.map(download_ftp_file, ftp_files))
+        except DownloadError:
+            raise
+        except Exception as e:
+            raise DownloadError(f'Download failed for ftp://{ftp_site}{ftp_dir}: {repr(e)}')
+        finally:
+            for ftp in ftp_connections:
+                try:
+                    ftp.quit()
+                except Exception:
+                    ftp.close()
+
+    def download_ftp(self, ftp: FTP, ftp_file: str, file_path: str, url: str):
+        """
+        Download a file from the current directory of an ftp connection, resuming a previous partial download of it.
+
+        :return: the size of the file
+        """
+        partial_file_path = f'{file_path}{PARTIAL_DOWNLOAD_SUFFIX}'
+        try:
+            ftp.voidcmd('TYPE I')
+            try:
+                file_size = ftp.size(ftp_file)
+            except error_perm:
+                # some servers don't support SIZE
+                file_size = None
+            offset = os.path.getsize(partial_file_path) if os.path.exists(partial_file_path) else 0
+            if file_size is None or offset > file_size:
+                offset = 0
+            if offset:
+                self.logger.info(f'Resuming download of {url} ({offset} of {file_size} bytes downloaded).')
+            if not file_size or offset < file_size:
+                try:
+                    with open(partial_file_path, 'ab' if offset else 'wb') as partial_file:
+                        ftp.retrbinary(f'RETR {ftp_file}', partial_file.write,
+                                       blocksize=DOWNLOAD_BUFFER_SIZE, rest=offset if offset else None)
+                except error_perm:
+                    if not offset:
+                        raise
+                    # the server doesn't support resuming (REST), start over
+                    self.logger.info(f'Resuming is not supported for {url}, starting over.')
+                    with open(partial_file_path, 'wb') as partial_file:
+                        ftp.retrbinary(f'RETR {ftp_file}', partial_file.write, blocksize=DOWNLOAD_BUFFER_SIZE)
+            if file_size is not None and os.path.getsize(partial_file_path) != file_size:
+                raise DownloadError(f'Downloaded {os.path.getsize(partial_file_path)} bytes but the server reported '
+                                    f'{file_size} bytes.')
+        except DownloadError as e:
+            raise DownloadError(f'Download failed for {url}: {e.error_message}')
+        except Exception as e:
+            raise DownloadError(f'Download failed for {url}: {repr(e)}')
+
+        os.replace(partial_file_path, file_path)
+        file_info = record_download(file_path, url)
+        self.logger.debug(f'Downloaded {url} -> {file_path} ({file_info["size"]} bytes)')
+        return file_info['size']
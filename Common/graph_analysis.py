@@ -0,0 +1,74 @@
+from Common.biolink_constants import NODE_TYPES
+from Common.biolink_utils import BiolinkUtils
+from Common.utils import quick_jsonl_file_iterator
+
+
+class GraphAnalysisConsumer:
+    """
+    A consumer of a GraphAnalyzer scan, it's given every node and then every edge of a graph.
+    """
+
+    # called for every node, leaf_types are the node's types that are leaves in the biolink model,
+    # or None if they couldn't be determined
+    def process_node(self, node: dict, leaf_types):
+        pass
+
+    # called once after all the nodes were processed
+    def nodes_complete(self):
+        pass
+
+    # called for every edge, node_leaf_types is a lookup of node id to leaf types for every node in the graph
+    def process_edge(self, edge: dict, node_leaf_types: dict):
+        pass
+
+    # called once after all the edges were processed
+    def edges_complete(self):
+        pass
+
+
+class GraphAnalyzer:
+    """
+    Reads the nodes and edges files of a graph once each, and hands every node and edge to the registered consumers.
+    The leaf node types of every node are determined once, and shared by all the consumers. Loading the biolink model
+    is slow, consumers that need it should be given the analyzer's bl_utils instead of loading their own.
+    """
+
+    def __init__(self,
+                 nodes_file_path: str,
+                 edges_file_path: str,
+                 logger=None,
+                 bl_utils: BiolinkUtils = None):
+        self.nodes_file_path = nodes_file_path
+        self.edges_file_path = edges_file_path
+        self.logger = logger
+        self.bl_utils = bl_utils if bl_utils else BiolinkUtils()
+        self.consumers = []
+        self.node_leaf_types = {}
+
+    def register_consumer(self, consumer: GraphAnalysisConsumer):
+        self.consumers.append(consumer)
+
+    def analyze(self):
+        if not self.consumers:
+            return
+
+        node_leaf_types = {}
+        for node in quick_jsonl_file_iterator(self.nodes_file_path):
+            # find the leaf node types of this node's types according to the biolink model
+            try:
+                leaf_types = self.bl_utils.find_biolink_leaves(frozenset(node[NODE_TYPES]))
+                node_leaf_types[node['id']] = leaf_types
+            except TypeError:
+                leaf_types = None
+                node_leaf_types[node['id']] = {}
+            for consumer in self.consumers:
+                consumer.process_node(node, leaf_types)
+        self.node_leaf_types = node_leaf_types
+        for consumer in self.consumers:
+            consumer.nodes_complete()
+
+        for edge in quick_jsonl_file_iterator(self.edges_file_path):
+            for consumer in self.consumers:
+                consumer.process_edge(edge, node_leaf_types)
+        for consumer in self.consumers:
+            consumer.edges_complete()
@@ -1,3 +1,5 @@
+import polars as pl
+
 
 # look up for reference chromosomes for HGVS conversion
 REFERENCE_CHROMOSOME_LOOKUP: dict = {
@@ -109,3 +111,100 @@ def convert_variant_to_hgvs(chromosome,
 
     # return the expression to the caller
     return hgvs
+
+
+def get_chromosome_strings(chromosomes):
+    # chromosomes as a String Series, they're usually all strings or all integers
+    try:
+        chromosome_series = pl.Series(chromosomes)
+        if chromosome_series.dtype == pl.String:
+            return chromosome_series
+        if chromosome_series.dtype.is_integer():
+            return chromosome_series.cast(pl.String)
+    except (TypeError, ValueError, pl.exceptions.PolarsError):
+        pass
+    return pl.Series([str(chromosome) for chromosome in chromosomes], dtype=pl.String)
+
+
+def convert_variants_to_hgvs(chromosomes,
+                             positions,
+                             ref_alleles,
+                             alt_alleles,
+                             reference_genomes='b38',
+                             reference_patches='p1'):
+    """
+    Convert many variants to HGVS at once, with the same results as calling convert_variant_to_hgvs on each of them,
+    including '' for the ones that can't be converted.
+
+    :param chromosomes: a sequence of chromosomes (strings like '1' or 'X', or integers)
+    :param positions: a sequence of integer positions
+    :param ref_alleles: a sequence of reference alleles
+    :param alt_alleles: a sequence of alternate alleles
+    :param reference_genomes: a sequence of reference genomes, or one for all of the variants
+    :param reference_patches: a sequence of reference patches, or one for all of the variants
+    :return: a polars Series of HGVS expressions
+    """
+    variants = pl.DataFrame({'chromosome': get_chromosome_strings(chromosomes),
+                             'position': pl.Series(positions, dtype=pl.Int64),
+                             'ref': pl.Series(ref_alleles, dtype=pl.String),
+                             'alt': pl.Series(alt_alleles, dtype=pl.String)})
+    variants = variants.with_columns(
+        genome=pl.Series(reference_genomes, dtype=pl.String) if not isinstance(reference_genomes, str)
+        else pl.lit(reference_genomes),
+        patch=pl.Series(reference_patches, dtype=pl.String) if not isinstance(reference_patches, str)
+        else pl.lit(reference_patches))
+
+    # chromosome numbers, X and Y are 23 and 24. anything besides plain digits is converted with int() like the scalar
+    # version does, which raises the same ValueError for chromosomes that aren't numbers
+    chromosome_numbers = variants.select(
+        pl.when(pl.col('chromosome') == 'X').then(23)
+        .when(pl.col('chromosome') == 'Y').then(24)
+        .when(pl.col('chromosome').str.contains(r'^[0-9]+$')).then(pl.col('chromosome').cast(pl.Int64, strict=False))
+        .otherwise(None)).to_series()
+    if chromosome_numbers.null_count():
+        original_chromosomes = list(chromosomes)
+        chromosome_numbers = pl.Series([chromosome_number if chromosome_number is not None
+                                        else int(original_chromosomes[i])
+                                        for i, chromosome_number in enumerate(chromosome_numbers)], dtype=pl.Int64)
+    reference_chromosome_lookup = {f'{genome}|{patch}|{chromosome_number}': ref_chromosome
+                                   for genome, patches in REFERENCE_CHROMOSOME_LOOKUP.items()
+                                   for patch, ref_chromosomes in patches.items()
+                                   for chromosome_number, ref_chromosome in ref_chromosomes.items()}
+    variants = variants.with_columns(
+        ref_chromosome=pl.concat_str([pl.col('genome'), pl.col('patch'), chromosome_numbers.cast(pl.String)],
+                                     separator='|').replace_strict(reference_chromosome_lookup,
+                                                                   default=None,
+                                                                   return_dtype=pl.String),
+        len_ref=pl.col('ref').str.len_chars().cast(pl.Int64),
+        len_alt=pl.col('alt').str.len_chars().cast(pl.Int64))
+
+    position = pl.col('position')
+    len_ref = pl.col('len_ref')
+    len_alt = pl.col('len_alt')
+    variation = (
+        # deletions
+        pl.when((pl.col('alt') == '.') & (len_ref == 1))
+        .then(pl.format('{}del', position))
+        .when(pl.col('alt') == '.')
+        .then(pl.format('{}_{}del', position, position + len_ref - 1))
+        # we know about these but don't support them yet
+        .when(pl.col('alt').str.starts_with('<'))
+        .then(None)
+        # SNPs
+        .when((len_ref == 1) & (len_alt == 1))
+        .then(pl.format('{}{}>{}', position, pl.col('ref'), pl.col('alt')))
+        # insertions, the alternate allele is larger than the reference and starts with it
+        .when((len_alt > len_ref) & pl.col('alt').str.starts_with(pl.col('ref')))
+        .then(pl.format('{}_{}ins{}', position + len_ref - 1, position + len_ref,
+                        pl.col('alt').str.slice(len_ref)))
+        # deletions, the reference is larger than the alternate allele and starts with it
+        .when((len_ref == len_alt + 1) & pl.col('ref').str.starts_with(pl.col('alt')))
+        .then(pl.format('{}del', position + len_alt))
+        .when((len_ref > len_alt) & pl.col('ref').str.starts_with(pl.col('alt')))
+        .then(pl.format('{}_{}del', position + len_alt, position + len_ref - 1))
+        # we do not support this allele
+        .otherwise(None))
+    return variants.select(
+        pl.when(pl.col('ref_chromosome').is_null()).then(pl.lit(''))
+        .otherwise(pl.format('{}:g.{}', pl.col('ref_chromosome'), variation).fill_null(''))
+        .alias('hgvs')).to_series()
@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+from functools import partial
+from xxhash import xxh64_hexdigest
+from Common.utils import LoggingUtil, chunk_iterator, open_kgx_jsonlines
+from Common.kgxmodel import GraphSource
+from Common.merging import write_sorted_run, node_key_function, edge_key_function, zstandard, \
+    DISK_MERGE_CHUNK_SIZE, NODE_ENTITY_TYPE, EDGE_ENTITY_TYPE, TEMP_FILE_FORMAT_VERSION
+
+logger = LoggingUtil.init_logging("ORION.Common.incremental_merging",
+                                  line_format='medium',
+                                  log_file_path=os.environ['ORION_LOGS'])
+
+CONTRIBUTION_INDEX_FILENAME = 'contributions.json'
+
+# the runs are kept between builds so they're always compressed
+CONTRIBUTION_RUN_COMPRESSION = 'zstd' if zstandard is not None else 'zlib'
+
+
+class SourceContributionIndex:
+    """
+    Keeps the nodes and edges that each primary source contributed to a graph as sorted runs, the same sorted files of
+    (merge key, entity) records that DiskGraphMerger makes, so that later versions of the graph can reuse the runs of
+    sources that didn't change and only read and sort the sources that did. Merging the runs in source order gives
+    exactly the same results as merging all of the sources from scratch on disk.
+
+    Contributions are stored by a key made from everything about a source that determines its runs: its id, its
+    version, how its edges are keyed, and the format of the run files. When a source changes it gets a new key, and the
+    contribution under the old key is retracted once a graph has been built without it.
+    """
+
+    def __init__(self,
+                 index_directory: str,
+                 chunk_size: int = DISK_MERGE_CHUNK_SIZE,
+                 compression: str = CONTRIBUTION_RUN_COMPRESSION):
+        self.index_directory = index_directory
+        self.chunk_size = chunk_size
+        self.compression = compression
+        os.makedirs(index_directory, exist_ok=True)
+        self.index_file_path = os.path.join(index_directory, CONTRIBUTION_INDEX_FILENAME)
+        self.contributions = {}
+        if os.path.exists(self.index_file_path):
+            with open(self.index_file_path) as index_file:
+                self.contributions = json.load(index_file)
+
+    @staticmethod
+    def get_contribution_key(graph_source: GraphSource):
+        return xxh64_hexdigest(json.dumps([graph_source.id,
+                                           graph_source.version,
+                                           graph_source.edge_merging_attributes,
+                                           graph_source.edge_id_addition,
+                                           TEMP_FILE_FORMAT_VERSION]))
+
+    def get_contribution(self, graph_source: GraphSource):
+        # returns the contribution of a source if it was already indexed and all of its runs are still there
+        contribution = self.contributions.get(self.get_contribution_key(graph_source), None)
+        if contribution is None:
+            return None
+        if not all(os.path.exists(run_file_path)
+                   for entity_type in (NODE_ENTITY_TYPE, EDGE_ENTITY_TYPE)
+                   for run_file_path in self.get_run_file_paths(contribution, entity_type)):
+            return None
+        return contribution
+
+    def add_contribution(self, graph_source: GraphSource):
+        """
+        Read and sort the nodes and edges of a source into runs, and add them to the index.
+
+        :return: the contribution, a dictionary of the run files and the number of entities from each source file
+        """
+        contribution_key = self.get_contribution_key(graph_source)
+        logger.info(f'Indexing the contribution of {graph_source.id} ({graph_source.version})...')
+        # write the runs to a separate directory first, so a failure doesn't leave a partial contribution behind
+        partial_directory = os.path.join(self.index_directory, f'{contribution_key}.partial')
+        shutil.rmtree(partial_directory, ignore_errors=True)
+        os.makedirs(partial_directory)
+        contribution = {'source_id': graph_source.id,
+                        'version': graph_source.version,
+                        'directory': contribution_key,
+                        NODE_ENTITY_TYPE: [],
+                        EDGE_ENTITY_TYPE: [],
+                        'file_counts': {}}
+        edge_sorting_function = partial(edge_key_function,
+                                        custom_key_attributes=graph_source.edge_merging_attributes)
+        for entity_type, file_paths, sorting_function, count_name in (
+                (NODE_ENTITY_TYPE, graph_source.get_node_file_paths(), node_key_function, 'nodes'),
+                (EDGE_ENTITY_TYPE, graph_source.get_edge_file_paths(), edge_sorting_function, 'edges')):
+            for file_path in file_paths:
+                entity_count = 0
+                with open_kgx_jsonlines(file_path) as entities:
+                    for chunk_of_entities in chunk_iterator(entities, self.chunk_size):
+                        run_file_name = f'{entity_type}_{len(contribution[entity_type]):05}.run'
+                        write_sorted_run(chunk_of_entities,
+                                         sorting_function,
+                                         os.path.join(partial_directory, run_file_name),
+                                         self.compression)
+                        contribution[entity_type].append(run_file_name)
+                        entity_count += len(chunk_of_entities)
+                contribution['file_counts'][file_path.rsplit('/')[-1]] = {count_name: entity_count}
+
+        contribution_directory = os.path.join(self.index_directory, contribution_key)
+        shutil.rmtree(contribution_directory, ignore_errors=True)
+        os.rename(partial_directory, contribution_directory)
+        self.contributions[contribution_key] = contribution
+        self.save()
+        return contribution
+
+    def get_run_file_paths(self, contribution: dict, entity_type: str):
+        contribution_directory = os.path.join(self.index_directory, contribution['directory'])
+        return [os.path.join(contribution_directory, run_file_name) for run_file_name in contribution[entity_type]]
+
+    def retract_contributions(self, graph_sources: list):
+        """
+        Remove every contribution that isn't from one of the graph_sources, like the old versions of changed sources.
+
+        :return: the ids of the sources that had contributions removed
+        """
+        keep_keys = {self.get_contribution_key(graph_source) for graph_source in graph_sources}
+        retracted_source_ids = []
+        for contribution_key in list(self.contributions):
+            if contribution_key in keep_keys:
+                continue
+            contribution = self.contributions.pop(contribution_key)
+            shutil.rmtree(os.path.join(self.index_directory, contribution['directory']), ignore_errors=True)
+            retracted_source_ids.append(contribution['source_id'])
+        if retracted_source_ids:
+            logger.info(f'Retracted old contributions of {retracted_source_ids}')
+            self.save()
+        return retracted_source_ids
+
+    def save(self):
+        temp_index_file_path = f'{self.index_file_path}.temp'
+        with open(temp_index_file_path, 'w') as index_file:
+            json.dump(self.contributions, index_file, indent=4)
+        os.replace(temp_index_file_path, self.index_file_path)
@@ -1,9 +1,41 @@
+import os
 import csv
 import json
+import orjson
 import argparse
+from contextlib import nullcontext
 from collections import defaultdict
-from Common.utils import quick_jsonl_file_iterator
-from Common.biolink_constants import SUBJECT_ID, OBJECT_ID, PREDICATE
+from concurrent.futures import ProcessPoolExecutor
+from Common.utils import quick_jsonl_file_iterator, chunk_iterator, get_byte_range_shards, read_byte_range_lines
+from Common.biolink_constants import SUBJECT_ID, OBJECT_ID, PREDICATE, NAMED_THING
+
+# the number of processes used to convert jsonl files to neo4j csv files, each converts a byte range of the file
+NEO4J_CSV_CONVERSION_WORKERS = int(os.environ.get('NEO4J_CSV_CONVERSION_WORKERS', min(os.cpu_count() or 1, 8)))
+
+# the number of rows a worker converts at once, a new csv part is started when a chunk has new properties
+NEO4J_CSV_CONVERSION_CHUNK_SIZE = 100_000
+
+# the first line of the file listing the csv parts, which is written in place of a single csv file
+NEO4J_CSV_PARTS_MANIFEST_MARKER = '# neo4j csv parts'
+
+# the number of nodes or edges in each UNWIND statement of a batched memgraph cypher file
+MEMGRAPH_CYPHER_BATCH_SIZE = int(os.environ.get('MEMGRAPH_CYPHER_BATCH_SIZE', 10_000))
+
+# jsonl files, plain or compressed, that can be converted
+JSONL_FILE_EXTENSIONS = ('jsonl', 'jsonl.gz', 'jsonl.zst')
+
+# these will get converted into headers
+# required properties have unique/specialized types of the following instead of normal variable types
+REQUIRED_NODE_PROPERTIES = {
+    'id': 'ID',
+    'name': 'string',
+    'category': 'LABEL'
+}
+REQUIRED_EDGE_PROPERTIES = {
+    SUBJECT_ID: 'START_ID',
+    PREDICATE: 'TYPE',
+    OBJECT_ID: 'END_ID'
+}
 
 
 def __normalize_value(v):
@@ -32,9 +64,9 @@ def convert_jsonl_to_memgraph_cypher(nodes_input_file: str,
     node_property_ignore_list : set, optional, properties to ignore when writing node properties.
     edge_property_ignore_list : set, optional, properties to ignore when writing edge properties.
     """
-    if not nodes_input_file or not nodes_input_file.endswith('jsonl'):
+    if not nodes_input_file or not nodes_input_file.endswith(JSONL_FILE_EXTENSIONS):
         raise Exception(f'Empty input node file or invalid file extension')
-    if not edges_input_file or not edges_input_file.endswith('jsonl'):
+    if not edges_input_file or not edges_input_file.endswith(JSONL_FILE_EXTENSIONS):
         raise Exception(f'Empty input edge file or invalid file extension')
     if not output_cypher_file or not output_cypher_file.endswith('.cypher'):
         raise Exception(f'Empty output cypher file or invalid file extension')
@@ -90,6 +122,125 @@ def convert_jsonl_to_memgraph_cypher(nodes_input_file: str,
             )
 
 
+def convert_jsonl_to_memgraph_cypher_batched(nodes_input_file: str,
+                                             edges_input_file: str,
+                                             output_cypher_file: str,
+                                             node_property_ignore_list=None,
+                                             edge_property_ignore_list=None,
+                                             batch_size: int = MEMGRAPH_CYPHER_BATCH_SIZE):
+    """
+    Convert nodes.jsonl and edges.jsonl into a .cypher file for Memgraph import, using batched statements.
+    The file starts with an index and a uniqueness constraint on node ids, then nodes are created with one
+    UNWIND statement per batch of nodes with the same labels, and edges with one UNWIND statement per batch of edges
+    with the same predicate. Every node also gets the biolink:NamedThing label, so edges can find their nodes with
+    the index instead of scanning every node.
+
+    Parameters
+    ----------
+    nodes_input_file : path to input nodes.jsonl file.
+    edges_input_file : path to input edges.jsonl file.
+    output_cypher_file : path to output .cypher file.
+    node_property_ignore_list : set, optional, properties to ignore when writing node properties.
+    edge_property_ignore_list : set, optional, properties to ignore when writing edge properties.
+    batch_size : int, optional, the max number of nodes or edges in each statement.
+
+    Returns
+    -------
+    dict of the number of nodes, edges, and statements written
+    """
+    if not nodes_input_file or not nodes_input_file.endswith(JSONL_FILE_EXTENSIONS):
+        raise Exception(f'Empty input node file or invalid file extension')
+    if not edges_input_file or not edges_input_file.endswith(JSONL_FILE_EXTENSIONS):
+        raise Exception(f'Empty input edge file or invalid file extension')
+    if not output_cypher_file or not output_cypher_file.endswith('.cypher'):
+        raise Exception(f'Empty output cypher file or invalid file extension')
+
+    node_label = f'`{NAMED_THING}`'
+    counts = {'nodes': 0, 'edges': 0, 'statements': 0}
+    with open(output_cypher_file, "w", encoding="utf-8") as cypher_out:
+
+        def write_statement(statement: str):
+            cypher_out.write(f'{statement};\n')
+            counts['statements'] += 1
+
+        write_statement(f'CREATE INDEX ON :{node_label}(id)')
+        write_statement(f'CREATE CONSTRAINT ON (n:{node_label}) ASSERT n.id IS UNIQUE')
+
+        def write_node_batch(labels_str: str, node_batch: list):
+            write_statement(f'UNWIND [{", ".join(node_batch)}] AS props CREATE (n:{labels_str}) SET n = props')
+
+        node_batches = defaultdict(list)
+        for node in quick_jsonl_file_iterator(nodes_input_file):
+            if 'id' not in node:
+                raise Exception('each node must include required property id')
+            if 'name' not in node:
+                raise Exception('each node must include required property name')
+            if 'category' not in node:
+                raise Exception(f'each node must include required property category')
+
+            categories = node.pop('category')
+            if isinstance(categories, str):
+                categories = [categories]
+            if not categories:
+                categories = []
+            if NAMED_THING not in categories:
+                categories = categories + [NAMED_THING]
+            # convert categories list to a labels string, add backticks to allow handling colons
+            labels_str = ":".join(f"`{c}`" for c in categories)
+
+            if node_property_ignore_list:
+                for ignore_key in node_property_ignore_list:
+                    node.pop(ignore_key, None)
+
+            node_batch = node_batches[labels_str]
+            node_batch.append(__to_cypher_map(node))
+            counts['nodes'] += 1
+            if len(node_batch) >= batch_size:
+                write_node_batch(labels_str, node_batch)
+                del node_batches[labels_str]
+        for labels_str, node_batch in node_batches.items():
+            write_node_batch(labels_str, node_batch)
+
+        def write_edge_batch(predicate: str, edge_batch: list):
+            write_statement(f'UNWIND [{", ".join(edge_batch)}] AS row '
+                            f'MATCH (a:{node_label} {{id: row.subject}}), (b:{node_label} {{id: row.object}}) '
+                            f'CREATE (a)-[r:`{predicate}`]->(b) SET r = row.props')
+
+        edge_batches = defaultdict(list)
+        for edge in quick_jsonl_file_iterator(edges_input_file):
+            if SUBJECT_ID not in edge:
+                raise Exception(f'each edge must include required property {SUBJECT_ID}')
+            if OBJECT_ID not in edge:
+                raise Exception(f'each edge must include required property {OBJECT_ID}')
+            if PREDICATE not in edge:
+                raise Exception(f'each edge must include required property {PREDICATE}')
+            subj = edge.pop(SUBJECT_ID)
+            obj = edge.pop(OBJECT_ID)
+            predicate = edge.pop(PREDICATE)
+
+            if edge_property_ignore_list:
+                for ignore_key in edge_property_ignore_list:
+                    edge.pop(ignore_key, None)
+
+            edge_batch = edge_batches[predicate]
+            edge_batch.append(f'{{subject: {json.dumps(subj, ensure_ascii=False)}, '
+                              f'object: {json.dumps(obj, ensure_ascii=False)}, '
+                              f'props: {__to_cypher_map(edge)}}}')
+            counts['edges'] += 1
+            if len(edge_batch) >= batch_size:
+                write_edge_batch(predicate, edge_batch)
+                del edge_batches[predicate]
+        for predicate, edge_batch in edge_batches.items():
+            write_edge_batch(predicate, edge_batch)
+    return counts
+
+
+def __to_cypher_map(properties: dict):
+    # a cypher map literal, keys are backticked because they can contain colons
+    return "{" + ", ".join(f"`{k}`: {json.dumps(__normalize_value(v), ensure_ascii=False)}"
+                           for k, v in properties.items()) + "}"
+
+
 def convert_jsonl_to_neo4j_csv(nodes_input_file: str,
                                edges_input_file: str,
                                nodes_output_file: str = None,
@@ -104,14 +255,7 @@ def convert_jsonl_to_neo4j_csv(nodes_input_file: str,
     if not edges_output_file:
         edges_output_file = f'{edges_input_file.rsplit(".")[0]}.csv'
 
-    # these will get converted into headers
-    # required properties have unique/specialized types of the following instead of normal variable types
-    required_node_properties = {
-        'id': 'ID',
-        'name': 'string',
-        'category': 'LABEL'
-    }
-    node_properties = __determine_properties_and_types(nodes_input_file, required_node_properties)
+    node_properties = __determine_properties_and_types(nodes_input_file, REQUIRED_NODE_PROPERTIES)
     __convert_to_csv(input_file=nodes_input_file,
                      output_file=nodes_output_file,
                      properties=node_properties,
@@ -120,14 +264,7 @@ def convert_jsonl_to_neo4j_csv(nodes_input_file: str,
                      property_ignore_list=node_property_ignore_list)
     # __verify_conversion(nodes_output_file, node_properties, array_delimiter, output_delimiter)
 
-    # these will get converted into headers
-    # required properties have unique/specialized types of the following instead of normal variable types
-    required_edge_properties = {
-        SUBJECT_ID: 'START_ID',
-        PREDICATE: 'TYPE',
-        OBJECT_ID: 'END_ID'
-    }
-    edge_properties = __determine_properties_and_types(edges_input_file, required_edge_properties)
+    edge_properties = __determine_properties_and_types(edges_input_file, REQUIRED_EDGE_PROPERTIES)
     __convert_to_csv(input_file=edges_input_file,
                      output_file=edges_output_file,
                      properties=edge_properties,
@@ -180,39 +317,46 @@ def __verify_conversion(file_path: str,
 def __determine_properties_and_types(file_path: str, required_properties: dict):
     property_type_counts = defaultdict(lambda: defaultdict(int))
     for entity in quick_jsonl_file_iterator(file_path):
-        for key, value in entity.items():
-            if value is None:
-                property_type_counts[key]["None"] += 1
-                if key in required_properties and key != "name":
-                    print(f'WARNING: Required property ({key}) was None: {entity.items()}')
-                    raise Exception(
-                        f'None found as a value for a required property (property: {key}) in line {entity.items()}')
-            elif isinstance(value, bool):
-                property_type_counts[key]["boolean"] += 1
-            elif isinstance(value, int):
-                property_type_counts[key]["int"] += 1
-            elif isinstance(value, float):
-                property_type_counts[key]["float"] += 1
-            elif isinstance(value, list):
-                has_floats = False
-                has_ints = False
-                has_strings = False
-                for item in value:
-                    if isinstance(item, float):
-                        has_floats = True
-                    elif isinstance(item, int):
-                        has_ints = True
-                    else:
-                        has_strings = True
-                if has_strings:
-                    property_type_counts[key]["string[]"] += 1
-                elif has_floats:
-                    property_type_counts[key]["float[]"] += 1
-                elif has_ints:
-                    property_type_counts[key]["int[]"] += 1
-            else:
-                property_type_counts[key]["string"] += 1
+        __count_property_types(entity, property_type_counts, required_properties)
+    return __resolve_property_types(property_type_counts, required_properties)
+
+
+def __count_property_types(entity: dict, property_type_counts: dict, required_properties: dict):
+    for key, value in entity.items():
+        if value is None:
+            property_type_counts[key]["None"] += 1
+            if key in required_properties and key != "name":
+                print(f'WARNING: Required property ({key}) was None: {entity.items()}')
+                raise Exception(
+                    f'None found as a value for a required property (property: {key}) in line {entity.items()}')
+        elif isinstance(value, bool):
+            property_type_counts[key]["boolean"] += 1
+        elif isinstance(value, int):
+            property_type_counts[key]["int"] += 1
+        elif isinstance(value, float):
+            property_type_counts[key]["float"] += 1
+        elif isinstance(value, list):
+            has_floats = False
+            has_ints = False
+            has_strings = False
+            for item in value:
+                if isinstance(item, float):
+                    has_floats = True
+                elif isinstance(item, int):
+                    has_ints = True
+                else:
+                    has_strings = True
+            if has_strings:
+                property_type_counts[key]["string[]"] += 1
+            elif has_floats:
+                property_type_counts[key]["float[]"] += 1
+            elif has_ints:
+                property_type_counts[key]["int[]"] += 1
+        else:
+            property_type_counts[key]["string"] += 1
+
 
+def __resolve_property_types(property_type_counts: dict, required_properties: dict):
     # start with the required_properties dictionary, it has the hard coded unique types for them already
     properties = required_properties.copy()
     properties_to_remove = []
@@ -323,6 +467,179 @@ def __convert_to_csv(input_file: str,
             csv_file_writer.writerow(item)
 
 
+def convert_jsonl_to_neo4j_csv_parts(nodes_input_file: str,
+                                     edges_input_file: str,
+                                     nodes_output_file: str = None,
+                                     edges_output_file: str = None,
+                                     output_delimiter='\t',
+                                     array_delimiter=chr(31),  # chr(31) = U+001F - Unit Separator
+                                     node_property_ignore_list=None,
+                                     edge_property_ignore_list=None,
+                                     workers: int = NEO4J_CSV_CONVERSION_WORKERS):
+    """
+    Convert nodes.jsonl and edges.jsonl into csv files for neo4j-admin import, reading each file only once.
+
+    Each input file is split into byte ranges that are converted by a pool of worker processes, which collect
+    property type statistics while writing rows to csv parts. Once every worker is done, the property types are
+    resolved the same way convert_jsonl_to_neo4j_csv resolves them, and a header file is written for each part.
+    neo4j-admin import accepts multiple header and data file groups per entity type, so the parts are not
+    concatenated. Instead, a manifest listing the groups is written to the output file path, see
+    get_neo4j_import_file_groups. The manifest is written last, so if it exists the conversion completed.
+    """
+    if not nodes_output_file:
+        nodes_output_file = f'{nodes_input_file.rsplit(".")[0]}.csv'
+    if not edges_output_file:
+        edges_output_file = f'{edges_input_file.rsplit(".")[0]}.csv'
+
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as process_pool:
+        __convert_to_csv_parts(input_file=nodes_input_file,
+                               output_file=nodes_output_file,
+                               required_properties=REQUIRED_NODE_PROPERTIES,
+                               output_delimiter=output_delimiter,
+                               array_delimiter=array_delimiter,
+                               property_ignore_list=node_property_ignore_list,
+                               workers=workers,
+                               process_pool=process_pool)
+        __convert_to_csv_parts(input_file=edges_input_file,
+                               output_file=edges_output_file,
+                               required_properties=REQUIRED_EDGE_PROPERTIES,
+                               output_delimiter=output_delimiter,
+                               array_delimiter=array_delimiter,
+                               property_ignore_list=edge_property_ignore_list,
+                               workers=workers,
+                               process_pool=process_pool)
+
+
+def get_neo4j_import_file_groups(csv_file_path: str):
+    """
+    :param csv_file_path: a csv file, or a manifest of csv parts written by convert_jsonl_to_neo4j_csv_parts
+    :return: a list of comma separated file groups (header file, data file), to be used as neo4j-admin import
+    arguments, the paths are relative to the directory of csv_file_path
+    """
+    with open(csv_file_path) as csv_file:
+        if csv_file.readline().rstrip('\n') != NEO4J_CSV_PARTS_MANIFEST_MARKER:
+            return [os.path.basename(csv_file_path)]
+        return [line.rstrip('\n') for line in csv_file if line.strip()]
+
+
+def __convert_to_csv_parts(input_file: str,
+                           output_file: str,
+                           required_properties: dict,
+                           array_delimiter: str,
+                           output_delimiter: str,
+                           property_ignore_list: set,
+                           workers: int,
+                           process_pool):
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    shards = get_byte_range_shards(input_file, workers)
+    shard_arguments = [(input_file, shard_start, shard_end, f'{output_file}.part{shard_number:03d}',
+                        required_properties, property_ignore_list, array_delimiter, output_delimiter)
+                       for shard_number, (shard_start, shard_end) in enumerate(shards)]
+    if process_pool:
+        shard_results = list(process_pool.map(__convert_shard_to_csv, *zip(*shard_arguments)))
+    else:
+        shard_results = [__convert_shard_to_csv(*arguments) for arguments in shard_arguments]
+
+    # combine the property type statistics from every shard and determine the property types
+    property_type_counts = defaultdict(lambda: defaultdict(int))
+    for shard_property_type_counts, shard_parts in shard_results:
+        for prop, type_counts in shard_property_type_counts.items():
+            for prop_type, count in type_counts.items():
+                property_type_counts[prop][prop_type] += count
+    properties = __resolve_property_types(property_type_counts, required_properties)
+
+    # if the input was empty, make an empty part so there's still a header for neo4j
+    if not any(shard_parts for shard_property_type_counts, shard_parts in shard_results):
+        empty_part_file_path = f'{output_file}.part000_0'
+        open(empty_part_file_path, 'w').close()
+        shard_results = [({}, [(empty_part_file_path, list(required_properties))])]
+
+    # write a header for every part, with the columns of that part, and a manifest of all the parts
+    file_groups = []
+    for shard_property_type_counts, shard_parts in shard_results:
+        for part_file_path, part_columns in shard_parts:
+            header_file_path = f'{part_file_path}.header'
+            with open(header_file_path, 'w', newline='') as header_file:
+                csv.writer(header_file, delimiter=output_delimiter, quoting=csv.QUOTE_MINIMAL).writerow(
+                    [f'{prop.removeprefix("biolink:")}:{properties[prop]}' for prop in part_columns])
+            file_groups.append(f'{os.path.basename(header_file_path)},{os.path.basename(part_file_path)}')
+    with open(output_file, 'w') as manifest_file:
+        manifest_file.write(f'{NEO4J_CSV_PARTS_MANIFEST_MARKER}\n')
+        manifest_file.writelines(f'{file_group}\n' for file_group in file_groups)
+
+
+def __convert_shard_to_csv(input_file: str,
+                           shard_start: int,
+                           shard_end: int,
+                           output_file_prefix: str,
+                           required_properties: dict,
+                           property_ignore_list: set,
+                           array_delimiter: str,
+                           output_delimiter: str):
+    """
+    Converts the lines of a byte range of a jsonl file to csv rows, while counting the types of property values.
+    The columns of a part are the properties seen so far, which aren't known in advance, so rows are converted in
+    chunks, and if a chunk has properties that weren't seen before a new part is started with the extra columns.
+    This runs in a worker process.
+
+    :return: a tuple of (property type counts, [(part file path, part columns)])
+    """
+    property_type_counts = defaultdict(lambda: defaultdict(int))
+    parts = []
+    part_columns = []
+    part_file = None
+    csv_writer = None
+    for chunk_of_lines in chunk_iterator(read_byte_range_lines(input_file, shard_start, shard_end),
+                                         NEO4J_CSV_CONVERSION_CHUNK_SIZE):
+        chunk_rows = []
+        chunk_columns = {}
+        for line in chunk_of_lines:
+            item = orjson.loads(line)
+            __count_property_types(item, property_type_counts, required_properties)
+            row = __convert_item_to_csv_row(item, array_delimiter, property_ignore_list)
+            chunk_columns.update(dict.fromkeys(row))
+            chunk_rows.append(row)
+
+        # start a new part if the chunk has columns that the current part doesn't
+        new_columns = [column for column in chunk_columns if column not in part_columns]
+        if new_columns or part_file is None:
+            if part_file:
+                part_file.close()
+            part_columns = part_columns + new_columns
+            part_file_path = f'{output_file_prefix}_{len(parts)}'
+            part_file = open(part_file_path, 'w', newline='')
+            csv_writer = csv.writer(part_file, delimiter=output_delimiter, quoting=csv.QUOTE_MINIMAL)
+            parts.append((part_file_path, part_columns))
+        csv_writer.writerows([row.get(column, '') for column in part_columns] for row in chunk_rows)
+    if part_file:
+        part_file.close()
+    # convert the defaultdicts so they can be returned from a worker process
+    return {prop: dict(type_counts) for prop, type_counts in property_type_counts.items()}, parts
+
+
+def __convert_item_to_csv_row(item: dict, array_delimiter: str, property_ignore_list: set = None):
+    # this mirrors the conversion in __convert_to_csv, but decides on formatting by the value instead of the
+    # property type, which isn't known yet, properties with no values (None or empty lists) are left out
+    row = {}
+    for key, value in item.items():
+        if property_ignore_list and key in property_ignore_list:
+            continue
+        if value is None:
+            if key == "name":
+                row["name"] = item["id"]
+        elif isinstance(value, list):
+            if value:
+                # convert lists into strings with an array delimiter
+                row[key] = array_delimiter.join(str(list_item) for list_item in value)
+        elif isinstance(value, bool):
+            # neo4j handles boolean with string 'true' being true and everything else false
+            row[key] = 'true' if value else 'false'
+        else:
+            row[key] = value
+    return row
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert jsonl kgx files to csv neo4j import files')
     parser.add_argument('nodes', help='file with nodes in jsonl format')
@@ -1,10 +1,12 @@
 import os
-import jsonlines
 from itertools import chain
-from Common.utils import LoggingUtil, quick_jsonl_file_iterator
+from Common.utils import LoggingUtil, quick_jsonl_file_iterator, chunk_iterator, open_kgx_file, \
+    open_kgx_jsonlines, get_kgx_file_compression
 from Common.kgxmodel import GraphSpec, SubGraphSource
 from Common.biolink_constants import SUBJECT_ID, OBJECT_ID
-from Common.merging import GraphMerger, DiskGraphMerger, MemoryGraphMerger
+from Common.merging import GraphMerger, DiskGraphMerger, MemoryGraphMerger, CompactIdIndex, NODE_ENTITY_TYPE, \
+    EDGE_ENTITY_TYPE
+from Common.incremental_merging import SourceContributionIndex
 from Common.load_manager import RESOURCE_HOGS
 
 # import line_profiler
@@ -20,6 +22,15 @@ CONNECTED_EDGE_SUBSET = 'connected_edge_subset'
 DONT_MERGE = 'dont_merge_edges'
 SECONDARY_MERGE_STRATEGIES = [CONNECTED_EDGE_SUBSET]
 
+# if the node or edge files being merged add up to more than this, merge them on disk instead of in memory
+DISK_MERGE_THRESHOLD_BYTES = int(os.environ.get('DISK_MERGE_THRESHOLD_BYTES', 20 * 1024 ** 3))
+
+# compressed input files are assumed to be about this many times smaller than they are uncompressed
+COMPRESSED_FILE_SIZE_RATIO = 5
+
+# the number of edges to check against the primary node id index at once
+CONNECTED_EDGE_CHUNK_SIZE = 100_000
+
 
 class KGXFileMerger:
 
@@ -27,14 +38,19 @@ class KGXFileMerger:
                  graph_spec: GraphSpec,
                  output_directory: str = None,
                  nodes_output_filename: str = None,
-                 edges_output_filename: str = None):
+                 edges_output_filename: str = None,
+                 contribution_index_directory: str = None):
         self.graph_spec = graph_spec
         self.output_directory = output_directory
         self.nodes_output_filename = nodes_output_filename
         self.edges_output_filename = edges_output_filename
         self.merge_metadata = self.init_merge_metadata()
-        self.edge_graph_merger: GraphMerger = self.init_edge_graph_merger()
-        self.node_graph_merger = MemoryGraphMerger()
+        # with a contribution index, primary sources are merged incrementally, reusing the sorted runs of sources
+        # that haven't changed since a previous merge, which requires merging on disk
+        self.contribution_index = SourceContributionIndex(contribution_index_directory) \
+            if contribution_index_directory else None
+        self.edge_graph_merger: GraphMerger = self.init_graph_merger(entity_type='edges')
+        self.node_graph_merger: GraphMerger = self.init_graph_merger(entity_type='nodes')
         # these will be edge files that have a dont_merge merge strategy
         self.unmerged_edge_files = {}
 
@@ -61,7 +77,10 @@ class KGXFileMerger:
                                                      f'{graph_source.merge_strategy}'
                 return
 
-        self.merge_primary_sources(primary_sources)
+        if self.contribution_index:
+            self.merge_primary_sources_incrementally(primary_sources)
+        else:
+            self.merge_primary_sources(primary_sources)
         self.merge_secondary_sources(secondary_sources)
         self.merge_dont_merge_sources(dont_merge_sources)
 
@@ -90,6 +109,11 @@ class KGXFileMerger:
             self.merge_metadata['final_node_count'] += merged_nodes_written
             self.merge_metadata['final_edge_count'] += merged_edges_written + unmerged_edges_written
 
+        if self.contribution_index and 'merge_error' not in self.merge_metadata:
+            # the merge worked, contributions from sources that are no longer in the graph aren't needed anymore
+            self.merge_metadata['incremental_merge']['retracted_sources'] = \
+                self.contribution_index.retract_contributions(primary_sources)
+
     def merge_primary_sources(self,
                               graph_sources: list):
 
@@ -98,13 +122,13 @@ class KGXFileMerger:
             self.merge_metadata["sources"][graph_source.id] = {'release_version': graph_source.version}
 
             for file_path in graph_source.get_node_file_paths():
-                with jsonlines.open(file_path) as nodes:
+                with open_kgx_jsonlines(file_path) as nodes:
                     nodes_count = self.node_graph_merger.merge_nodes(nodes)
                 source_filename = file_path.rsplit('/')[-1]
                 self.merge_metadata["sources"][graph_source.id][source_filename] = {"nodes": nodes_count}
 
             for file_path in graph_source.get_edge_file_paths():
-                with jsonlines.open(file_path) as edges:
+                with open_kgx_jsonlines(file_path) as edges:
                     edges_count = self.edge_graph_merger.merge_edges(
                         edges, additional_edge_attributes=graph_source.edge_merging_attributes,
                         add_edge_id=graph_source.edge_id_addition)
@@ -112,6 +136,34 @@ class KGXFileMerger:
                 self.merge_metadata["sources"][graph_source.id][source_filename] = {"edges": edges_count}
         return True
 
+    def merge_primary_sources_incrementally(self,
+                                            graph_sources: list):
+        reused_sources = []
+        indexed_sources = []
+        for i, graph_source in enumerate(graph_sources, start=1):
+            contribution = self.contribution_index.get_contribution(graph_source)
+            if contribution:
+                logger.info(f"Reusing the indexed contribution of {graph_source.id}. "
+                            f"(primary source {i}/{len(graph_sources)})")
+                reused_sources.append(graph_source.id)
+            else:
+                logger.info(f"Processing {graph_source.id}. (primary source {i}/{len(graph_sources)})")
+                contribution = self.contribution_index.add_contribution(graph_source)
+                indexed_sources.append(graph_source.id)
+            self.merge_metadata["sources"][graph_source.id] = {'release_version': graph_source.version,
+                                                               **contribution['file_counts']}
+            self.node_graph_merger.add_sorted_runs(
+                self.contribution_index.get_run_file_paths(contribution, NODE_ENTITY_TYPE),
+                NODE_ENTITY_TYPE)
+            self.edge_graph_merger.add_sorted_runs(
+                self.contribution_index.get_run_file_paths(contribution, EDGE_ENTITY_TYPE),
+                EDGE_ENTITY_TYPE,
+                additional_edge_attributes=graph_source.edge_merging_attributes,
+                add_edge_id=graph_source.edge_id_addition)
+        self.merge_metadata['incremental_merge'] = {'reused_sources': reused_sources,
+                                                    'indexed_sources': indexed_sources}
+        return True
+
     def merge_secondary_sources(self,
                                 graph_sources: list):
         primary_node_ids = None
@@ -125,26 +177,30 @@ class KGXFileMerger:
                 # For connected_edge_subset, only merge edges that connect to nodes in primary sources.
                 # Here we establish that list once, before any connected_edge_subset sources are merged in, so we don't
                 # include edges from one connected_edge_subset that are only connected to another connected_edge_subset.
-                if not primary_node_ids:
-                    primary_node_ids = set(self.node_graph_merger.nodes.keys())
+                # The ids are kept in a compact index of hashed ids rather than a set, to keep memory usage down.
+                if primary_node_ids is None:
+                    primary_node_ids = CompactIdIndex(self.node_graph_merger.get_node_ids())
 
                 nodes_to_add = set()
                 for edge_file in graph_source.get_edge_file_paths():
                     edge_counter = 0
                     additional_edge_attributes = graph_source.edge_merging_attributes
                     add_edge_id = graph_source.edge_id_addition
-                    for edge in quick_jsonl_file_iterator(edge_file):
-                        edge_subject_connected = edge[SUBJECT_ID] in primary_node_ids
-                        edge_object_connected = edge[OBJECT_ID] in primary_node_ids
-                        if edge_subject_connected or edge_object_connected:
-                            edge_counter += 1
-                            self.edge_graph_merger.merge_edge(edge,
-                                                              additional_edge_attributes=additional_edge_attributes,
-                                                              add_edge_id=add_edge_id)
-                            if not edge_subject_connected:
-                                nodes_to_add.add(edge[SUBJECT_ID])
-                            elif not edge_object_connected:
-                                nodes_to_add.add(edge[OBJECT_ID])
+                    for edges in chunk_iterator(quick_jsonl_file_iterator(edge_file), CONNECTED_EDGE_CHUNK_SIZE):
+                        subjects_connected = primary_node_ids.contains_many([edge[SUBJECT_ID] for edge in edges])
+                        objects_connected = primary_node_ids.contains_many([edge[OBJECT_ID] for edge in edges])
+                        for edge, edge_subject_connected, edge_object_connected in zip(edges,
+                                                                                       subjects_connected,
+                                                                                       objects_connected):
+                            if edge_subject_connected or edge_object_connected:
+                                edge_counter += 1
+                                self.edge_graph_merger.merge_edge(edge,
+                                                                  additional_edge_attributes=additional_edge_attributes,
+                                                                  add_edge_id=add_edge_id)
+                                if not edge_subject_connected:
+                                    nodes_to_add.add(edge[SUBJECT_ID])
+                                elif not edge_object_connected:
+                                    nodes_to_add.add(edge[OBJECT_ID])
                     source_filename = edge_file.rsplit('/')[-1]
                     self.merge_metadata["sources"][graph_source.id][source_filename] = {"edges": edge_counter}
 
@@ -161,7 +217,7 @@ class KGXFileMerger:
         for graph_source in graph_sources:
             # merge in the nodes
             for file_path in graph_source.get_node_file_paths():
-                with jsonlines.open(file_path) as nodes:
+                with open_kgx_jsonlines(file_path) as nodes:
                     nodes_count = self.node_graph_merger.merge_nodes(nodes)
                 source_filename = file_path.rsplit('/')[-1]
                 self.merge_metadata["sources"][graph_source.id][source_filename] = {"nodes": nodes_count}
@@ -180,14 +236,14 @@ class KGXFileMerger:
 
         logger.info(f'Writing merged nodes to file...')
         nodes_written = 0
-        with open(nodes_output_file_path, 'w') as nodes_out:
+        with open_kgx_file(nodes_output_file_path, 'w') as nodes_out:
             for node_line in self.node_graph_merger.get_merged_nodes_jsonl():
                 nodes_out.write(node_line)
                 nodes_written += 1
 
         logger.info(f'Writing merged edges to file...')
         edges_written = 0
-        with open(edges_output_file_path, 'w') as edges_out:
+        with open_kgx_file(edges_output_file_path, 'w') as edges_out:
             for edge_line in self.edge_graph_merger.get_merged_edges_jsonl():
                 edges_out.write(edge_line)
                 edges_written += 1
@@ -197,11 +253,11 @@ class KGXFileMerger:
     def __write_unmerged_edges_to_file(self):
         all_unmerged_edges_count = 0
         edges_output_file_path = os.path.join(self.output_directory, self.edges_output_filename)
-        with open(edges_output_file_path, 'a') as edges_out:
+        with open_kgx_file(edges_output_file_path, 'a') as edges_out:
             for graph_source_id, edges_files in self.unmerged_edge_files.items():
                 for edges_file in edges_files:
                     edges_count = 0
-                    with open(edges_file) as edges:
+                    with open_kgx_file(edges_file) as edges:
                         for edge in edges:
                             edges_out.write(edge)
                             edges_count += 1
@@ -210,8 +266,10 @@ class KGXFileMerger:
                     all_unmerged_edges_count += edges_count
         return all_unmerged_edges_count
 
-    def init_edge_graph_merger(self) -> GraphMerger:
-        needs_on_disk_merge = False
+    def init_graph_merger(self, entity_type: str) -> GraphMerger:
+        # merge on disk if any of the sources are known to be huge, or if the input files are estimated to be too big,
+        # incremental merges are always on disk because they merge the sorted runs of the contribution index
+        needs_on_disk_merge = self.contribution_index is not None
         for graph_source in chain(self.graph_spec.sources, self.graph_spec.subgraphs):
             if isinstance(graph_source, SubGraphSource):
                 for source_id in graph_source.graph_metadata.get_source_ids():
@@ -221,6 +279,11 @@ class KGXFileMerger:
             elif graph_source.id in RESOURCE_HOGS:
                 needs_on_disk_merge = True
                 break
+        if not needs_on_disk_merge:
+            estimated_input_size = self.estimate_input_size(entity_type)
+            if estimated_input_size > DISK_MERGE_THRESHOLD_BYTES:
+                logger.info(f'Input {entity_type} files total {estimated_input_size} bytes, merging them on disk.')
+                needs_on_disk_merge = True
         if needs_on_disk_merge:
             if self.output_directory is None:
                 raise IOError(f'DiskGraphMerger attempted but no output directory was specified.')
@@ -228,6 +291,18 @@ class KGXFileMerger:
         else:
             return MemoryGraphMerger()
 
+    def estimate_input_size(self, entity_type: str):
+        input_size = 0
+        for graph_source in chain(self.graph_spec.sources, self.graph_spec.subgraphs):
+            if graph_source.file_paths is None:
+                continue
+            file_paths = graph_source.get_node_file_paths() if entity_type == 'nodes' \
+                else graph_source.get_edge_file_paths()
+            input_size += sum(os.path.getsize(file_path) *
+                              (COMPRESSED_FILE_SIZE_RATIO if get_kgx_file_compression(file_path) else 1)
+                              for file_path in file_paths if os.path.exists(file_path))
+        return input_size
+
     @staticmethod
     def init_merge_metadata():
         return {'sources': {},
@@ -1,20 +1,36 @@
 import os
 import json
+import orjson
+import shutil
 import jsonlines
 import logging
+import resource
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from Common.biolink_utils import BiolinkInformationResources, INFORES_STATUS_INVALID, INFORES_STATUS_DEPRECATED
 from Common.biolink_constants import SEQUENCE_VARIANT, PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES, \
     PUBLICATIONS, OBJECT_ID, SUBJECT_ID, PREDICATE, SUBCLASS_OF, ORIGINAL_OBJECT, ORIGINAL_SUBJECT
 from Common.normalization import NormalizationScheme, NodeNormalizer, EdgeNormalizer, EdgeNormalizationResult, \
     NormalizationFailedError
-from Common.utils import LoggingUtil, chunk_iterator
-from Common.kgx_file_writer import KGXFileWriter
+from Common.normalization_cache import NodeNormalizationCache, NodeNormalizationLookupStore
+from Common.utils import LoggingUtil, chunk_iterator, open_kgx_file, open_kgx_jsonlines, quick_jsonl_file_iterator, \
+    get_kgx_file_compression, get_byte_range_shards, read_byte_range_lines
+from Common.kgx_file_writer import KGXFileWriter, BufferedJsonlWriter, ConnectedNodeBitmap
 
 
 EDGE_PROPERTIES_THAT_SHOULD_BE_SETS = {AGGREGATOR_KNOWLEDGE_SOURCES, PUBLICATIONS}
 NODE_NORMALIZATION_BATCH_SIZE = 1_000_000
 EDGE_NORMALIZATION_BATCH_SIZE = 1_000_000
 
+# the number of processes used to normalize edges, more than 1 normalizes byte ranges of the edge file in parallel
+EDGE_NORMALIZATION_WORKERS = int(os.environ.get('EDGE_NORMALIZATION_WORKERS', 1))
+
+# the number of edges a parallel edge normalization worker reads and normalizes at once
+EDGE_NORMALIZATION_SHARD_CHUNK_SIZE = 100_000
+
+EDGE_SHARD_COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
 
 #
 # This piece takes KGX-like files and normalizes the nodes and edges for biolink compliance.
@@ -43,7 +59,9 @@ class KGXFileNormalizer:
                  predicates_pre_normalized: bool = False,
                  default_provenance: str = None,
                  process_in_memory: bool = True,
-                 preserve_unconnected_nodes: bool = False):
+                 preserve_unconnected_nodes: bool = False,
+                 use_node_norm_cache: bool = True,
+                 edge_normalization_workers: int = EDGE_NORMALIZATION_WORKERS):
         if not normalization_scheme:
             normalization_scheme = NormalizationScheme()
         self.normalization_scheme = normalization_scheme
@@ -62,8 +80,23 @@ class KGXFileNormalizer:
         self.predicates_pre_normalized = predicates_pre_normalized
         self.sequence_variants_pre_normalized = sequence_variants_pre_normalized
         self.has_sequence_variants = has_sequence_variants
+        # when process_in_memory is False the node normalization lookup is spilled to disk after every batch of nodes,
+        # and the edge pass only loads the part of the lookup needed for the current batch of edges
         self.process_in_memory = process_in_memory
+        self.node_norm_lookup_store = None
         self.preserve_unconnected_nodes = preserve_unconnected_nodes
+        # unless unconnected nodes are preserved, normalized nodes are written to a temporary file and the ones attached
+        # to edges are tracked during the edge pass, then only those are copied to the final nodes file
+        if preserve_unconnected_nodes:
+            self.connected_node_bitmap = None
+            self.normalized_nodes_file_path = nodes_output_file_path
+        else:
+            self.connected_node_bitmap = ConnectedNodeBitmap()
+            # keep the extension at the end of the temp file name, it determines the compression
+            self.normalized_nodes_file_path = os.path.join(os.path.dirname(nodes_output_file_path),
+                                                           f'temp_{os.path.basename(nodes_output_file_path)}')
+        self.use_node_norm_cache = use_node_norm_cache
+        self.edge_normalization_workers = edge_normalization_workers
         self.default_provenance = default_provenance
         self.normalization_metadata = {'strict_normalization': normalization_scheme.strict,
                                        'sequence_variants_pre_normalized': sequence_variants_pre_normalized}
@@ -83,7 +116,9 @@ class KGXFileNormalizer:
         self.normalize_node_file()
         self.normalize_edge_file()
         if not self.preserve_unconnected_nodes:
-            unconnected_nodes_removed = remove_unconnected_nodes(self.nodes_output_file_path, self.edges_output_file_path)
+            unconnected_nodes_removed = write_connected_nodes(self.normalized_nodes_file_path,
+                                                              self.nodes_output_file_path,
+                                                              self.connected_node_bitmap)
             self.normalization_metadata['unconnected_nodes_removed'] = unconnected_nodes_removed
         else:
             self.normalization_metadata['unconnected_nodes_removed'] = 0
@@ -98,6 +133,17 @@ class KGXFileNormalizer:
         node_norm_version = self.node_normalizer.get_current_node_norm_version()
         self.normalization_metadata['regular_node_norm_version'] = node_norm_version
 
+        # set up the persistent node norm cache, results from other sources or previous builds can be reused
+        # as long as they came from the same node norm version with the same conflation setting
+        node_norm_cache = None
+        if self.use_node_norm_cache:
+            try:
+                node_norm_cache = NodeNormalizationCache(node_norm_version=node_norm_version,
+                                                         conflation=self.normalization_scheme.conflation)
+            except (sqlite3.Error, IOError) as e:
+                self.logger.warning(f'Node norm cache could not be opened, continuing without it: {repr(e)}')
+        self.node_normalizer.node_norm_cache = node_norm_cache
+
         regular_nodes_pre_norm = 0
         regular_nodes_post_norm = 0
         variant_nodes_pre_norm = 0
@@ -106,8 +152,9 @@ class KGXFileNormalizer:
 
         self.logger.info(f'Normalizing nodes and writing to file...')
         try:
-            with jsonlines.open(self.source_nodes_file_path) as source_json_reader,\
-                    KGXFileWriter(nodes_output_file_path=self.nodes_output_file_path) as output_file_writer:
+            with open_kgx_jsonlines(self.source_nodes_file_path) as source_json_reader,\
+                    KGXFileWriter(nodes_output_file_path=self.normalized_nodes_file_path,
+                                  connected_node_bitmap=self.connected_node_bitmap) as output_file_writer:
 
                 # iterate through the source file
                 for nodes_subset in chunk_iterator(source_json_reader, NODE_NORMALIZATION_BATCH_SIZE):
@@ -173,6 +220,9 @@ class KGXFileNormalizer:
                         self.logger.debug(f'Writing sequence variant nodes to file...')
                         output_file_writer.write_normalized_nodes(variant_nodes)
 
+                    if not self.process_in_memory:
+                        self.spill_node_norm_lookup()
+
                 # grab the number of repeat writes from the file writer
                 # assuming the input file contained all unique node IDs,
                 # this is the number of nodes that started with different IDs but normalized to the same ID as another node
@@ -184,11 +234,28 @@ class KGXFileNormalizer:
             norm_error_msg = f'Error decoding json from {self.source_nodes_file_path} on line number {e.lineno}: ' \
                              f'{e.line}'
             raise NormalizationFailedError(error_message=norm_error_msg, actual_error=e)
+        finally:
+            if node_norm_cache:
+                self.normalization_metadata.update(node_norm_cache.get_metadata())
+                node_norm_cache.close()
+                self.node_normalizer.node_norm_cache = None
+
+        if not self.process_in_memory:
+            self.spill_node_norm_lookup()
 
         self.logger.debug(f'Writing normalization map to file...')
-        normalization_map_info = {'normalization_map': self.node_normalizer.node_normalization_lookup}
-        with open(self.node_norm_map_file_path, "w") as node_norm_map_file:
-            json.dump(normalization_map_info, node_norm_map_file, indent=4)
+        if self.process_in_memory:
+            normalization_map_info = {'normalization_map': self.node_normalizer.node_normalization_lookup}
+            with open(self.node_norm_map_file_path, "w") as node_norm_map_file:
+                json.dump(normalization_map_info, node_norm_map_file, indent=4)
+        else:
+            # stream the lookup from disk into the file, one compact entry per line
+            with open(self.node_norm_map_file_path, "w") as node_norm_map_file:
+                node_norm_map_file.write('{"normalization_map": {')
+                for i, (original_id, normalized_ids) in enumerate(self.node_norm_lookup_store.items()):
+                    node_norm_map_file.write(f'{"," if i else ""}\n{json.dumps(original_id)}: '
+                                             f'{json.dumps(normalized_ids)}')
+                node_norm_map_file.write('\n}}\n')
 
         # grab the list of node IDs that failed
         regular_node_norm_failures = self.node_normalizer.failed_to_normalize_ids
@@ -215,135 +282,78 @@ class KGXFileNormalizer:
                 'variant_nodes_post_norm': variant_nodes_post_norm
             })
         self.normalization_metadata.update({
+            'node_norm_lookup_in_memory': self.process_in_memory,
+            'node_norm_lookup_size': len(self.node_normalizer.node_normalization_lookup) if self.process_in_memory
+            else len(self.node_norm_lookup_store),
             'all_nodes_post_norm': regular_nodes_post_norm + variant_nodes_post_norm,
             'merged_nodes_post_norm': merged_node_count,
             'final_normalized_nodes': regular_nodes_post_norm + variant_nodes_post_norm - merged_node_count
         })
 
+    # move the current contents of the node normalization lookup to disk and clear it from memory
+    def spill_node_norm_lookup(self):
+        if not self.node_norm_lookup_store:
+            self.node_norm_lookup_store = NodeNormalizationLookupStore(f'{self.node_norm_map_file_path}.lookup.db')
+        self.node_norm_lookup_store.update(self.node_normalizer.node_normalization_lookup)
+        self.node_normalizer.node_normalization_lookup.clear()
+
     # given file paths to the source data edge file and an output file,
     # normalize the predicates and write them to the new file
     # also write a file with the predicates that did not successfully normalize
     def normalize_edge_file(self):
 
-        number_of_source_edges = 0
-        normalized_edge_count = 0
-        edge_splits = 0
-        edges_failed_due_to_nodes = 0
-        edges_failed_due_to_predicates = 0
-        subclass_loops_removed = 0
-
-        node_norm_lookup = self.node_normalizer.node_normalization_lookup
+        node_norm_lookup = self.node_normalizer.node_normalization_lookup if self.process_in_memory else None
         edge_norm_lookup = self.edge_normalizer.edge_normalization_lookup
         edge_norm_failures = set()
-        knowledge_sources = set()
-
+        edge_normalization_pass = EdgeNormalizationPass(node_norm_lookup=node_norm_lookup,
+                                                        edge_norm_lookup=edge_norm_lookup,
+                                                        edge_subject_pre_normalized=self.edge_subject_pre_normalized,
+                                                        edge_object_pre_normalized=self.edge_object_pre_normalized,
+                                                        predicates_pre_normalized=self.predicates_pre_normalized,
+                                                        default_provenance=self.default_provenance,
+                                                        connected_node_bitmap=self.connected_node_bitmap,
+                                                        logger=self.logger)
+
+        # the parallel pass needs the whole node norm lookup in memory, and byte ranges of an uncompressed file
+        run_in_parallel = self.edge_normalization_workers > 1 and self.process_in_memory and \
+            not get_kgx_file_compression(self.source_edges_file_path)
         try:
-            with jsonlines.open(self.source_edges_file_path) as source_json_reader, \
-                    jsonlines.open(self.edges_output_file_path, 'w') as edges_out:
-
-                for edges_subset in chunk_iterator(source_json_reader, EDGE_NORMALIZATION_BATCH_SIZE):
-
-                    number_of_source_edges += len(edges_subset)
-
-                    if not self.predicates_pre_normalized:
-                        current_edge_norm_failures = self.edge_normalizer.normalize_edge_data(edges_subset)
-                        if current_edge_norm_failures:
-                            edge_norm_failures.update(current_edge_norm_failures)
-                            self.logger.error(
-                                f'Edge normalization service failed to return results for {edge_norm_failures}')
-
-                    for edge in edges_subset:
-                        normalized_subject_ids = None
-                        normalized_object_ids = None
-                        try:
-                            if self.edge_subject_pre_normalized:
-                                normalized_subject_ids = [edge[SUBJECT_ID]]
-                            else:
-                                normalized_subject_ids = node_norm_lookup[edge[SUBJECT_ID]]
-                            if self.edge_object_pre_normalized:
-                                normalized_object_ids = [edge[OBJECT_ID]]
-                            else:
-                                normalized_object_ids = node_norm_lookup[edge[OBJECT_ID]]
-                        except KeyError as e:
-                            self.logger.error(f"One of the node IDs from the edge file was missing from the normalizer look up, "
-                                              f"it's probably not in the node file. ({e})")
-                        if not (normalized_subject_ids and normalized_object_ids):
-                            edges_failed_due_to_nodes += 1
-                        else:
-                            if not self.predicates_pre_normalized:
-                                try:
-                                    edge_norm_result: EdgeNormalizationResult = edge_norm_lookup[edge[PREDICATE]]
-                                    # extract the normalization info
-                                    normalized_predicate = edge_norm_result.predicate
-                                    edge_inverted_by_normalization = edge_norm_result.inverted
-                                    normalized_edge_properties = edge_norm_result.properties
-                                except KeyError as e:
-                                    norm_error_msg = f'Edge norm lookup failure - missing {edge[PREDICATE]}!'
-                                    self.logger.error(norm_error_msg)
-                                    raise NormalizationFailedError(error_message=norm_error_msg, actual_error=e)
-                            else:
-                                normalized_predicate = edge[PREDICATE]
-                                edge_inverted_by_normalization = False
-
-                            # a counter for the number of normalized edges coming from a single source edge
-                            # it's only used to determine how many edge splits occurred
-                            edge_count = 0
-
-                            # ensure edge has a primary knowledge source
-                            if PRIMARY_KNOWLEDGE_SOURCE not in edge:
-                                edge[PRIMARY_KNOWLEDGE_SOURCE] = self.default_provenance
-                                knowledge_sources.add(self.default_provenance)
-                            else:
-                                knowledge_sources.add(edge[PRIMARY_KNOWLEDGE_SOURCE])
-                                if AGGREGATOR_KNOWLEDGE_SOURCES in edge:
-                                    for knowledge_source in edge[AGGREGATOR_KNOWLEDGE_SOURCES]:
-                                        knowledge_sources.add(knowledge_source)
-
-                            for norm_subject_id in normalized_subject_ids:
-                                for norm_object_id in normalized_object_ids:
-
-                                    # if it's a subclass_of edge, and it's a self-loop, throw it out
-                                    if normalized_predicate == SUBCLASS_OF and norm_subject_id == norm_object_id:
-                                        subclass_loops_removed += 1
-                                        continue
-
-                                    edge_count += 1
-
-                                    # create a new edge with the normalized values
-                                    # start with the original edge to preserve other properties
-                                    normalized_edge = edge.copy()
-
-                                    # Keep the original subject and object IDs
-                                    normalized_edge[ORIGINAL_SUBJECT] = normalized_edge[SUBJECT_ID]
-                                    normalized_edge[ORIGINAL_OBJECT] = normalized_edge[OBJECT_ID]
-
-                                    normalized_edge[PREDICATE] = normalized_predicate
-
-                                    if normalized_edge_properties:
-                                        normalized_edge.update(normalized_edge_properties)
-
-                                    normalized_edge[SUBJECT_ID] = norm_subject_id
-                                    normalized_edge[OBJECT_ID] = norm_object_id
-
-                                    # if normalization switched the direction of the predicate,
-                                    # invert the entire edge
-                                    if edge_inverted_by_normalization:
-                                        normalized_edge = invert_edge(normalized_edge)
-
-                                    edges_out.write(normalized_edge)
-                                    normalized_edge_count += 1
-
-                            # this counter tracks the number of new edges created from each individual edge in the
-                            # original file this could happen due to rare cases of normalization splits where one
-                            # node normalizes to many
-                            if edge_count > 1:
-                                edge_splits += edge_count - 1
-
-                    self.logger.info(f'Processed {number_of_source_edges} edges so far...')
+            if run_in_parallel:
+                self.normalize_edge_file_in_parallel(edge_normalization_pass, edge_norm_failures)
+            else:
+                with open_kgx_jsonlines(self.source_edges_file_path) as source_json_reader, \
+                        KGXFileWriter(edges_output_file_path=self.edges_output_file_path) as edges_out:
+
+                    for edges_subset in chunk_iterator(source_json_reader, EDGE_NORMALIZATION_BATCH_SIZE):
+
+                        if not self.process_in_memory:
+                            # only load the part of the node normalization lookup needed for this batch of edges
+                            edge_normalization_pass.node_norm_lookup = self.node_norm_lookup_store.get_many(
+                                {node_id for edge in edges_subset for node_id in (
+                                    None if self.edge_subject_pre_normalized else edge.get(SUBJECT_ID),
+                                    None if self.edge_object_pre_normalized else edge.get(OBJECT_ID)) if node_id})
+
+                        if not self.predicates_pre_normalized:
+                            current_edge_norm_failures = self.edge_normalizer.normalize_edge_data(edges_subset)
+                            if current_edge_norm_failures:
+                                edge_norm_failures.update(current_edge_norm_failures)
+                                self.logger.error(
+                                    f'Edge normalization service failed to return results for {edge_norm_failures}')
+
+                        edges_out.write_edges(edge_normalization_pass.normalize_edges(edges_subset))
+                        self.logger.info(f'Processed {edge_normalization_pass.counts["source_edges"]} '
+                                         f'edges so far...')
 
         except OSError as e:
             norm_error_msg = f'Error normalizing edges file {self.source_edges_file_path}'
             raise NormalizationFailedError(error_message=norm_error_msg, actual_error=e)
+        finally:
+            if self.node_norm_lookup_store:
+                self.node_norm_lookup_store.close()
+                self.node_norm_lookup_store = None
+
+        edge_counts = edge_normalization_pass.counts
+        knowledge_sources = edge_normalization_pass.knowledge_sources
 
         bl_inforesources = BiolinkInformationResources()
         deprecated_infores_ids = []
@@ -370,14 +380,16 @@ class KGXFileNormalizer:
 
         self.normalization_metadata.update({
             'edge_norm_version': self.edge_normalizer.edge_norm_version,
-            'source_edges': number_of_source_edges,
-            'edges_failed_due_to_nodes': edges_failed_due_to_nodes,
-            'edges_failed_due_to_predicates': edges_failed_due_to_predicates,
+            'source_edges': edge_counts['source_edges'],
+            'edges_failed_due_to_nodes': edge_counts['edges_failed_due_to_nodes'],
+            'edges_failed_due_to_predicates': edge_counts['edges_failed_due_to_predicates'],
             # these keep track of how many edges merged into another, or split into multiple edges
             # this should be true: source_edges - failures - mergers + splits = edges post norm
-            'edge_splits': edge_splits,
-            'subclass_loops_removed': subclass_loops_removed,
-            'final_normalized_edges': normalized_edge_count
+            'edge_splits': edge_counts['edge_splits'],
+            'subclass_loops_removed': edge_counts['subclass_loops_removed'],
+            'final_normalized_edges': edge_counts['final_normalized_edges'],
+            # ru_maxrss is the peak resident memory of the whole process so far, in kilobytes on linux
+            'peak_memory_usage_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
         })
         if deprecated_infores_ids:
             self.normalization_metadata['deprecated_infores_ids'] = deprecated_infores_ids
@@ -386,6 +398,79 @@ class KGXFileNormalizer:
             self.normalization_metadata['invalid_infores_ids'] = invalid_infores_ids
             self.logger.warning(f'Normalization found invalid infores identifiers: {invalid_infores_ids}')
 
+    # normalize byte range shards of the edge file in worker processes, which are forked after the node normalization
+    # lookup is complete so that they share the lookups copy-on-write, then concatenate the shard outputs in order
+    def normalize_edge_file_in_parallel(self, edge_normalization_pass, edge_norm_failures: set):
+        shards = get_byte_range_shards(self.source_edges_file_path, self.edge_normalization_workers)
+        shard_output_file_paths = [f'{self.edges_output_file_path}.shard{shard_number:03d}'
+                                   for shard_number in range(len(shards))]
+        self.logger.info(f'Normalizing edges in {len(shards)} shards with {self.edge_normalization_workers} '
+                         f'processes...')
+        try:
+            # shards that find predicates missing from the predicate lookup only collect them, once they're all
+            # normalized those shards are normalized again in a second round, with a complete predicate lookup
+            unseen_predicates = self.run_edge_normalization_shards(edge_normalization_pass,
+                                                                   shards,
+                                                                   shard_output_file_paths,
+                                                                   defer_unseen_predicates=True)
+            if unseen_predicates:
+                current_edge_norm_failures = self.edge_normalizer.normalize_edge_data(
+                    [{PREDICATE: predicate} for predicate in set().union(*unseen_predicates.values())])
+                if current_edge_norm_failures:
+                    edge_norm_failures.update(current_edge_norm_failures)
+                    self.logger.error(f'Edge normalization service failed to return results for {edge_norm_failures}')
+                self.logger.info(f'Normalizing edges again in {len(unseen_predicates)} shards with newly normalized '
+                                 f'predicates...')
+                self.run_edge_normalization_shards(edge_normalization_pass,
+                                                   [shards[shard_number] for shard_number in unseen_predicates],
+                                                   [shard_output_file_paths[shard_number]
+                                                    for shard_number in unseen_predicates],
+                                                   defer_unseen_predicates=False)
+
+            with open_kgx_file(self.edges_output_file_path, 'wb') as edges_out:
+                for shard_output_file_path in shard_output_file_paths:
+                    with open(shard_output_file_path, 'rb') as shard_output:
+                        shutil.copyfileobj(shard_output, edges_out, EDGE_SHARD_COPY_BUFFER_SIZE)
+        finally:
+            for shard_output_file_path in shard_output_file_paths:
+                if os.path.exists(shard_output_file_path):
+                    os.remove(shard_output_file_path)
+
+    # run a round of edge normalization shard workers, adding the results of the completed shards to the pass,
+    # returns a dictionary of the index of each shard that was deferred -> the unseen predicates it found
+    def run_edge_normalization_shards(self,
+                                      edge_normalization_pass,
+                                      shards: list,
+                                      shard_output_file_paths: list,
+                                      defer_unseen_predicates: bool):
+        global shared_edge_normalization_pass
+
+        unseen_predicates = {}
+        shared_edge_normalization_pass = edge_normalization_pass
+        try:
+            # a new pool for every round, so the workers are forked with the current lookups
+            with ProcessPoolExecutor(max_workers=self.edge_normalization_workers,
+                                     mp_context=multiprocessing.get_context('fork')) as process_pool:
+                shard_results = process_pool.map(normalize_edge_file_shard,
+                                                 [self.source_edges_file_path] * len(shards),
+                                                 *zip(*shards),
+                                                 shard_output_file_paths,
+                                                 [defer_unseen_predicates] * len(shards))
+                for shard_number, (shard_counts, shard_knowledge_sources, shard_connected_nodes,
+                                   shard_unseen_predicates, shard_error) in enumerate(shard_results):
+                    if shard_error:
+                        raise NormalizationFailedError(error_message=shard_error)
+                    if shard_unseen_predicates:
+                        unseen_predicates[shard_number] = shard_unseen_predicates
+                        continue
+                    edge_normalization_pass.add_results(shard_counts, shard_knowledge_sources)
+                    if shard_connected_nodes is not None:
+                        self.connected_node_bitmap.update(shard_connected_nodes)
+                    self.logger.info(f'Processed {edge_normalization_pass.counts["source_edges"]} edges so far...')
+        finally:
+            shared_edge_normalization_pass = None
+        return unseen_predicates
+
 
 def invert_edge(edge):
     inverted_edge = {}
@@ -399,28 +484,231 @@ def invert_edge(edge):
     return inverted_edge
 
 
+class EdgeNormalizationPass:
+    """
+    Normalizes edges with complete node and predicate normalization lookups, and counts what happened to them.
+    It's used for the single process edge normalization pass, and by every worker process of the parallel one.
+    """
+
+    def __init__(self,
+                 node_norm_lookup: dict,
+                 edge_norm_lookup: dict,
+                 edge_subject_pre_normalized: bool,
+                 edge_object_pre_normalized: bool,
+                 predicates_pre_normalized: bool,
+                 default_provenance: str,
+                 logger,
+                 connected_node_bitmap: ConnectedNodeBitmap = None):
+        self.node_norm_lookup = node_norm_lookup
+        self.edge_norm_lookup = edge_norm_lookup
+        self.edge_subject_pre_normalized = edge_subject_pre_normalized
+        self.edge_object_pre_normalized = edge_object_pre_normalized
+        self.predicates_pre_normalized = predicates_pre_normalized
+        self.default_provenance = default_provenance
+        self.logger = logger
+        # if provided, the nodes of every normalized edge are marked as connected in it
+        self.connected_node_bitmap = connected_node_bitmap
+        self.counts = None
+        self.knowledge_sources = None
+        self.reset_results()
+
+    def reset_results(self):
+        self.counts = {'source_edges': 0,
+                       'edges_failed_due_to_nodes': 0,
+                       'edges_failed_due_to_predicates': 0,
+                       'edge_splits': 0,
+                       'subclass_loops_removed': 0,
+                       'final_normalized_edges': 0}
+        self.knowledge_sources = set()
+
+    def add_results(self, counts: dict, knowledge_sources: set):
+        for count_key, count in counts.items():
+            self.counts[count_key] += count
+        self.knowledge_sources.update(knowledge_sources)
+
+    def normalize_edges(self, edges: list):
+        # yields the normalized edges for a list of edges, the counts are updated once they've all been yielded
+        node_norm_lookup = self.node_norm_lookup
+        edge_norm_lookup = self.edge_norm_lookup
+        knowledge_sources = self.knowledge_sources
+        connected_node_bitmap = self.connected_node_bitmap
+        normalized_edge_properties = None
+        edges_failed_due_to_nodes = 0
+        edge_splits = 0
+        subclass_loops_removed = 0
+        normalized_edge_count = 0
+
+        for edge in edges:
+            normalized_subject_ids = None
+            normalized_object_ids = None
+            try:
+                if self.edge_subject_pre_normalized:
+                    normalized_subject_ids = [edge[SUBJECT_ID]]
+                else:
+                    normalized_subject_ids = node_norm_lookup[edge[SUBJECT_ID]]
+                if self.edge_object_pre_normalized:
+                    normalized_object_ids = [edge[OBJECT_ID]]
+                else:
+                    normalized_object_ids = node_norm_lookup[edge[OBJECT_ID]]
+            except KeyError as e:
+                self.logger.error(f"One of the node IDs from the edge file was missing from the normalizer look up, "
+                                  f"it's probably not in the node file. ({e})")
+            if not (normalized_subject_ids and normalized_object_ids):
+                edges_failed_due_to_nodes += 1
+            else:
+                if not self.predicates_pre_normalized:
+                    try:
+                        edge_norm_result: EdgeNormalizationResult = edge_norm_lookup[edge[PREDICATE]]
+                        # extract the normalization info
+                        normalized_predicate = edge_norm_result.predicate
+                        edge_inverted_by_normalization = edge_norm_result.inverted
+                        normalized_edge_properties = edge_norm_result.properties
+                    except KeyError as e:
+                        norm_error_msg = f'Edge norm lookup failure - missing {edge[PREDICATE]}!'
+                        self.logger.error(norm_error_msg)
+                        raise NormalizationFailedError(error_message=norm_error_msg, actual_error=e)
+                else:
+                    normalized_predicate = edge[PREDICATE]
+                    edge_inverted_by_normalization = False
+
+                # a counter for the number of normalized edges coming from a single source edge
+                # it's only used to determine how many edge splits occurred
+                edge_count = 0
+
+                # ensure edge has a primary knowledge source
+                if PRIMARY_KNOWLEDGE_SOURCE not in edge:
+                    edge[PRIMARY_KNOWLEDGE_SOURCE] = self.default_provenance
+                    knowledge_sources.add(self.default_provenance)
+                else:
+                    knowledge_sources.add(edge[PRIMARY_KNOWLEDGE_SOURCE])
+                    if AGGREGATOR_KNOWLEDGE_SOURCES in edge:
+                        for knowledge_source in edge[AGGREGATOR_KNOWLEDGE_SOURCES]:
+                            knowledge_sources.add(knowledge_source)
+
+                for norm_subject_id in normalized_subject_ids:
+                    for norm_object_id in normalized_object_ids:
+
+                        # if it's a subclass_of edge, and it's a self-loop, throw it out
+                        if normalized_predicate == SUBCLASS_OF and norm_subject_id == norm_object_id:
+                            subclass_loops_removed += 1
+                            continue
+
+                        edge_count += 1
+
+                        # create a new edge with the normalized values
+                        # start with the original edge to preserve other properties
+                        normalized_edge = edge.copy()
+
+                        # Keep the original subject and object IDs
+                        normalized_edge[ORIGINAL_SUBJECT] = normalized_edge[SUBJECT_ID]
+                        normalized_edge[ORIGINAL_OBJECT] = normalized_edge[OBJECT_ID]
+
+                        normalized_edge[PREDICATE] = normalized_predicate
+
+                        if normalized_edge_properties:
+                            normalized_edge.update(normalized_edge_properties)
+
+                        normalized_edge[SUBJECT_ID] = norm_subject_id
+                        normalized_edge[OBJECT_ID] = norm_object_id
+
+                        # if normalization switched the direction of the predicate,
+                        # invert the entire edge
+                        if edge_inverted_by_normalization:
+                            normalized_edge = invert_edge(normalized_edge)
+
+                        if connected_node_bitmap is not None:
+                            connected_node_bitmap.mark_connected(norm_subject_id)
+                            connected_node_bitmap.mark_connected(norm_object_id)
+
+                        normalized_edge_count += 1
+                        yield normalized_edge
+
+                # this counter tracks the number of new edges created from each individual edge in the
+                # original file this could happen due to rare cases of normalization splits where one
+                # node normalizes to many
+                if edge_count > 1:
+                    edge_splits += edge_count - 1
+
+        self.add_results({'source_edges': len(edges),
+                          'edges_failed_due_to_nodes': edges_failed_due_to_nodes,
+                          'edge_splits': edge_splits,
+                          'subclass_loops_removed': subclass_loops_removed,
+                          'final_normalized_edges': normalized_edge_count}, set())
+
+
+# the EdgeNormalizationPass used by parallel edge normalization workers, it's set in the parent process before the
+# workers are forked so they inherit it, and its lookups, without copying or pickling them
+shared_edge_normalization_pass = None
+
+
+def normalize_edge_file_shard(source_edges_file_path: str,
+                              range_start: int,
+                              range_end: int,
+                              shard_output_file_path: str,
+                              defer_unseen_predicates: bool = False):
+    # if defer_unseen_predicates is set and the shard has predicates missing from the predicate lookup, the shard
+    # stops normalizing when it finds the first one and only returns the set of them, it needs to be normalized again
+    edge_normalization_pass = shared_edge_normalization_pass
+    edge_normalization_pass.reset_results()
+    check_predicates = defer_unseen_predicates and not edge_normalization_pass.predicates_pre_normalized
+    edge_norm_lookup = edge_normalization_pass.edge_norm_lookup
+    unseen_predicates = set()
+    try:
+        with KGXFileWriter(edges_output_file_path=shard_output_file_path) as shard_writer:
+            for lines in chunk_iterator(read_byte_range_lines(source_edges_file_path, range_start, range_end),
+                                        EDGE_NORMALIZATION_SHARD_CHUNK_SIZE):
+                edges = [orjson.loads(line) for line in lines]
+                if check_predicates:
+                    unseen_predicates.update(edge[PREDICATE] for edge in edges
+                                             if edge[PREDICATE] not in edge_norm_lookup)
+                if not unseen_predicates:
+                    shard_writer.write_edges(edge_normalization_pass.normalize_edges(edges))
+    except NormalizationFailedError as e:
+        # return the error message instead of raising, NormalizationFailedError can't be sent back to the parent
+        return None, None, None, None, e.error_message
+    if unseen_predicates:
+        return None, None, None, unseen_predicates, None
+    connected_node_bitmap = edge_normalization_pass.connected_node_bitmap
+    return edge_normalization_pass.counts, \
+        edge_normalization_pass.knowledge_sources, \
+        bytes(connected_node_bitmap.bitmap) if connected_node_bitmap is not None else None, \
+        None, \
+        None
+
 """
 Given a nodes file and an edges file, remove all of the nodes from the nodes file that aren't attached to edges.
 """
 def remove_unconnected_nodes(nodes_file_path: str, edges_file_path: str):
-    utilized_nodes = set()
-    with open(edges_file_path) as edges_source:
-        edge_reader = jsonlines.Reader(edges_source)
-        for edge in edge_reader:
-            utilized_nodes.add(edge[OBJECT_ID])
-            utilized_nodes.add(edge[SUBJECT_ID])
-
-    unconnected_nodes_removed = 0
-    temp_nodes_file_name = f'{nodes_file_path}.temp'
+    connected_node_bitmap = ConnectedNodeBitmap()
+    for node in quick_jsonl_file_iterator(nodes_file_path):
+        connected_node_bitmap.add_node(node['id'])
+    for edge in quick_jsonl_file_iterator(edges_file_path):
+        connected_node_bitmap.mark_connected(edge[SUBJECT_ID])
+        connected_node_bitmap.mark_connected(edge[OBJECT_ID])
+
+    # keep the extension at the end of the temp file name, it determines the compression
+    temp_nodes_file_name = os.path.join(os.path.dirname(nodes_file_path), f'temp_{os.path.basename(nodes_file_path)}')
     os.rename(nodes_file_path, temp_nodes_file_name)
-    with open(temp_nodes_file_name) as nodes_source:
-        nodes_reader = jsonlines.Reader(nodes_source)
-        with KGXFileWriter(nodes_output_file_path=nodes_file_path) as kgx_file_writer:
-            for node in nodes_reader:
-                if node['id'] in utilized_nodes:
-                    kgx_file_writer.write_normalized_node(node, uniquify=False)
-                else:
-                    unconnected_nodes_removed += 1
-    os.remove(temp_nodes_file_name)
-    return unconnected_nodes_removed
+    return write_connected_nodes(temp_nodes_file_name, nodes_file_path, connected_node_bitmap)
 
+
+"""
+Copy the lines of a nodes file for the nodes marked as connected in a ConnectedNodeBitmap, which had the nodes added in
+the same order as the file, to the output file, without decoding them. The original nodes file is removed.
+Returns the number of nodes that were left out.
+"""
+def write_connected_nodes(nodes_file_path: str, output_file_path: str, connected_node_bitmap: ConnectedNodeBitmap):
+    unconnected_nodes_removed = len(connected_node_bitmap) - connected_node_bitmap.connected_count()
+    if not unconnected_nodes_removed:
+        os.replace(nodes_file_path, output_file_path)
+        return 0
+    with open_kgx_file(nodes_file_path, 'rb') as nodes_file, \
+            open_kgx_file(output_file_path, 'wb') as output_file:
+        output_writer = BufferedJsonlWriter(output_file)
+        is_connected = connected_node_bitmap.is_connected
+        for position, node_line in enumerate(nodes_file):
+            if is_connected(position):
+                output_writer.write_line(node_line)
+        output_writer.flush()
+    os.remove(nodes_file_path)
+    return unconnected_nodes_removed
@@ -1,12 +1,244 @@
 import os
-import jsonlines
+import json
+import orjson
 import logging
+import sqlite3
+from array import array
+from xxhash import xxh64_intdigest
 
-from Common.utils import LoggingUtil
+from Common.utils import LoggingUtil, open_kgx_file
 from Common.kgxmodel import kgxnode, kgxedge
 from Common.biolink_constants import PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES, \
     SUBJECT_ID, OBJECT_ID, PREDICATE
 
+# serialized lines are collected in a buffer and written to the file once it gets this big
+KGX_FILE_WRITER_BUFFER_SIZE = 4 * 1024 * 1024
+
+ORJSON_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# how KGXFileWriter remembers which nodes were written, to skip writing them again:
+# set - a set of the node ids, the fastest
+# hashed - a compact table of 64 bit hashes of the node ids, a small fraction of the memory of a set but several times
+# slower to add to and check, used by the sources with huge numbers of nodes (see SourceDataLoader.node_dedup_strategy)
+# exact - the hashed table, plus the node ids on disk to tell apart different ids with the same hash
+NODE_DEDUP_STRATEGIES = ('set', 'hashed', 'exact')
+NODE_DEDUP_STRATEGY = os.environ.get('KGX_NODE_DEDUP_STRATEGY', 'set')
+
+# node ids stored for exact checks are held in memory and written to disk in batches of this size
+EXACT_NODE_ID_BATCH_SIZE = 100_000
+
+# the number of bits set in every possible byte, for counting the bits of a bitmap (int.bit_count needs python 3.10)
+BYTE_BIT_COUNTS = bytes(bin(byte).count('1') for byte in range(256))
+
+
+class BufferedJsonlWriter:
+    """
+    Writes json lines to a binary file, serializing with orjson into a reusable buffer that's written in large blocks.
+    """
+
+    def __init__(self, file_handler, buffer_size: int = KGX_FILE_WRITER_BUFFER_SIZE):
+        self.file_handler = file_handler
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    def write(self, item):
+        try:
+            self.buffer += orjson.dumps(item, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # orjson can't handle some things the json module can, like integers bigger than 64 bits
+            self.buffer += f'{json.dumps(item, ensure_ascii=False)}\n'.encode('utf-8')
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_line(self, line: bytes):
+        # write a line that was already serialized
+        self.buffer += line
+        if not line.endswith(b'\n'):
+            self.buffer += b'\n'
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file_handler.write(self.buffer)
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+
+
+class HashedNodeIdSet:
+    """
+    A compact set of node ids, only 64 bit hashes of the ids are kept, in an open addressing hash table backed by an
+    array. Different ids with the same hash would be mistaken for each other, which is extremely unlikely, but if an
+    exact_check_file_path is provided the ids are also stored in a sqlite file there, and checked when hashes match.
+    """
+
+    def __init__(self, exact_check_file_path: str = None, initial_capacity: int = 1 << 16):
+        # 0 marks an empty slot, so hashes of 0 are stored as 1
+        self.table = array('Q', [0]) * initial_capacity
+        self.mask = initial_capacity - 1
+        self.size = 0
+
+        self.exact_check_file_path = exact_check_file_path
+        self.exact_check_connection = None
+        self.pending_node_ids = set()
+        if exact_check_file_path:
+            if os.path.exists(exact_check_file_path):
+                os.remove(exact_check_file_path)
+            self.exact_check_connection = sqlite3.connect(exact_check_file_path)
+            self.exact_check_connection.execute('PRAGMA journal_mode=OFF')
+            self.exact_check_connection.execute('PRAGMA synchronous=OFF')
+            self.exact_check_connection.execute('CREATE TABLE node_ids (node_id TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, node_id: str):
+        if not self.__find_slot(xxh64_intdigest(node_id) or 1)[1]:
+            return False
+        return self.__exactly_contains(node_id) if self.exact_check_connection else True
+
+    def add(self, node_id: str):
+        node_hash = xxh64_intdigest(node_id) or 1
+        slot, found = self.__find_slot(node_hash)
+        if found:
+            if not self.exact_check_connection or self.__exactly_contains(node_id):
+                return
+            # a different id with the same hash, it only needs to be stored on disk
+            self.__store_exact_node_id(node_id)
+            self.size += 1
+            return
+        self.table[slot] = node_hash
+        self.size += 1
+        if self.exact_check_connection:
+            self.__store_exact_node_id(node_id)
+        # keep the table at most half full so that probing stays short
+        if self.size * 2 > len(self.table):
+            self.__resize(len(self.table) * 2)
+
+    def close(self):
+        if self.exact_check_connection:
+            self.exact_check_connection.close()
+            self.exact_check_connection = None
+            os.remove(self.exact_check_file_path)
+
+    def __find_slot(self, node_hash: int):
+        # returns the slot the hash is in or should go in, and whether it was found there
+        table = self.table
+        slot = node_hash & self.mask
+        while True:
+            slot_hash = table[slot]
+            if slot_hash == node_hash:
+                return slot, True
+            if slot_hash == 0:
+                return slot, False
+            slot = (slot + 1) & self.mask
+
+    def __resize(self, capacity: int):
+        old_table = self.table
+        self.table = table = array('Q', [0]) * capacity
+        self.mask = mask = capacity - 1
+        for node_hash in old_table:
+            if node_hash:
+                slot = node_hash & mask
+                while table[slot]:
+                    slot = (slot + 1) & mask
+                table[slot] = node_hash
+
+    def __exactly_contains(self, node_id: str):
+        if node_id in self.pending_node_ids:
+            return True
+        return self.exact_check_connection.execute('SELECT 1 FROM node_ids WHERE node_id = ?',
+                                                   (node_id,)).fetchone() is not None
+
+    def __store_exact_node_id(self, node_id: str):
+        self.pending_node_ids.add(node_id)
+        if len(self.pending_node_ids) >= EXACT_NODE_ID_BATCH_SIZE:
+            with self.exact_check_connection:
+                self.exact_check_connection.executemany('INSERT OR IGNORE INTO node_ids VALUES (?)',
+                                                        ((node_id,) for node_id in self.pending_node_ids))
+            self.pending_node_ids = set()
+
+
+class ConnectedNodeBitmap:
+    """
+    Tracks which of the nodes in a nodes file are attached to edges. Nodes are added in the order they're written,
+    their positions in the file are kept in an open addressing table keyed by 64 bit hashes of their ids, and a bitmap
+    with a bit per position is set when an edge uses a node. A node with the same hash as an earlier node can't be told
+    apart from it, which is extremely unlikely, so it's always considered connected rather than risk losing it.
+    """
+
+    def __init__(self, initial_capacity: int = 1 << 16):
+        # 0 marks an empty slot, so hashes of 0 are stored as 1
+        self.hashes = array('Q', [0]) * initial_capacity
+        self.positions = array('Q', [0]) * initial_capacity
+        self.mask = initial_capacity - 1
+        self.node_count = 0
+        self.bitmap = bytearray()
+
+    def __len__(self):
+        return self.node_count
+
+    def add_node(self, node_id: str):
+        node_hash = xxh64_intdigest(node_id) or 1
+        position = self.node_count
+        self.node_count += 1
+        if not position & 7:
+            self.bitmap.append(0)
+        slot, found = self.__find_slot(node_hash)
+        if found:
+            self.bitmap[position >> 3] |= 1 << (position & 7)
+            return
+        self.hashes[slot] = node_hash
+        self.positions[slot] = position
+        # keep the table at most half full so that probing stays short
+        if self.node_count * 2 > len(self.hashes):
+            self.__resize(len(self.hashes) * 2)
+
+    def mark_connected(self, node_id: str):
+        # ids that weren't added are ignored
+        slot, found = self.__find_slot(xxh64_intdigest(node_id) or 1)
+        if found:
+            position = self.positions[slot]
+            self.bitmap[position >> 3] |= 1 << (position & 7)
+
+    def is_connected(self, position: int):
+        return bool(self.bitmap[position >> 3] & (1 << (position & 7)))
+
+    def connected_count(self):
+        return sum(self.bitmap.translate(BYTE_BIT_COUNTS))
+
+    def update(self, bitmap: bytes):
+        # add the connected nodes from the bitmap of a copy of this, for example one from another process
+        self.bitmap = bytearray((int.from_bytes(self.bitmap, 'little') |
+                                 int.from_bytes(bitmap, 'little')).to_bytes(len(self.bitmap), 'little'))
+
+    def __find_slot(self, node_hash: int):
+        # returns the slot the hash is in or should go in, and whether it was found there
+        hashes = self.hashes
+        slot = node_hash & self.mask
+        while True:
+            slot_hash = hashes[slot]
+            if slot_hash == node_hash:
+                return slot, True
+            if slot_hash == 0:
+                return slot, False
+            slot = (slot + 1) & self.mask
+
+    def __resize(self, capacity: int):
+        old_hashes, old_positions = self.hashes, self.positions
+        self.hashes = hashes = array('Q', [0]) * capacity
+        self.positions = positions = array('Q', [0]) * capacity
+        self.mask = mask = capacity - 1
+        for node_hash, position in zip(old_hashes, old_positions):
+            if node_hash:
+                slot = node_hash & mask
+                while hashes[slot]:
+                    slot = (slot + 1) & mask
+                hashes[slot] = node_hash
+                positions[slot] = position
+
 
 class KGXFileWriter:
 
@@ -18,34 +250,49 @@ class KGXFileWriter:
     constructor
     :param nodes_output_file_path: the file path for the nodes file
     :param edges_output_file_path: the file path for the edes file
+    :param node_dedup_strategy: how written node ids are remembered, one of NODE_DEDUP_STRATEGIES, defaults to
+    NODE_DEDUP_STRATEGY
+    :param connected_node_bitmap: if provided, every node written is added to it, in the order they're written
     """
     def __init__(self,
                  nodes_output_file_path: str = None,
-                 edges_output_file_path: str = None):
+                 edges_output_file_path: str = None,
+                 node_dedup_strategy: str = None,
+                 connected_node_bitmap: ConnectedNodeBitmap = None):
         self.edges_to_write = []
         self.edges_written = 0
 
         # written nodes is a set of node ids used for preventing duplicate node writes
-        self.written_nodes = set()
+        node_dedup_strategy = node_dedup_strategy if node_dedup_strategy else NODE_DEDUP_STRATEGY
+        if node_dedup_strategy not in NODE_DEDUP_STRATEGIES:
+            raise ValueError(f'Unsupported node dedup strategy {node_dedup_strategy}, '
+                             f'options are: {", ".join(NODE_DEDUP_STRATEGIES)}')
+        if node_dedup_strategy == 'set':
+            self.written_nodes = set()
+        elif node_dedup_strategy == 'exact' and nodes_output_file_path:
+            self.written_nodes = HashedNodeIdSet(exact_check_file_path=f'{nodes_output_file_path}.node_ids.db')
+        else:
+            self.written_nodes = HashedNodeIdSet()
         self.nodes_to_write = []
         self.nodes_written = 0
         self.repeat_node_count = 0
+        self.connected_node_bitmap = connected_node_bitmap
 
         self.nodes_output_file_handler = None
         if nodes_output_file_path:
             if os.path.isfile(nodes_output_file_path):
                 # TODO verify - do we really want to overwrite existing files? we could remove them on previous errors instead
                 self.logger.warning(f'KGXFileWriter warning.. file already existed: {nodes_output_file_path}! Overwriting it!')
-            self.nodes_output_file_handler = open(nodes_output_file_path, 'w')
-            self.nodes_jsonl_writer = jsonlines.Writer(self.nodes_output_file_handler)
+            self.nodes_output_file_handler = open_kgx_file(nodes_output_file_path, 'wb')
+            self.nodes_jsonl_writer = BufferedJsonlWriter(self.nodes_output_file_handler)
 
         self.edges_output_file_handler = None
         if edges_output_file_path:
             if os.path.isfile(edges_output_file_path):
                 # TODO verify - do we really want to overwrite existing files? we could remove them on previous errors instead
                 self.logger.warning(f'KGXFileWriter warning.. file already existed: {edges_output_file_path}! Overwriting it!')
-            self.edges_output_file_handler = open(edges_output_file_path, 'w')
-            self.edges_jsonl_writer = jsonlines.Writer(self.edges_output_file_handler)
+            self.edges_output_file_handler = open_kgx_file(edges_output_file_path, 'wb')
+            self.edges_jsonl_writer = BufferedJsonlWriter(self.edges_output_file_handler)
 
     def __enter__(self):
         return self
@@ -54,6 +301,8 @@ class KGXFileWriter:
         self.close()
 
     def close(self):
+        if isinstance(self.written_nodes, HashedNodeIdSet):
+            self.written_nodes.close()
         if self.nodes_output_file_handler:
             self.nodes_jsonl_writer.close()
             self.nodes_output_file_handler.close()
@@ -95,15 +344,36 @@ class KGXFileWriter:
         self.__write_node_to_file(node_json)
 
     def write_normalized_nodes(self, nodes: iter, uniquify: bool = True):
+        self.write_nodes(nodes, uniquify)
+
+    def write_nodes(self, nodes: iter, uniquify: bool = True):
+        """
+        Write many nodes at once. Nodes can be dictionaries, or json lines that were already serialized (bytes),
+        which are written as they are and can't be checked for duplicates.
+        """
+        written_nodes = self.written_nodes
         for node in nodes:
-            self.write_normalized_node(node, uniquify)
+            if isinstance(node, (bytes, bytearray)):
+                if self.connected_node_bitmap is not None:
+                    self.connected_node_bitmap.add_node(orjson.loads(node)['id'])
+                self.nodes_jsonl_writer.write_line(node)
+                self.nodes_written += 1
+                continue
+            if uniquify:
+                if node['id'] in written_nodes:
+                    self.repeat_node_count += 1
+                    continue
+                written_nodes.add(node['id'])
+            self.__write_node_to_file(node)
 
     def __write_node_to_file(self, node):
         try:
             self.nodes_jsonl_writer.write(node)
             self.nodes_written += 1
-        except jsonlines.InvalidLineError as e:
-            self.logger.error(f'KGXFileWriter: Failed to write json data: {e.line}.')
+            if self.connected_node_bitmap is not None:
+                self.connected_node_bitmap.add_node(node['id'])
+        except (TypeError, ValueError) as e:
+            self.logger.error(f'KGXFileWriter: Failed to write json data: {node}.')
             raise e
 
     def write_edge(self,
@@ -147,13 +417,23 @@ class KGXFileWriter:
         self.__write_edge_to_file(edge)
 
     def write_normalized_edges(self, edges: iter):
+        self.write_edges(edges)
+
+    def write_edges(self, edges: iter):
+        """
+        Write many edges at once. Edges can be dictionaries, or json lines that were already serialized (bytes).
+        """
         for edge in edges:
-            self.__write_edge_to_file(edge)
+            if isinstance(edge, (bytes, bytearray)):
+                self.edges_jsonl_writer.write_line(edge)
+                self.edges_written += 1
+            else:
+                self.__write_edge_to_file(edge)
 
     def __write_edge_to_file(self, edge):
         try:
             self.edges_jsonl_writer.write(edge)
             self.edges_written += 1
-        except jsonlines.InvalidLineError as e:
-            self.logger.error(f'KGXFileWriter: Failed to write json data: {e.line}.')
+        except (TypeError, ValueError) as e:
+            self.logger.error(f'KGXFileWriter: Failed to write json data: {edge}.')
             raise e
@@ -3,21 +3,33 @@ import os
 import argparse
 import datetime
 import time
+import threading
 from collections import defaultdict
 
 from Common.data_sources import SourceDataLoaderClassFactory, RESOURCE_HOGS, get_available_data_sources
 from Common.exceptions import DataVersionError
-from Common.utils import LoggingUtil, GetDataPullError
+from Common.utils import LoggingUtil, GetDataPullError, KGX_FILE_COMPRESSION_EXTENSIONS, \
+    add_kgx_file_compression_extension
 from Common.kgx_file_normalizer import KGXFileNormalizer
 from Common.kgx_validation import validate_graph
 from Common.normalization import NormalizationScheme, NodeNormalizer, EdgeNormalizer, NormalizationFailedError
 from Common.metadata import SourceMetadata
+from Common.downloader import read_download_manifest
 from Common.loader_interface import SourceDataBrokenError, SourceDataFailedError
 from Common.supplementation import SequenceVariantSupplementation, SupplementationFailedError
 
 
 SOURCE_DATA_LOADER_CLASSES = SourceDataLoaderClassFactory()
 
+# compression for the kgx files written by source pipelines, gzip or zstd, or None for uncompressed files
+INTERMEDIATE_FILE_COMPRESSION = os.environ.get('ORION_INTERMEDIATE_FILE_COMPRESSION', None)
+
+# latest source versions are kept in this file in ORION_STORAGE, so that builds run shortly after one another, like the
+# ones started by the celery worker, don't have to check every upstream source again
+LATEST_SOURCE_VERSIONS_FILENAME = 'latest_source_versions.json'
+# seconds a latest source version is used from that file before it's checked again, 0 to always check
+LATEST_SOURCE_VERSION_CACHE_TTL = int(os.environ.get('ORION_SOURCE_VERSION_CACHE_TTL', 900))
+
 logger = LoggingUtil.init_logging("ORION.Common.SourceDataManager",
                                   line_format='medium',
                                   log_file_path=os.environ['ORION_LOGS'])
@@ -27,7 +39,9 @@ class SourceDataManager:
 
     def __init__(self,
                  test_mode: bool = False,
-                 fresh_start_mode: bool = False):
+                 fresh_start_mode: bool = False,
+                 intermediate_file_compression: str = INTERMEDIATE_FILE_COMPRESSION,
+                 latest_source_version_cache_ttl: int = LATEST_SOURCE_VERSION_CACHE_TTL):
 
         self.test_mode = test_mode
         if test_mode:
@@ -37,12 +51,24 @@ class SourceDataManager:
         if fresh_start_mode:
             logger.info(f'SourceDataManager running in fresh start mode... previous state and files ignored.')
 
+        if intermediate_file_compression and intermediate_file_compression not in KGX_FILE_COMPRESSION_EXTENSIONS:
+            raise ValueError(f'Unsupported intermediate file compression {intermediate_file_compression}, '
+                             f'options are: {", ".join(KGX_FILE_COMPRESSION_EXTENSIONS)}')
+        self.intermediate_file_compression = intermediate_file_compression
+        if intermediate_file_compression:
+            logger.info(f'SourceDataManager writing {intermediate_file_compression} compressed kgx files.')
+
         # locate and verify the main storage directory
         self.storage_dir = self.init_storage_dir()
 
         # dict of source_id -> latest source version (to prevent double lookups)
         self.latest_source_version_lookup = {}
         self.latest_parsing_version_lookup = {}
+        # latest source versions persisted between runs, not used in test or fresh start mode
+        self.latest_source_version_cache_ttl = latest_source_version_cache_ttl \
+            if not (test_mode or fresh_start_mode) else 0
+        # latest source versions can be retrieved from multiple threads at once, see GraphBuilder
+        self.latest_source_version_cache_lock = threading.Lock()
         # placeholders for lazy loading
         self.latest_node_normalization_version = None
         self.latest_edge_normalization_version = None
@@ -131,6 +157,11 @@ class SourceDataManager:
     def get_latest_source_version(self, source_id: str, retries: int = 0):
         if source_id in self.latest_source_version_lookup:
             return self.latest_source_version_lookup[source_id]
+        cached_source_version = self.get_cached_latest_source_version(source_id)
+        if cached_source_version:
+            logger.info(f"Using recently retrieved latest source version for {source_id}: {cached_source_version}")
+            self.latest_source_version_lookup[source_id] = cached_source_version
+            return cached_source_version
 
         loader = SOURCE_DATA_LOADER_CLASSES[source_id](test_mode=self.test_mode)
         logger.info(f"Retrieving latest source version for {source_id}...")
@@ -138,6 +169,7 @@ class SourceDataManager:
             latest_source_version = loader.get_latest_source_version()
             logger.info(f"Found latest source version for {source_id}: {latest_source_version}")
             self.latest_source_version_lookup[source_id] = latest_source_version
+            self.cache_latest_source_version(source_id, latest_source_version)
             return latest_source_version
         except GetDataPullError as failed_error:
             error_message = f"Error while checking for latest source version for {source_id}: " \
@@ -153,6 +185,39 @@ class SourceDataManager:
             logger.error(error_message)
             raise DataVersionError(error_message=error_message)
 
+    def get_latest_source_versions_file_path(self):
+        return os.path.join(self.storage_dir, LATEST_SOURCE_VERSIONS_FILENAME)
+
+    def load_latest_source_versions_file(self):
+        # source_id -> {'source_version': the latest version, 'retrieved': when it was retrieved (seconds since epoch)}
+        try:
+            with open(self.get_latest_source_versions_file_path()) as versions_file:
+                return json.load(versions_file)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def get_cached_latest_source_version(self, source_id: str):
+        if self.latest_source_version_cache_ttl <= 0:
+            return None
+        cached_version = self.load_latest_source_versions_file().get(source_id, None)
+        if cached_version and time.time() - cached_version['retrieved'] < self.latest_source_version_cache_ttl:
+            return cached_version['source_version']
+        return None
+
+    def cache_latest_source_version(self, source_id: str, source_version: str):
+        if self.latest_source_version_cache_ttl <= 0:
+            return
+        with self.latest_source_version_cache_lock:
+            # other processes could be writing the file too, so read it again right before writing and replace it
+            # in one step, the worst case is that a version gets checked again
+            latest_source_versions = self.load_latest_source_versions_file()
+            latest_source_versions[source_id] = {'source_version': source_version, 'retrieved': time.time()}
+            versions_file_path = self.get_latest_source_versions_file_path()
+            temp_versions_file_path = f'{versions_file_path}.{os.getpid()}.temp'
+            with open(temp_versions_file_path, 'w') as versions_file:
+                json.dump(latest_source_versions, versions_file, indent=4)
+            os.replace(temp_versions_file_path, versions_file_path)
+
     def fetch_source(self, source_id: str, source_version: str='latest', retries: int=0):
 
         logger.debug(f'Fetching source {source_id}...')
@@ -174,6 +239,10 @@ class SourceDataManager:
 
                 logger.info(f'Retrieving source data for {source_id} (version: {source_version})..')
                 loader.get_data()
+                # record the sizes and hashes of the files that were downloaded
+                fetch_files = read_download_manifest(loader.data_path)
+                if fetch_files:
+                    source_metadata.set_fetch_files(fetch_files)
             else:
                 logger.info(f'Source data was already retrieved for {source_id}..')
             source_metadata.set_fetch_status(SourceMetadata.STABLE)
@@ -554,21 +623,23 @@ class SourceDataManager:
 
     def get_source_node_file_path(self, source_id: str, source_version: str, parsing_version: str):
         file_name = f'source_nodes.jsonl'
-        return os.path.join(self.get_versioned_parsing_directory(source_id, source_version, parsing_version), file_name)
+        return self.get_kgx_file_path(self.get_versioned_parsing_directory(source_id, source_version, parsing_version),
+                                      file_name)
 
     def get_source_edge_file_path(self, source_id: str, source_version: str, parsing_version: str):
         file_name = f'source_edges.jsonl'
-        return os.path.join(self.get_versioned_parsing_directory(source_id, source_version, parsing_version), file_name)
+        return self.get_kgx_file_path(self.get_versioned_parsing_directory(source_id, source_version, parsing_version),
+                                      file_name)
 
     def get_versioned_normalization_directory(self, source_id: str, source_version: str, parsing_version: str, normalization_version: str):
         versioned_norm_dir = f'normalized_{normalization_version}/'
         return os.path.join(self.get_versioned_parsing_directory(source_id, source_version, parsing_version), versioned_norm_dir)
 
     def get_normalized_node_file_path(self, source_id: str, source_version: str, parsing_version: str, normalization_version: str):
-        return os.path.join(self.get_versioned_normalization_directory(source_id,
-                                                                       source_version,
-                                                                       parsing_version,
-                                                                       normalization_version), f'normalized_nodes.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_normalization_directory(source_id,
+                                                                                 source_version,
+                                                                                 parsing_version,
+                                                                                 normalization_version), f'normalized_nodes.jsonl')
 
     def get_node_norm_map_file_path(self, source_id: str, source_version: str, parsing_version: str, normalization_version: str):
         return os.path.join(self.get_versioned_normalization_directory(source_id,
@@ -583,10 +654,10 @@ class SourceDataManager:
                                                                        normalization_version), f'norm_node_failures.log')
 
     def get_normalized_edge_file_path(self, source_id: str, source_version: str, parsing_version: str, normalization_version: str):
-        return os.path.join(self.get_versioned_normalization_directory(source_id,
-                                                                       source_version,
-                                                                       parsing_version,
-                                                                       normalization_version), f'normalized_edges.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_normalization_directory(source_id,
+                                                                                 source_version,
+                                                                                 parsing_version,
+                                                                                 normalization_version), f'normalized_edges.jsonl')
 
     def get_edge_norm_predicate_map_file_path(self, source_id: str, source_version: str, parsing_version: str, normalization_version: str):
         return os.path.join(self.get_versioned_normalization_directory(source_id,
@@ -608,19 +679,19 @@ class SourceDataManager:
 
     def get_supplemental_node_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                         normalization_version: str, supplementation_version: str):
-        return os.path.join(self.get_versioned_supplementation_directory(source_id,
-                                                                         source_version,
-                                                                         parsing_version,
-                                                                         normalization_version,
-                                                                         supplementation_version), f'supp_nodes.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_supplementation_directory(source_id,
+                                                                                   source_version,
+                                                                                   parsing_version,
+                                                                                   normalization_version,
+                                                                                   supplementation_version), f'supp_nodes.jsonl')
 
     def get_normalized_supp_node_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                            normalization_version: str, supplementation_version: str):
-        return os.path.join(self.get_versioned_supplementation_directory(source_id,
-                                                                         source_version,
-                                                                         parsing_version,
-                                                                         normalization_version,
-                                                                         supplementation_version), f'supp_norm_nodes.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_supplementation_directory(source_id,
+                                                                                   source_version,
+                                                                                   parsing_version,
+                                                                                   normalization_version,
+                                                                                   supplementation_version), f'supp_norm_nodes.jsonl')
 
     def get_supp_node_norm_map_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                          normalization_version: str, supplementation_version: str):
@@ -640,19 +711,19 @@ class SourceDataManager:
 
     def get_supplemental_edge_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                         normalization_version: str, supplementation_version: str):
-        return os.path.join(self.get_versioned_supplementation_directory(source_id,
-                                                                         source_version,
-                                                                         parsing_version,
-                                                                         normalization_version,
-                                                                         supplementation_version), f'supp_edges.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_supplementation_directory(source_id,
+                                                                                   source_version,
+                                                                                   parsing_version,
+                                                                                   normalization_version,
+                                                                                   supplementation_version), f'supp_edges.jsonl')
 
     def get_normalized_supplemental_edge_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                                    normalization_version: str, supplementation_version: str):
-        return os.path.join(self.get_versioned_supplementation_directory(source_id,
-                                                                         source_version,
-                                                                         parsing_version,
-                                                                         normalization_version,
-                                                                         supplementation_version), f'supp_norm_edges.jsonl')
+        return self.get_kgx_file_path(self.get_versioned_supplementation_directory(source_id,
+                                                                                   source_version,
+                                                                                   parsing_version,
+                                                                                   normalization_version,
+                                                                                   supplementation_version), f'supp_norm_edges.jsonl')
 
     def get_supp_edge_norm_predicate_map_file_path(self, source_id: str, source_version: str, parsing_version: str,
                                                    normalization_version: str, supplementation_version: str):
@@ -685,6 +756,15 @@ class SourceDataManager:
                                                                 supplementation_version))
         return file_paths
 
+    def get_kgx_file_path(self, directory: str, file_name: str):
+        # files from previous runs could have been written with a different compression, if one exists use it
+        file_path = os.path.join(directory, file_name)
+        for compression in [self.intermediate_file_compression, None, *KGX_FILE_COMPRESSION_EXTENSIONS]:
+            existing_file_path = add_kgx_file_compression_extension(file_path, compression)
+            if os.path.exists(existing_file_path):
+                return existing_file_path
+        return add_kgx_file_compression_extension(file_path, self.intermediate_file_compression)
+
     def get_source_version_path(self, source_id: str, source_version: str):
         return os.path.join(self.storage_dir, source_id, source_version)
 
@@ -721,6 +801,10 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Lenient normalization mode will allow nodes that do not normalize to persist '
                              'in the finalized kgx files.')
+    parser.add_argument('-c', '--compression',
+                        choices=list(KGX_FILE_COMPRESSION_EXTENSIONS),
+                        default=INTERMEDIATE_FILE_COMPRESSION,
+                        help='Compress the kgx files written by the pipeline.')
     args = parser.parse_args()
 
     if 'ORION_TEST_MODE' in os.environ:
@@ -731,7 +815,8 @@ if __name__ == '__main__':
     loader_test_mode = args.test_mode or test_mode_from_env
     loader_strict_normalization = (not args.lenient_normalization)
     load_manager = SourceDataManager(test_mode=loader_test_mode,
-                                     fresh_start_mode=args.fresh_start_mode)
+                                     fresh_start_mode=args.fresh_start_mode,
+                                     intermediate_file_compression=args.compression)
     for data_source in args.data_source:
         if data_source not in get_available_data_sources():
             print(f'Data source {data_source} is not valid. '
@@ -27,6 +27,10 @@ class SourceDataLoader:
     license = ""
     attribution = ""
 
+    # how the kgx file writer remembers which nodes were written, one of NODE_DEDUP_STRATEGIES, None for the default,
+    # sources with huge numbers of nodes should use 'hashed' to save memory at some cost in speed
+    node_dedup_strategy = None
+
     def __init__(self, test_mode: bool = False, source_data_dir: str = None):
         """Initialize with the option to run in testing mode."""
         self.test_mode: bool = test_mode
@@ -83,7 +87,8 @@ class SourceDataLoader:
 
             # create a KGX file writer, parsers may use this
             self.output_file_writer = KGXFileWriter(nodes_output_file_path,
-                                                    edges_output_file_path)
+                                                    edges_output_file_path,
+                                                    node_dedup_strategy=self.node_dedup_strategy)
 
             # parse the data
             load_metadata = self.parse_data()
@@ -1,4 +1,6 @@
 import os
+import time
+import neo4j
 import Common.kgx_file_converter as kgx_file_converter
 
 
@@ -9,6 +11,7 @@ def create_memgraph_dump(nodes_filepath: str,
                          graph_version: str = '',
                          node_property_ignore_list: set = None,
                          edge_property_ignore_list: set = None,
+                         batch_size: int = kgx_file_converter.MEMGRAPH_CYPHER_BATCH_SIZE,
                          logger=None):
     output_cypher_file = os.path.join(output_directory, f'memgraph_{graph_id}_{graph_version}.cypher')
     if os.path.exists(output_cypher_file):
@@ -18,11 +21,15 @@ def create_memgraph_dump(nodes_filepath: str,
         if logger:
             logger.info(f'Creating memgraph dump cypher file for {graph_id}({graph_version})...')
         try:
-            kgx_file_converter.convert_jsonl_to_memgraph_cypher(nodes_input_file=nodes_filepath,
-                                                                edges_input_file=edges_filepath,
-                                                                output_cypher_file=output_cypher_file,
-                                                                node_property_ignore_list=node_property_ignore_list,
-                                                                edge_property_ignore_list=edge_property_ignore_list)
+            start_time = time.time()
+            counts = kgx_file_converter.convert_jsonl_to_memgraph_cypher_batched(
+                nodes_input_file=nodes_filepath,
+                edges_input_file=edges_filepath,
+                output_cypher_file=output_cypher_file,
+                node_property_ignore_list=node_property_ignore_list,
+                edge_property_ignore_list=edge_property_ignore_list,
+                batch_size=batch_size)
+            elapsed_time = time.time() - start_time
         except Exception as e:
             if logger:
                 logger.error(f'create_memgraph_dump() failed with exception: {e}')
@@ -30,5 +37,47 @@ def create_memgraph_dump(nodes_filepath: str,
             else:
                 raise e
         if logger:
-            logger.info(f'Memgraph cypher dump file created for {graph_id}({graph_version})...')
+            logger.info(f'Memgraph cypher dump file created for {graph_id}({graph_version}), '
+                        f'{counts["nodes"]} nodes and {counts["edges"]} edges in {counts["statements"]} statements, '
+                        f'{get_throughput(counts, elapsed_time)} entities per second.')
     return True
+
+
+def import_memgraph_cypher_file(cypher_file_path: str,
+                                memgraph_uri: str = None,
+                                memgraph_auth: tuple = None,
+                                logger=None):
+    """
+    Runs a cypher file from create_memgraph_dump against a running Memgraph instance over bolt, one statement at a
+    time, and reports how fast nodes and edges were imported. The dump files have one statement per line.
+
+    :param cypher_file_path: path to the .cypher file
+    :param memgraph_uri: bolt uri of memgraph, defaults to the environment variable MEMGRAPH_URI or bolt://localhost:7687
+    :param memgraph_auth: (username, password) if memgraph requires authentication
+    :param logger: optional logger
+    :return: dict of the number of nodes and edges created, the number of statements run, and the elapsed seconds
+    """
+    memgraph_uri = memgraph_uri if memgraph_uri else os.environ.get('MEMGRAPH_URI', 'bolt://localhost:7687')
+    import_results = {'nodes': 0, 'edges': 0, 'statements': 0}
+    start_time = time.time()
+    with neo4j.GraphDatabase.driver(memgraph_uri, auth=memgraph_auth if memgraph_auth else ("", "")) as driver:
+        with driver.session() as session:
+            with open(cypher_file_path, encoding='utf-8') as cypher_file:
+                for statement in cypher_file:
+                    statement = statement.strip()
+                    if not statement:
+                        continue
+                    counters = session.run(statement.rstrip(';')).consume().counters
+                    import_results['nodes'] += counters.nodes_created
+                    import_results['edges'] += counters.relationships_created
+                    import_results['statements'] += 1
+    import_results['seconds'] = time.time() - start_time
+    if logger:
+        logger.info(f'Imported {cypher_file_path} to memgraph: {import_results["nodes"]} nodes and '
+                    f'{import_results["edges"]} edges in {round(import_results["seconds"], 2)} seconds, '
+                    f'{get_throughput(import_results, import_results["seconds"])} entities per second.')
+    return import_results
+
+
+def get_throughput(counts: dict, elapsed_time: float):
+    return round((counts['nodes'] + counts['edges']) / elapsed_time) if elapsed_time > 0 else 0
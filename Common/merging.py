@@ -1,17 +1,65 @@
 import os
-import jsonlines
+import zlib
+import heapq
+import struct
+import orjson
+import resource
 import secrets
-from xxhash import xxh64_hexdigest
+from functools import partial
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from xxhash import xxh64_hexdigest, xxh64_intdigest
 from Common.biolink_utils import BiolinkUtils
 from Common.biolink_constants import *
 from Common.utils import quick_json_loads, quick_json_dumps, chunk_iterator, LoggingUtil
 
+# zstandard and lz4 are optional, they're only needed to compress disk merging temp files with them
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 NODE_PROPERTIES_THAT_SHOULD_BE_SETS = {SYNONYMS, NODE_TYPES, SYNONYM}
 EDGE_PROPERTIES_THAT_SHOULD_BE_SETS = {AGGREGATOR_KNOWLEDGE_SOURCES, PUBLICATIONS, XREFS}
 
 NODE_ENTITY_TYPE = 'node'
 EDGE_ENTITY_TYPE = 'edge'
 
+# the max number of entities sorted and written to each temp file by DiskGraphMerger
+DISK_MERGE_CHUNK_SIZE = int(os.environ.get('DISK_MERGE_CHUNK_SIZE', 10_000_000))
+
+# the number of worker processes DiskGraphMerger uses to sort and write temp files, 1 means do it on the main process
+DISK_MERGE_WORKERS = int(os.environ.get('DISK_MERGE_WORKERS', 1))
+
+# edge properties with string values that are often repeated across edges, MemoryGraphMerger interns these values
+# (along with qualifier values) instead of storing a copy of them for every edge
+EDGE_PROPERTIES_TO_INTERN = {SUBJECT_ID, PREDICATE, OBJECT_ID, PRIMARY_KNOWLEDGE_SOURCE, KNOWLEDGE_LEVEL, AGENT_TYPE}
+
+# the compression used for blocks of DiskGraphMerger temp files, one of TEMP_FILE_COMPRESSION_CODECS,
+# by default temp files are only compressed when using worker processes
+DISK_MERGE_COMPRESSION = os.environ.get('DISK_MERGE_COMPRESSION', None)
+
+# temp files are sequences of blocks, each block has a header (compression codec, stored size, uncompressed size)
+# followed by the block of records, each record has a header (key size, payload size) followed by the sort key of
+# an entity and the entity itself encoded as json, so the merge can compare keys without decoding entities,
+# sorted runs are kept between builds by SourceContributionIndex so TEMP_FILE_FORMAT_VERSION must change with the format
+TEMP_FILE_FORMAT_VERSION = 2
+TEMP_FILE_BLOCK_HEADER = struct.Struct('<BII')
+TEMP_FILE_RECORD_HEADER = struct.Struct('<II')
+TEMP_FILE_COMPRESSION_CODECS = {None: 0, 'zlib': 1, 'zstd': 2, 'lz4': 3}
+
+# the uncompressed size of temp file blocks, there is one block in memory per file being merged at once
+TEMP_FILE_BLOCK_SIZE = 1024 * 1024
+
+# the max number of sorted temp files to merge at once, more than that are merged in multiple passes,
+# by default stay well under the open file limit of the process
+MAX_MERGE_FAN_IN = min(resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2, 256)
+
 bmt = BiolinkUtils()
 
 logger = LoggingUtil.init_logging("ORION.Common.merging",
@@ -23,15 +71,121 @@ def node_key_function(node):
     return node['id']
 
 
-def edge_key_function(edge, custom_key_attributes=None):
-    qualifiers = [f'{key}{value}' for key, value in edge.items() if bmt.is_qualifier(key)]
-    standard_attributes = (f'{edge[SUBJECT_ID]}{edge[PREDICATE]}{edge[OBJECT_ID]}'
-                           f'{edge.get(PRIMARY_KNOWLEDGE_SOURCE, "")}{"".join(qualifiers)}')
+# edge property name -> whether it's a biolink qualifier, each property name only needs to be resolved once
+qualifier_property_lookup = {}
+
+
+def is_qualifier_property(property_name):
+    is_qualifier = qualifier_property_lookup.get(property_name)
+    if is_qualifier is None:
+        is_qualifier = qualifier_property_lookup[property_name] = bmt.is_qualifier(property_name)
+    return is_qualifier
+
+
+def get_edge_key_bytes(edge, custom_key_attributes=None):
+    # the key is made from subject, predicate, object, primary knowledge source, and any qualifiers (name and value),
+    # followed by the values of any custom key attributes, all concatenated in that order
+    key_parts = [str(edge[SUBJECT_ID]),
+                 str(edge[PREDICATE]),
+                 str(edge[OBJECT_ID]),
+                 str(edge.get(PRIMARY_KNOWLEDGE_SOURCE, ""))]
+    for key, value in edge.items():
+        if is_qualifier_property(key):
+            key_parts.append(key)
+            key_parts.append(str(value))
     if custom_key_attributes:
-        custom_attributes = [edge[attr] if attr in edge else '' for attr in custom_key_attributes]
-        return xxh64_hexdigest(f'{standard_attributes}{"".join(custom_attributes)}')
-    else:
-        return xxh64_hexdigest(standard_attributes)
+        key_parts.extend([edge[attr] if attr in edge else '' for attr in custom_key_attributes])
+    return "".join(key_parts).encode('utf-8')
+
+
+def edge_key_function(edge, custom_key_attributes=None):
+    return xxh64_hexdigest(get_edge_key_bytes(edge, custom_key_attributes=custom_key_attributes))
+
+
+def edge_int_key_function(edge, custom_key_attributes=None):
+    # the same hash as edge_key_function as a 64 bit integer, format it with :016x to get the edge_key_function value
+    return xxh64_intdigest(get_edge_key_bytes(edge, custom_key_attributes=custom_key_attributes))
+
+
+def compress_temp_file_block(block, codec):
+    if codec == TEMP_FILE_COMPRESSION_CODECS['zlib']:
+        return zlib.compress(block, 1)
+    elif codec == TEMP_FILE_COMPRESSION_CODECS['zstd']:
+        return zstandard.ZstdCompressor(level=1).compress(block)
+    elif codec == TEMP_FILE_COMPRESSION_CODECS['lz4']:
+        return lz4.frame.compress(block)
+    return block
+
+
+def decompress_temp_file_block(block, codec):
+    if codec == TEMP_FILE_COMPRESSION_CODECS['zlib']:
+        return zlib.decompress(block)
+    elif codec == TEMP_FILE_COMPRESSION_CODECS['zstd']:
+        return zstandard.ZstdDecompressor().decompress(block)
+    elif codec == TEMP_FILE_COMPRESSION_CODECS['lz4']:
+        return lz4.frame.decompress(block)
+    return block
+
+
+class TempFileWriter:
+    """
+    Writes (key, json payload) records to a DiskGraphMerger temp file, in blocks that are optionally compressed.
+    """
+
+    def __init__(self, file_path: str, compression: str = None):
+        self.codec = TEMP_FILE_COMPRESSION_CODECS[compression]
+        self.temp_file = open(file_path, 'wb')
+        self.block = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_record(self, key: bytes, payload: bytes):
+        self.block += TEMP_FILE_RECORD_HEADER.pack(len(key), len(payload))
+        self.block += key
+        self.block += payload
+        if len(self.block) >= TEMP_FILE_BLOCK_SIZE:
+            self.write_block()
+
+    def write_block(self):
+        stored_block = compress_temp_file_block(self.block, self.codec)
+        self.temp_file.write(TEMP_FILE_BLOCK_HEADER.pack(self.codec, len(stored_block), len(self.block)))
+        self.temp_file.write(stored_block)
+        self.block = bytearray()
+
+    def close(self):
+        if self.block:
+            self.write_block()
+        self.temp_file.close()
+
+
+def read_temp_file(file_path):
+    # yields (key, json payload) for every record in a temp file
+    with open(file_path, 'rb') as temp_file:
+        while block_header := temp_file.read(TEMP_FILE_BLOCK_HEADER.size):
+            codec, stored_size, block_size = TEMP_FILE_BLOCK_HEADER.unpack(block_header)
+            block = decompress_temp_file_block(temp_file.read(stored_size), codec)
+            offset = 0
+            while offset < block_size:
+                key_size, payload_size = TEMP_FILE_RECORD_HEADER.unpack_from(block, offset)
+                offset += TEMP_FILE_RECORD_HEADER.size
+                key = block[offset:offset + key_size]
+                offset += key_size
+                yield key, block[offset:offset + payload_size]
+                offset += payload_size
+
+
+def write_sorted_run(entities, entity_sorting_function, temp_file_path, compression=None):
+    # sort a chunk of entities and write them to a temp file, this may run in a worker process,
+    # keys are compared as utf-8 bytes during the merge, which sorts the same way as the strings do
+    keyed_entities = [(entity_sorting_function(entity), entity) for entity in entities]
+    keyed_entities.sort(key=itemgetter(0))
+    with TempFileWriter(temp_file_path, compression=compression) as temp_file_writer:
+        for key, entity in keyed_entities:
+            temp_file_writer.write_record(key.encode('utf-8'), orjson.dumps(entity))
 
 
 def entity_merging_function(entity_1, entity_2, properties_that_are_sets):
@@ -66,6 +220,39 @@ def entity_merging_function(entity_1, entity_2, properties_that_are_sets):
     return entity_1
 
 
+class CompactIdIndex:
+    """
+    A set-like index of ids for fast membership tests, stored as a sorted numpy array of 64 bit hashes of the ids.
+    That's 8 bytes per id instead of a python set of strings. Membership is tested by hash, so a lookup for an id that
+    isn't in the index is a false positive with a chance of about len(index) / 2^64, which is negligible.
+    """
+
+    def __init__(self, ids):
+        id_hashes = np.fromiter((xxh64_intdigest(identifier.encode('utf-8')) for identifier in ids), dtype=np.uint64)
+        # np.unique sorts and removes duplicates
+        self.id_hashes = np.unique(id_hashes)
+
+    def __len__(self):
+        return len(self.id_hashes)
+
+    def __contains__(self, identifier):
+        return self.contains_many([identifier])[0]
+
+    def contains_many(self, ids: list) -> list:
+        """
+        :param ids: a list of ids to look up
+        :return: a list of booleans, True for the ids that are in the index
+        """
+        if not len(self.id_hashes):
+            return [False] * len(ids)
+        lookup_hashes = np.fromiter((xxh64_intdigest(identifier.encode('utf-8')) for identifier in ids),
+                                    dtype=np.uint64, count=len(ids))
+        positions = np.searchsorted(self.id_hashes, lookup_hashes)
+        # ids that would be inserted at the end of the array are not in it, clip so the comparison below is valid
+        positions[positions == len(self.id_hashes)] = 0
+        return (self.id_hashes[positions] == lookup_hashes).tolist()
+
+
 class GraphMerger:
 
     def __init__(self):
@@ -87,6 +274,10 @@ class GraphMerger:
     def flush(self):
         pass
 
+    def get_node_ids(self):
+        # an iterable of the ids of the nodes merged so far, possibly with duplicates
+        raise NotImplementedError
+
     def get_merged_nodes_jsonl(self):
         raise NotImplementedError
 
@@ -96,11 +287,34 @@ class GraphMerger:
 
 class DiskGraphMerger(GraphMerger):
 
-    def __init__(self, temp_directory: str = None, chunk_size: int = 10_000_000):
+    def __init__(self,
+                 temp_directory: str = None,
+                 chunk_size: int = DISK_MERGE_CHUNK_SIZE,
+                 max_merge_fan_in: int = MAX_MERGE_FAN_IN,
+                 workers: int = DISK_MERGE_WORKERS,
+                 temp_file_compression: str = DISK_MERGE_COMPRESSION):
 
         super().__init__()
 
         self.chunk_size = chunk_size
+        self.max_merge_fan_in = max(max_merge_fan_in, 2)
+
+        # with more than one worker, chunks are sorted and written by a process pool while the main process keeps
+        # reading input, at most one chunk per worker is waiting or in progress at a time, so peak memory is roughly
+        # proportional to chunk_size * workers
+        self.workers = workers
+        self.process_pool = None
+        self.pending_sorted_runs = set()
+        # by default compress temp files when using workers, they have cpu to spare for it
+        if temp_file_compression is None and workers > 1:
+            temp_file_compression = 'zstd' if zstandard is not None else 'zlib'
+        if temp_file_compression not in TEMP_FILE_COMPRESSION_CODECS:
+            raise ValueError(f'Unsupported temp file compression: {temp_file_compression}, '
+                             f'use one of {[codec for codec in TEMP_FILE_COMPRESSION_CODECS if codec]}')
+        if (temp_file_compression == 'zstd' and zstandard is None) or (temp_file_compression == 'lz4' and lz4 is None):
+            raise ImportError(f'Temp file compression {temp_file_compression} requires a package that is not '
+                              f'installed ({"zstandard" if temp_file_compression == "zstd" else "lz4"}).')
+        self.temp_file_compression = temp_file_compression
         self.probably_unique_temp_file_key = secrets.token_hex(6)
 
         self.additional_edge_attributes = None
@@ -113,6 +327,8 @@ class DiskGraphMerger(GraphMerger):
         self.current_edge_chunk = 0
 
         self.temp_directory = temp_directory
+        # sorted files added with add_sorted_runs, they're merged like the temp files but never removed
+        self.persistent_file_paths = set()
         self.temp_file_paths = {
             NODE_ENTITY_TYPE: [],
             EDGE_ENTITY_TYPE: []
@@ -141,7 +357,7 @@ class DiskGraphMerger(GraphMerger):
         logger.info(f'additional_edge_attributes: {additional_edge_attributes}, add_edge_id: {add_edge_id}')
         self.additional_edge_attributes = additional_edge_attributes
         self.add_edge_id = add_edge_id
-        sorting_function = lambda edge: edge_key_function(edge, custom_key_attributes=additional_edge_attributes)
+        sorting_function = partial(edge_key_function, custom_key_attributes=additional_edge_attributes)
         return self.merge_entities(edges,
                                    EDGE_ENTITY_TYPE,
                                    sorting_function)
@@ -171,22 +387,77 @@ class DiskGraphMerger(GraphMerger):
                                 entities,
                                 entity_sorting_function,
                                 entity_type):
-        entities.sort(key=entity_sorting_function)
-        temp_file_name = f'{entity_type}_{secrets.token_hex(6)}.temp'
-        temp_file_path = os.path.join(self.temp_directory, temp_file_name)
-        with jsonlines.open(temp_file_path, 'w', compact=True) as jsonl_writer:
-            jsonl_writer.write_all(entities)
+        temp_file_path = self.get_new_temp_file_path(entity_type)
+        # the temp file paths are recorded in the order the chunks were read, merging depends on that order
         self.temp_file_paths[entity_type].append(temp_file_path)
+        if self.workers <= 1:
+            write_sorted_run(entities, entity_sorting_function, temp_file_path, self.temp_file_compression)
+            return
+
+        if self.process_pool is None:
+            self.process_pool = ProcessPoolExecutor(max_workers=self.workers)
+        if len(self.pending_sorted_runs) >= self.workers:
+            finished_sorted_runs, self.pending_sorted_runs = wait(self.pending_sorted_runs,
+                                                                  return_when=FIRST_COMPLETED)
+            for finished_sorted_run in finished_sorted_runs:
+                # this raises any exception from the worker
+                finished_sorted_run.result()
+        self.pending_sorted_runs.add(self.process_pool.submit(write_sorted_run,
+                                                              entities,
+                                                              entity_sorting_function,
+                                                              temp_file_path,
+                                                              self.temp_file_compression))
+
+    def add_sorted_runs(self, file_paths, entity_type, additional_edge_attributes=None, add_edge_id=False):
+        """
+        Add sorted files that were written elsewhere, like with write_sorted_run, to be merged after what was merged
+        so far. Edge files must be sorted by the edge key with the same additional_edge_attributes. These files are
+        only read, they're not removed after merging like the temp files.
+        """
+        if entity_type == NODE_ENTITY_TYPE:
+            self.flush_node_buffer()
+        else:
+            # buffered edges need to be sorted with the attributes they were merged with, before those change
+            self.flush_edge_buffer()
+            self.additional_edge_attributes = additional_edge_attributes
+            self.add_edge_id = add_edge_id
+        self.temp_file_paths[entity_type].extend(file_paths)
+        self.persistent_file_paths.update(file_paths)
+
+    def remove_temp_file(self, file_path):
+        if file_path not in self.persistent_file_paths:
+            os.remove(file_path)
+
+    def get_node_ids(self):
+        self.flush_node_buffer()
+        self.wait_for_sorted_runs()
+        for file_path in self.temp_file_paths[NODE_ENTITY_TYPE]:
+            for key, payload in read_temp_file(file_path):
+                yield str(key, encoding='utf-8')
+
+    def wait_for_sorted_runs(self):
+        for pending_sorted_run in self.pending_sorted_runs:
+            pending_sorted_run.result()
+        self.pending_sorted_runs = set()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+
+    def get_new_temp_file_path(self, entity_type):
+        temp_file_name = f'{entity_type}_{secrets.token_hex(6)}.temp'
+        return os.path.join(self.temp_directory, temp_file_name)
 
     def get_merged_nodes_jsonl(self):
         self.flush_node_buffer()
-        for node in self.get_merged_entities(file_paths=self.temp_file_paths[NODE_ENTITY_TYPE],
-                                             sorting_key_function=node_key_function,
-                                             merge_function=entity_merging_function,
-                                             entity_type=NODE_ENTITY_TYPE):
-            yield f'{quick_json_dumps(node)}\n'
+        self.wait_for_sorted_runs()
+        self.temp_file_paths[NODE_ENTITY_TYPE] = self.reduce_sorted_runs(self.temp_file_paths[NODE_ENTITY_TYPE],
+                                                                         entity_type=NODE_ENTITY_TYPE)
+        for node_json in self.get_merged_entities(file_paths=self.temp_file_paths[NODE_ENTITY_TYPE],
+                                                  merge_function=entity_merging_function,
+                                                  entity_type=NODE_ENTITY_TYPE):
+            yield f'{str(node_json, encoding="utf-8")}\n'
         for file_path in self.temp_file_paths[NODE_ENTITY_TYPE]:
-            os.remove(file_path)
+            self.remove_temp_file(file_path)
 
     def flush_node_buffer(self):
         if not self.entity_buffers[NODE_ENTITY_TYPE]:
@@ -198,76 +469,121 @@ class DiskGraphMerger(GraphMerger):
 
     def get_merged_edges_jsonl(self):
         self.flush_edge_buffer()
-        sorting_function = lambda e: edge_key_function(e, custom_key_attributes=self.additional_edge_attributes)
-        for edge in self.get_merged_entities(file_paths=self.temp_file_paths[EDGE_ENTITY_TYPE],
-                                             sorting_key_function=sorting_function,
-                                             merge_function=entity_merging_function,
-                                             entity_type=EDGE_ENTITY_TYPE,
-                                             add_edge_id=self.add_edge_id):
-            yield f'{quick_json_dumps(edge)}\n'
+        self.wait_for_sorted_runs()
+        self.temp_file_paths[EDGE_ENTITY_TYPE] = self.reduce_sorted_runs(self.temp_file_paths[EDGE_ENTITY_TYPE],
+                                                                         entity_type=EDGE_ENTITY_TYPE)
+        for edge_json in self.get_merged_entities(file_paths=self.temp_file_paths[EDGE_ENTITY_TYPE],
+                                                  merge_function=entity_merging_function,
+                                                  entity_type=EDGE_ENTITY_TYPE,
+                                                  add_edge_id=self.add_edge_id):
+            yield f'{str(edge_json, encoding="utf-8")}\n'
         for file_path in self.temp_file_paths[EDGE_ENTITY_TYPE]:
-            os.remove(file_path)
+            self.remove_temp_file(file_path)
 
     def flush_edge_buffer(self):
         if not self.entity_buffers[EDGE_ENTITY_TYPE]:
             return
+        # the buffer must be sorted with the same key used for merging, including any custom key attributes
+        sorting_function = partial(edge_key_function, custom_key_attributes=self.additional_edge_attributes)
         self.sort_and_write_entities(self.entity_buffers[EDGE_ENTITY_TYPE],
-                                     edge_key_function,
+                                     sorting_function,
                                      EDGE_ENTITY_TYPE)
         self.entity_buffers[EDGE_ENTITY_TYPE] = []
 
+    @staticmethod
+    def merge_sorted_runs(file_paths):
+        # a heap based k-way merge of the sorted temp files, heapq.merge is stable, so entities with the same key
+        # come out in the order of the files they came from, and in their original order within each file
+        return heapq.merge(*[read_temp_file(file_path) for file_path in file_paths], key=itemgetter(0))
+
+    def reduce_sorted_runs(self, file_paths, entity_type):
+        """
+        If there are more sorted temp files than can be merged at once, merge consecutive groups of them into larger
+        sorted temp files, in as many passes as needed. Entities are not merged with each other here, and the groups
+        preserve the file order, so the final merge produces exactly the same results as merging all the files at once.
+
+        :return: the list of sorted temp file paths to use for the final merge
+        """
+        merge_pass = 0
+        while len(file_paths) > self.max_merge_fan_in:
+            merge_pass += 1
+            logger.info(f'Merging {len(file_paths)} sorted {entity_type} files in groups of '
+                        f'{self.max_merge_fan_in} (pass {merge_pass})...')
+            reduced_file_paths = []
+            for group_start in range(0, len(file_paths), self.max_merge_fan_in):
+                group_file_paths = file_paths[group_start:group_start + self.max_merge_fan_in]
+                if len(group_file_paths) == 1:
+                    reduced_file_paths.append(group_file_paths[0])
+                    continue
+                temp_file_path = self.get_new_temp_file_path(entity_type)
+                with TempFileWriter(temp_file_path, compression=self.temp_file_compression) as temp_file_writer:
+                    for key, payload in self.merge_sorted_runs(group_file_paths):
+                        temp_file_writer.write_record(key, payload)
+                for file_path in group_file_paths:
+                    self.remove_temp_file(file_path)
+                reduced_file_paths.append(temp_file_path)
+            file_paths = reduced_file_paths
+        return file_paths
+
     def get_merged_entities(self,
                             file_paths,
-                            sorting_key_function,
                             merge_function,
                             entity_type,
                             add_edge_id=False):
+        """
+        Merges the sorted temp files, merging entities with the same key.
 
+        :return: a generator of merged entities as json (bytes), entities that don't need to be merged or modified
+        are passed through without being decoded
+        """
         if not file_paths:
             logger.error('get_merged_entities called but no file_paths were provided! Empty source?')
             return
 
-        file_handlers = [open(file_path) for file_path in file_paths]
-        json_readers = {i: jsonlines.Reader(file_handler) for i, file_handler in enumerate(file_handlers)}
-
-        first_lines = {i: json_reader.read() for i, json_reader in json_readers.items()}
-        next_entities = {i: (sorting_key_function(value), value) for i, value in first_lines.items()}
-
-        min_key = min([key for key, entity in next_entities.values()], default=None)
-        while min_key is not None:
-            merged_entity = None
-            for i in list(next_entities.keys()):
-                next_key, next_entity = next_entities[i]
-                while next_key == min_key:
-                    if merged_entity:
-                        if entity_type == NODE_ENTITY_TYPE:
-                            merged_entity = merge_function(merged_entity, next_entity, NODE_PROPERTIES_THAT_SHOULD_BE_SETS)
-                            self.merged_node_counter += 1
-                        else:
-                            merged_entity = merge_function(merged_entity, next_entity, EDGE_PROPERTIES_THAT_SHOULD_BE_SETS)
-                            self.merged_edge_counter += 1
-                    else:
-                        merged_entity = next_entity
-                    try:
-                        next_entity = json_readers[i].read()
-                        next_key = sorting_key_function(next_entity)
-                        next_entities[i] = next_key, next_entity
-                    except EOFError:
-                        next_key, next_entity = None, None
-                        del(next_entities[i])
-                        json_readers[i].close()
-                        file_handlers[i].close()
-
-            # Add the id attribute if add_edge_id is True
-            if entity_type == EDGE_ENTITY_TYPE and add_edge_id and merged_entity and min_key:
-                merged_entity["id"] = min_key
-
-            yield merged_entity
-            min_key = min([key for key, entity in next_entities.values()], default=None)
+        if entity_type == NODE_ENTITY_TYPE:
+            properties_that_are_sets = NODE_PROPERTIES_THAT_SHOULD_BE_SETS
+        else:
+            properties_that_are_sets = EDGE_PROPERTIES_THAT_SHOULD_BE_SETS
+        add_edge_id = entity_type == EDGE_ENTITY_TYPE and add_edge_id
+
+        merged_key = None
+        merged_payload = None
+        merged_entity = None
+        merge_counter = 0
+        for key, payload in self.merge_sorted_runs(file_paths):
+            if merged_payload is not None and key == merged_key:
+                if merged_entity is None:
+                    merged_entity = orjson.loads(merged_payload)
+                merged_entity = merge_function(merged_entity, orjson.loads(payload), properties_that_are_sets)
+                merge_counter += 1
+            else:
+                if merged_payload is not None:
+                    yield self.finalize_merged_entity(merged_key, merged_payload, merged_entity, add_edge_id)
+                merged_key = key
+                merged_payload = payload
+                merged_entity = None
+        if merged_payload is not None:
+            yield self.finalize_merged_entity(merged_key, merged_payload, merged_entity, add_edge_id)
+
+        if entity_type == NODE_ENTITY_TYPE:
+            self.merged_node_counter += merge_counter
+        else:
+            self.merged_edge_counter += merge_counter
+
+    @staticmethod
+    def finalize_merged_entity(key, payload, entity, add_edge_id):
+        # Add the id attribute if add_edge_id is True
+        if add_edge_id and key:
+            if entity is None:
+                entity = orjson.loads(payload)
+            entity["id"] = str(key, encoding='utf-8')
+        # if the entity was never decoded the original json can be used as is
+        return orjson.dumps(entity) if entity is not None else payload
 
     def flush(self):
         self.flush_node_buffer()
         self.flush_edge_buffer()
+        self.wait_for_sorted_runs()
 
 
 class MemoryGraphMerger(GraphMerger):
@@ -275,7 +591,10 @@ class MemoryGraphMerger(GraphMerger):
     def __init__(self):
         super().__init__()
         self.nodes = {}
+        # edges are stored in a compact form keyed by 64 bit integer edge keys, see compact_edge
         self.edges = {}
+        self.interned_strings = {}
+        self.edge_layouts = {}
 
     # merge a list of nodes (dictionaries not kgxnode objects!) into the existing set
     def merge_nodes(self, nodes):
@@ -297,6 +616,9 @@ class MemoryGraphMerger(GraphMerger):
         else:
             self.nodes[node_key] = node
 
+    def get_node_ids(self):
+        return self.nodes.keys()
+
     # merge a list of edges (dictionaries not kgxedge objects!) into the existing list
     def merge_edges(self, edges, additional_edge_attributes=None, add_edge_id=False):
         edge_count = 0
@@ -306,24 +628,54 @@ class MemoryGraphMerger(GraphMerger):
         return edge_count
 
     def merge_edge(self, edge, additional_edge_attributes=None, add_edge_id=False):
-        edge_key = edge_key_function(edge, custom_key_attributes=additional_edge_attributes)
+        edge_key = edge_int_key_function(edge, custom_key_attributes=additional_edge_attributes)
         if edge_key in self.edges:
             self.merged_edge_counter += 1
-            merged_edge = entity_merging_function(quick_json_loads(self.edges[edge_key]),
+            merged_edge = entity_merging_function(self.expand_edge(self.edges[edge_key]),
                                                   edge,
                                                   EDGE_PROPERTIES_THAT_SHOULD_BE_SETS)
             if add_edge_id is True:
-                merged_edge[EDGE_ID] = edge_key
-            self.edges[edge_key] = quick_json_dumps(merged_edge)
+                merged_edge[EDGE_ID] = f'{edge_key:016x}'
+            self.edges[edge_key] = self.compact_edge(merged_edge)
         else:
             if add_edge_id is True:
-                edge[EDGE_ID] = edge_key
-            self.edges[edge_key] = quick_json_dumps(edge)
+                edge[EDGE_ID] = f'{edge_key:016x}'
+            self.edges[edge_key] = self.compact_edge(edge)
+
+    def compact_edge(self, edge):
+        """
+        Converts an edge to a compact tuple for storage: (layout, other properties json, *interned values).
+        The layout is shared by every edge with the same property names in the same order, and records which property
+        values are interned strings. Any other properties are stored together as one json string.
+        """
+        property_names = []
+        interned_flags = []
+        interned_values = []
+        other_properties = {}
+        for key, value in edge.items():
+            property_names.append(key)
+            if value.__class__ is str and (key in EDGE_PROPERTIES_TO_INTERN or is_qualifier_property(key)):
+                interned_flags.append(True)
+                interned_values.append(self.interned_strings.setdefault(value, value))
+            else:
+                interned_flags.append(False)
+                other_properties[key] = value
+        edge_layout = (tuple(property_names), tuple(interned_flags))
+        edge_layout = self.edge_layouts.setdefault(edge_layout, edge_layout)
+        return edge_layout, quick_json_dumps(other_properties) if other_properties else None, *interned_values
+
+    @staticmethod
+    def expand_edge(compact_edge):
+        (property_names, interned_flags), other_properties_json, *interned_values = compact_edge
+        other_properties = quick_json_loads(other_properties_json) if other_properties_json else {}
+        interned_values = iter(interned_values)
+        return {property_name: next(interned_values) if is_interned else other_properties[property_name]
+                for property_name, is_interned in zip(property_names, interned_flags)}
 
     def get_merged_nodes_jsonl(self):
         for node in self.nodes.values():
             yield f'{quick_json_dumps(node)}\n'
 
     def get_merged_edges_jsonl(self):
-        for edge in self.edges.values():
-            yield f'{edge}\n'
+        for compact_edge in self.edges.values():
+            yield f'{quick_json_dumps(self.expand_edge(compact_edge))}\n'
@@ -3,8 +3,8 @@ import jsonlines
 from collections import defaultdict
 
 from Common.biolink_constants import NODE_TYPES, SUBJECT_ID, OBJECT_ID, PREDICATE, PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES
-from Common.utils import quick_jsonl_file_iterator
 from Common.biolink_utils import BiolinkUtils
+from Common.graph_analysis import GraphAnalyzer, GraphAnalysisConsumer
 
 BL_ATTRIBUTE_MAP = {
     "equivalent_identifiers": "biolink:same_as",
@@ -19,17 +19,22 @@ EXAMPLE_DATA_FILENAME = 'example_edges.jsonl'
 ####
 # This class is responsible for generating a meta knowledge graph, as defined by the NCATSTranslator ReasonerAPI
 # It also generates sample testing data (specific examples for each edge type) for usage by the SRI testing harness.
+# It's a GraphAnalysisConsumer, if file paths are provided it runs its own GraphAnalyzer scan of them, otherwise
+# it can be registered with a GraphAnalyzer that other consumers share.
 ####
-class MetaKnowledgeGraphBuilder:
+class MetaKnowledgeGraphBuilder(GraphAnalysisConsumer):
+
+    core_node_attributes = {'id', 'name', NODE_TYPES}
+    core_edge_attributes = {SUBJECT_ID, PREDICATE, OBJECT_ID, PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES}
 
     def __init__(self,
-                 nodes_file_path: str,
-                 edges_file_path: str,
-                 logger=None):
+                 nodes_file_path: str = None,
+                 edges_file_path: str = None,
+                 logger=None,
+                 bl_utils: BiolinkUtils = None):
         self.logger = logger
-        self.bl_utils = BiolinkUtils()
+        self.bl_utils = bl_utils if bl_utils else BiolinkUtils()
 
-        self.node_id_to_leaf_types = None
         self.meta_kg = {
             "nodes": {},
             "edges": []
@@ -39,134 +44,132 @@ class MetaKnowledgeGraphBuilder:
             "edges": []
         }
         self.example_edges = []
-        self.analyze_nodes(nodes_file_path)
-        self.analyze_edges(edges_file_path)
+
+        self.node_type_to_curie_prefixes = defaultdict(set)
+        self.node_type_to_attributes = defaultdict(set)
+        self.node_attribute_to_metadata = {}
+
+        self.edge_attribute_to_metadata = {}
+        self.edge_type_key_to_attributes = defaultdict(set)
+        self.edge_type_key_to_qualifiers = defaultdict(lambda: defaultdict(set))
+        self.edge_type_key_to_example = {}
+        self.edge_types = defaultdict(lambda: defaultdict(set))  # subject_id to object_id to set of predicates
+
+        if nodes_file_path and edges_file_path:
+            graph_analyzer = GraphAnalyzer(nodes_file_path=nodes_file_path,
+                                           edges_file_path=edges_file_path,
+                                           logger=logger,
+                                           bl_utils=self.bl_utils)
+            graph_analyzer.register_consumer(self)
+            graph_analyzer.analyze()
 
     ####
     # Walk through the nodes to find metadata about each node type.
     # Create a set of unique curie prefixes and attribute metadata for each node type.
-    # In the process create a map of node ids to their types that are leaves in the biolink model.
     ####
-    def analyze_nodes(self, nodes_file_path: str):
-
-        core_node_attributes = {'id', 'name', NODE_TYPES}
-
-        node_id_to_leaf_types = {}
-        node_type_to_curie_prefixes = defaultdict(set)
-        node_type_to_attributes = defaultdict(set)
-        node_attribute_to_metadata = {}
-
-        for node in quick_jsonl_file_iterator(nodes_file_path):
-
-            # find the leaf node types of this node's types according to the biolink model
-            try:
-                leaf_types = self.bl_utils.find_biolink_leaves(frozenset(node[NODE_TYPES]))
-            except TypeError:
-                error_message = f'Node types were not a valid list for node: {node}'
-                leaf_types = {}
-                if self.logger:
-                    self.logger.error(error_message)
-                else:
-                    print(error_message)
-
-            # store the leaf types for this node id
-            node_id_to_leaf_types[node['id']] = leaf_types
-
-            # generate metadata for attributes on the node other than the core attributes
-            node_attributes = [key for key in node.keys() if key not in core_node_attributes]
-            for node_attribute in node_attributes:
-                if node_attribute not in node_attribute_to_metadata:
-                    node_attribute_to_metadata[node_attribute] = self.get_meta_attribute(node_attribute)
-
-            curie_prefix = node['id'].split(":")[0]
-            for node_type in leaf_types:
-                # add the curie prefix from the node id to the set for each leaf node type
-                node_type_to_curie_prefixes[node_type].add(curie_prefix)
-                node_type_to_attributes[node_type].update(node_attributes)
-
-        self.node_id_to_leaf_types = node_id_to_leaf_types
-
+    def process_node(self, node: dict, leaf_types):
+        if leaf_types is None:
+            error_message = f'Node types were not a valid list for node: {node}'
+            leaf_types = {}
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+
+        # generate metadata for attributes on the node other than the core attributes
+        node_attributes = [key for key in node.keys() if key not in self.core_node_attributes]
+        for node_attribute in node_attributes:
+            if node_attribute not in self.node_attribute_to_metadata:
+                self.node_attribute_to_metadata[node_attribute] = self.get_meta_attribute(node_attribute)
+
+        curie_prefix = node['id'].split(":")[0]
+        for node_type in leaf_types:
+            # add the curie prefix from the node id to the set for each leaf node type
+            self.node_type_to_curie_prefixes[node_type].add(curie_prefix)
+            self.node_type_to_attributes[node_type].update(node_attributes)
+
+    def nodes_complete(self):
         self.meta_kg['nodes'] = {
-            node_type: {'id_prefixes': list(node_type_to_curie_prefixes[node_type]),
-                        'attributes': [node_attribute_to_metadata[attribute]
-                                       for attribute in node_type_to_attributes[node_type]]}
-            for node_type in node_type_to_curie_prefixes.keys()}
-
-    def analyze_edges(self, edges_file_path: str):
-
-        core_attributes = {SUBJECT_ID, PREDICATE, OBJECT_ID, PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES}
-        node_id_to_leaf_types = self.node_id_to_leaf_types  # local reference for speed
-
-        edge_attribute_to_metadata = {}
-        edge_type_key_to_attributes = defaultdict(set)
-        edge_type_key_to_qualifiers = defaultdict(lambda: defaultdict(set))
-        edge_type_key_to_example = {}
-        edge_types = defaultdict(lambda: defaultdict(set))  # subject_id to object_id to set of predicates
-
-        for edge in quick_jsonl_file_iterator(edges_file_path):
-            try:
-                subject_types = node_id_to_leaf_types[edge[SUBJECT_ID]]
-                object_types = node_id_to_leaf_types[edge[OBJECT_ID]]
-            except KeyError as e:
-                error_message = f'Leaf node types not found for node: {e}. '\
-                                f'Make sure the node is present in the nodes file.'
-                if self.logger:
-                    self.logger.error(error_message)
-                else:
-                    print(error_message)
+            node_type: {'id_prefixes': list(self.node_type_to_curie_prefixes[node_type]),
+                        'attributes': [self.node_attribute_to_metadata[attribute]
+                                       for attribute in self.node_type_to_attributes[node_type]]}
+            for node_type in self.node_type_to_curie_prefixes.keys()}
+
+    def process_edge(self, edge: dict, node_id_to_leaf_types: dict):
+        core_attributes = self.core_edge_attributes
+        edge_attribute_to_metadata = self.edge_attribute_to_metadata
+        edge_type_key_to_attributes = self.edge_type_key_to_attributes
+        edge_type_key_to_qualifiers = self.edge_type_key_to_qualifiers
+        edge_type_key_to_example = self.edge_type_key_to_example
+        edge_types = self.edge_types
+        try:
+            subject_types = node_id_to_leaf_types[edge[SUBJECT_ID]]
+            object_types = node_id_to_leaf_types[edge[OBJECT_ID]]
+        except KeyError as e:
+            error_message = f'Leaf node types not found for node: {e}. '\
+                            f'Make sure the node is present in the nodes file.'
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+            return
+
+        edge_qualifiers = {}
+        edge_attributes = []
+        for key, value in edge.items():
+            if key in core_attributes or value is None:
                 continue
-
-            edge_qualifiers = {}
-            edge_attributes = []
-            for key, value in edge.items():
-                if key in core_attributes or value is None:
-                    continue
-                if self.bl_utils.is_qualifier(key):
-                    edge_qualifiers[key] = value
-                else:
-                    edge_attributes.append(key)
-                    if key not in edge_attribute_to_metadata:
-                        edge_attribute_to_metadata[key] = self.get_meta_attribute(key)
-
-            predicate = edge[PREDICATE]
-            for subject_type in subject_types:
-                for object_type in object_types:
-                    edge_types[subject_type][object_type].add(predicate)
-                    inverse_predicate = self.bl_utils.invert_predicate(predicate)
-                    if inverse_predicate:
-                        edge_types[object_type][subject_type].add(inverse_predicate)
-
-                    edge_type_key = f'{subject_type}{object_type}{predicate}'
-                    edge_type_key_to_attributes[edge_type_key].update(edge_attributes)
-                    for qual, qual_val in edge_qualifiers.items():
-                        try:
-                            edge_type_key_to_qualifiers[edge_type_key][qual].add(qual_val)
-                        except TypeError as e:
-                            error_message = f'Type of value for qualifier not expected: {qual}: {qual_val}, '\
-                                            f'ignoring for meta kg. Error: {e}'
-                            if self.logger:
-                                self.logger.warning(error_message)
-                            else:
-                                print(error_message)
-
-                    if edge_type_key not in edge_type_key_to_example:
-                        example_edge = {
-                            "subject_category": subject_type,
-                            "object_category": object_type,
-                            "predicate": predicate,
-                            "subject_id": edge[SUBJECT_ID],
-                            "object_id": edge[OBJECT_ID]
-                        }
-                        if edge_qualifiers:
-                            example_edge['qualifiers'] = [
-                                {"qualifier_type_id": f"biolink:{qualifier}" if not qualifier.startswith("biolink:") else qualifier,
-                                 "qualifier_value": qualifier_value}
-                                for qualifier, qualifier_value in edge_qualifiers.items()
-                            ]
-                        edge_type_key_to_example[edge_type_key] = example_edge
-                        self.example_edges.append(edge)
-
-        for subject_node_type, object_types_to_predicates in edge_types.items():
+            if self.bl_utils.is_qualifier(key):
+                edge_qualifiers[key] = value
+            else:
+                edge_attributes.append(key)
+                if key not in edge_attribute_to_metadata:
+                    edge_attribute_to_metadata[key] = self.get_meta_attribute(key)
+
+        predicate = edge[PREDICATE]
+        for subject_type in subject_types:
+            for object_type in object_types:
+                edge_types[subject_type][object_type].add(predicate)
+                inverse_predicate = self.bl_utils.invert_predicate(predicate)
+                if inverse_predicate:
+                    edge_types[object_type][subject_type].add(inverse_predicate)
+
+                edge_type_key = f'{subject_type}{object_type}{predicate}'
+                edge_type_key_to_attributes[edge_type_key].update(edge_attributes)
+                for qual, qual_val in edge_qualifiers.items():
+                    try:
+                        edge_type_key_to_qualifiers[edge_type_key][qual].add(qual_val)
+                    except TypeError as e:
+                        error_message = f'Type of value for qualifier not expected: {qual}: {qual_val}, '\
+                                        f'ignoring for meta kg. Error: {e}'
+                        if self.logger:
+                            self.logger.warning(error_message)
+                        else:
+                            print(error_message)
+
+                if edge_type_key not in edge_type_key_to_example:
+                    example_edge = {
+                        "subject_category": subject_type,
+                        "object_category": object_type,
+                        "predicate": predicate,
+                        "subject_id": edge[SUBJECT_ID],
+                        "object_id": edge[OBJECT_ID]
+                    }
+                    if edge_qualifiers:
+                        example_edge['qualifiers'] = [
+                            {"qualifier_type_id": f"biolink:{qualifier}" if not qualifier.startswith("biolink:") else qualifier,
+                             "qualifier_value": qualifier_value}
+                            for qualifier, qualifier_value in edge_qualifiers.items()
+                        ]
+                    edge_type_key_to_example[edge_type_key] = example_edge
+                    self.example_edges.append(edge)
+
+    def edges_complete(self):
+        edge_attribute_to_metadata = self.edge_attribute_to_metadata
+        edge_type_key_to_attributes = self.edge_type_key_to_attributes
+        edge_type_key_to_qualifiers = self.edge_type_key_to_qualifiers
+        edge_type_key_to_example = self.edge_type_key_to_example
+        for subject_node_type, object_types_to_predicates in self.edge_types.items():
             for object_node_type, predicates in object_types_to_predicates.items():
                 for predicate in predicates:
                     edge_type_key = f'{subject_node_type}{object_node_type}{predicate}'
@@ -32,8 +32,11 @@ class Metadata:
     def save_metadata(self):
         if not os.path.isdir(os.path.dirname(self.metadata_file_path)):
             os.makedirs(os.path.dirname(self.metadata_file_path))
-        with open(self.metadata_file_path, 'w') as meta_json_file:
+        # write to a temp file and swap it in, so the file is never seen half written, by another process for example
+        temp_metadata_file_path = f'{self.metadata_file_path}.{os.getpid()}.temp'
+        with open(temp_metadata_file_path, 'w') as meta_json_file:
             json.dump(self.metadata, meta_json_file, indent=4)
+        os.replace(temp_metadata_file_path, self.metadata_file_path)
 
 
 class GraphMetadata(Metadata):
@@ -158,6 +161,14 @@ class SourceMetadata(Metadata):
         self.metadata['fetch_error'] = fetch_error
         self.save_metadata()
 
+    def set_fetch_files(self, fetch_files: dict):
+        # file name -> the url, size and sha256 of each file downloaded during the fetch stage
+        self.metadata['fetch_files'] = fetch_files
+        self.save_metadata()
+
+    def get_fetch_files(self):
+        return self.metadata.get('fetch_files', {})
+
     def get_initial_parsing_metadata(self):
         return {'parsing_status': self.NOT_STARTED,
                 'parsing_source_version': None,
@@ -37,9 +37,14 @@ class Neo4jTools:
             return password_exit_code
 
         self.logger.info(f'Importing csv files to neo4j...')
+        # the csv files may be manifests of multiple csv parts, each part is imported as its own group of files
+        node_file_groups = kgx_file_converter.get_neo4j_import_file_groups(os.path.join(graph_directory,
+                                                                                        csv_nodes_filename))
+        edge_file_groups = kgx_file_converter.get_neo4j_import_file_groups(os.path.join(graph_directory,
+                                                                                        csv_edges_filename))
         neo4j_import_cmd = ['neo4j-admin', 'database', 'import', 'full',
-                            f'--nodes={csv_nodes_filename}',
-                            f'--relationships={csv_edges_filename}',
+                            *[f'--nodes={node_file_group}' for node_file_group in node_file_groups],
+                            *[f'--relationships={edge_file_group}' for edge_file_group in edge_file_groups],
                             '--delimiter=TAB',
                             '--array-delimiter=U+001F',
                             '--overwrite-destination=true']
@@ -237,12 +242,12 @@ def create_neo4j_dump(nodes_filepath: str,
     else:
         if logger:
             logger.info(f'Creating CSV files for {graph_id}({graph_version})...')
-        kgx_file_converter.convert_jsonl_to_neo4j_csv(nodes_input_file=nodes_filepath,
-                                                      edges_input_file=edges_filepath,
-                                                      nodes_output_file=csv_nodes_file_path,
-                                                      edges_output_file=csv_edges_file_path,
-                                                      node_property_ignore_list=node_property_ignore_list,
-                                                      edge_property_ignore_list=edge_property_ignore_list)
+        kgx_file_converter.convert_jsonl_to_neo4j_csv_parts(nodes_input_file=nodes_filepath,
+                                                            edges_input_file=edges_filepath,
+                                                            nodes_output_file=csv_nodes_file_path,
+                                                            edges_output_file=csv_edges_file_path,
+                                                            node_property_ignore_list=node_property_ignore_list,
+                                                            edge_property_ignore_list=edge_property_ignore_list)
         if logger:
             logger.info(f'CSV files created for {graph_id}({graph_version})...')
 
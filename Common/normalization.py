@@ -1,14 +1,18 @@
 import os
 import logging
+import random
 import requests
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter, Retry
 from dataclasses import dataclass
 
 from robokop_genetics.genetics_normalization import GeneticsNormalizer
 from Common.biolink_constants import *
 from Common.utils import LoggingUtil
+from Common.normalization_cache import NodeNormalizationCache
 
 NORMALIZATION_CODE_VERSION = '1.4'
 
@@ -51,6 +55,58 @@ class NormalizationFailedError(Exception):
 
 NODE_NORMALIZATION_URL = os.environ.get('NODE_NORMALIZATION_ENDPOINT', 'https://nodenormalization-sri.renci.org/')
 
+# the maximum number of node norm requests allowed in flight at once, 1 means hit node norm sequentially
+NODE_NORMALIZATION_CONCURRENCY = int(os.environ.get('NODE_NORMALIZATION_CONCURRENCY', 1))
+
+# settings for retrying node norm requests, node norm responds with a 403 when it's throttling requests
+NODE_NORM_RETRY_STATUS_CODES = [502, 503, 504, 403, 429]
+NODE_NORM_MAX_RETRIES = 8
+NODE_NORM_BACKOFF_FACTOR = 1
+NODE_NORM_MAX_BACKOFF = 60
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight. The limit starts at max_concurrency, it is halved whenever the service
+    indicates it's overloaded (403s, 429s, 5xx, dropped connections) and it creeps back up by one after a run of successes.
+    """
+
+    def __init__(self, max_concurrency: int, successes_before_increase: int = 10):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.current_limit = self.max_concurrency
+        self.successes_before_increase = successes_before_increase
+        self.in_flight = 0
+        self.consecutive_successes = 0
+        self.throttle_count = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= self.current_limit:
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record_success(self):
+        with self.condition:
+            self.consecutive_successes += 1
+            if self.consecutive_successes >= self.successes_before_increase and \
+                    self.current_limit < self.max_concurrency:
+                self.current_limit += 1
+                self.consecutive_successes = 0
+                self.condition.notify_all()
+
+    def record_throttle(self):
+        with self.condition:
+            self.throttle_count += 1
+            self.consecutive_successes = 0
+            self.current_limit = max(self.current_limit // 2, 1)
+
 
 class NodeNormalizer:
     """
@@ -70,11 +126,15 @@ class NodeNormalizer:
                  node_normalization_version: str = 'latest',
                  biolink_version: str = 'latest',
                  strict_normalization: bool = True,
-                 conflate_node_types: bool = False):
+                 conflate_node_types: bool = False,
+                 max_concurrent_requests: int = NODE_NORMALIZATION_CONCURRENCY,
+                 node_norm_cache: NodeNormalizationCache = None):
         """
         constructor
         :param log_level - overrides default log level
         :param node_normalization_version - not implemented yet
+        :param max_concurrent_requests - the max number of node norm requests in flight at once, 1 means sequential
+        :param node_norm_cache - an optional persistent cache of node norm results, consulted before hitting node norm
         """
         # create a logger
         self.logger = LoggingUtil.init_logging("ORION.Common.NodeNormalizer",
@@ -98,6 +158,10 @@ class NodeNormalizer:
         self.sequence_variant_normalizer = None
         self.variant_node_types = None
         self.requests_session = self.get_normalization_requests_session()
+        self.max_concurrent_requests = max_concurrent_requests
+        # the concurrent path handles its own retries, so it uses a session that doesn't retry under the hood
+        self.concurrent_requests_session = None
+        self.node_norm_cache = node_norm_cache
 
     def hit_node_norm_service(self, curies, retries=0):
         resp: requests.models.Response = \
@@ -120,6 +184,74 @@ class NodeNormalizer:
             self.logger.error(error_message)
             resp.raise_for_status()
 
+    def hit_node_norm_service_with_backoff(self, curies, concurrency_limiter: AdaptiveConcurrencyLimiter):
+        retries = 0
+        while True:
+            retry_after = None
+            try:
+                with concurrency_limiter:
+                    resp: requests.models.Response = \
+                        self.concurrent_requests_session.post(f'{NODE_NORMALIZATION_URL}get_normalized_nodes',
+                                                              json={'curies': curies,
+                                                                    'conflate': self.conflate_node_types,
+                                                                    'drug_chemical_conflate': self.conflate_node_types,
+                                                                    'description': True})
+                if resp.status_code == 200:
+                    concurrency_limiter.record_success()
+                    response_json = resp.json()
+                    if response_json:
+                        return response_json
+                    else:
+                        error_message = f"Node Normalization service {NODE_NORMALIZATION_URL} returned 200 " \
+                                        f"but with an empty result for (curies: {curies})"
+                        raise NormalizationFailedError(error_message=error_message)
+                elif resp.status_code not in NODE_NORM_RETRY_STATUS_CODES or retries >= NODE_NORM_MAX_RETRIES:
+                    error_message = f'Node norm response code: {resp.status_code} (curies: {curies})'
+                    self.logger.error(error_message)
+                    resp.raise_for_status()
+                    raise NormalizationFailedError(error_message=error_message)
+                retry_reason = f'response code {resp.status_code}'
+                retry_after = resp.headers.get('Retry-After')
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if retries >= NODE_NORM_MAX_RETRIES:
+                    raise e
+                retry_reason = repr(e)
+
+            # the service is struggling, slow everyone down and wait a while before trying again
+            concurrency_limiter.record_throttle()
+            backoff = min(NODE_NORM_BACKOFF_FACTOR * (2 ** retries), NODE_NORM_MAX_BACKOFF)
+            if retry_after and retry_after.isdigit():
+                backoff = max(backoff, int(retry_after))
+            backoff = random.uniform(backoff / 2, backoff)
+            retries += 1
+            self.logger.warning(f'Node norm request failed ({retry_reason}), '
+                                f'retry {retries}/{NODE_NORM_MAX_RETRIES} in {backoff:.1f} seconds..')
+            time.sleep(backoff)
+
+    def hit_node_norm_service_concurrently(self, chunks_of_ids: list) -> dict:
+        if not self.concurrent_requests_session:
+            self.concurrent_requests_session = \
+                self.get_normalization_requests_session(pool_maxsize=self.max_concurrent_requests,
+                                                        retries=False)
+        concurrency_limiter = AdaptiveConcurrencyLimiter(self.max_concurrent_requests)
+        node_normalization_results: dict = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            futures = [executor.submit(self.hit_node_norm_service_with_backoff, chunk, concurrency_limiter)
+                       for chunk in chunks_of_ids]
+            try:
+                # collect the results in the order the chunks were sent so the results match the sequential path
+                for future in futures:
+                    node_normalization_results.update(**future.result())
+            except Exception as e:
+                for future in futures:
+                    future.cancel()
+                raise e
+        if concurrency_limiter.throttle_count:
+            self.logger.info(f'Node norm requests were throttled {concurrency_limiter.throttle_count} times, '
+                             f'concurrency ended at {concurrency_limiter.current_limit}/'
+                             f'{self.max_concurrent_requests}.')
+        return node_normalization_results
+
     def normalize_node_data(self, node_list: list, batch_size: int = 1000) -> list:
         """
         This method calls the NodeNormalization web service and normalizes a list of nodes.
@@ -139,6 +271,13 @@ class NodeNormalizer:
         # make a list of the node ids, we used to deduplicate here, but now we expect the list to be unique ids
         to_normalize: list = [node['id'] for node in node_list]
 
+        # if there is a node norm cache, only ask node norm about the curies that weren't already cached
+        cached_normalization_results: dict = {}
+        if self.node_norm_cache:
+            cached_normalization_results = self.node_norm_cache.get_normalizations(to_normalize)
+            if cached_normalization_results:
+                to_normalize = [curie for curie in to_normalize if curie not in cached_normalization_results]
+
         # use indexes and slice to grab batch_size sized chunks of ids from the list
         start_index: int = 0
         last_index: int = len(to_normalize)
@@ -159,27 +298,19 @@ class NodeNormalizer:
             else:
                 break
 
-        # we should be able to do the following, but it's causing RemoteDisconnected errors with node norm
-        #
-        # hit the node norm api with the chunks of curies in parallel
-        # we could try to optimize the number of max_workers for ThreadPoolExecutor more specifically,
-        # by default python attempts to find a reasonable # based on os.cpu_count()
-        # with ThreadPoolExecutor() as executor:
-        #     executor_results = executor.map(self.hit_node_norm_service, chunks_of_ids)
-        #
-        # normalization_results = list(executor_results)
-        # for normalization_json, ids in zip(normalization_results, chunks_of_ids):
-        #     if not normalization_json:
-        #        raise NormalizationFailedError(f'!!! Normalization json results missing for ids: {ids}')
-        #    else:
-        #        merge the normalization results into one dictionary
-        #        node_normalization_results.update(**normalization_json)
-
-        # until we can get threading working, hit node norm sequentially
-        node_normalization_results: dict = {}
-        for chunk in chunks_of_ids:
-            results = self.hit_node_norm_service(chunk)
-            node_normalization_results.update(**results)
+        # hit node norm with the chunks of curies, either sequentially or with a bounded number of concurrent requests
+        # that backs off when node norm starts to struggle (bursts of parallel requests used to cause RemoteDisconnected)
+        if self.max_concurrent_requests > 1 and len(chunks_of_ids) > 1:
+            node_normalization_results: dict = self.hit_node_norm_service_concurrently(chunks_of_ids)
+        else:
+            node_normalization_results: dict = {}
+            for chunk in chunks_of_ids:
+                results = self.hit_node_norm_service(chunk)
+                node_normalization_results.update(**results)
+
+        if self.node_norm_cache:
+            self.node_norm_cache.set_normalizations(node_normalization_results)
+            node_normalization_results.update(cached_normalization_results)
 
         # reset the node index
         node_idx = 0
@@ -359,13 +490,16 @@ class NodeNormalizer:
             resp.raise_for_status()
 
     @staticmethod
-    def get_normalization_requests_session():
-        pool_maxsize = max(os.cpu_count(), 10)
+    def get_normalization_requests_session(pool_maxsize: int = None, retries: bool = True):
+        pool_maxsize = max(os.cpu_count(), 10, pool_maxsize or 0)
         s = requests.Session()
-        retries = Retry(total=8,
-                        backoff_factor=1,
-                        status_forcelist=[502, 503, 504, 403, 429],
-                        allowed_methods=['GET', 'POST', 'HEAD', 'OPTIONS'])
+        if retries:
+            retries = Retry(total=8,
+                            backoff_factor=1,
+                            status_forcelist=NODE_NORM_RETRY_STATUS_CODES,
+                            allowed_methods=['GET', 'POST', 'HEAD', 'OPTIONS'])
+        else:
+            retries = Retry(total=0, raise_on_status=False)
         s.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize))
         s.mount('http://', HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize))
         return s
@@ -0,0 +1,212 @@
+import os
+import sqlite3
+import logging
+import orjson
+from datetime import datetime
+from Common.utils import LoggingUtil, chunk_iterator
+
+NODE_NORM_CACHE_DIR = 'node_norm_cache'
+NODE_NORM_CACHE_FILENAME = 'node_norm_cache.db'
+
+# how many node norm version / conflation combinations to keep around, the least recently used are evicted
+NODE_NORM_CACHE_VERSIONS_TO_KEEP = int(os.environ.get('NODE_NORM_CACHE_VERSIONS_TO_KEEP', 2))
+
+# sqlite limits the number of variables in a single statement, look up curies in chunks smaller than that
+CACHE_LOOKUP_CHUNK_SIZE = 500
+
+
+class NodeNormalizationCache:
+    """
+    A persistent on-disk cache of node normalization service results, shared by every source and build that
+    uses the same storage directory. Results are keyed by (node norm version, conflation flag, curie), so a cached
+    result is only reused when node norm would have returned the same thing. Curies that failed to normalize are
+    cached too (as null), because node norm will keep failing them for the same version.
+    """
+
+    def __init__(self,
+                 node_norm_version: str,
+                 conflation: bool = False,
+                 cache_file_path: str = None,
+                 versions_to_keep: int = NODE_NORM_CACHE_VERSIONS_TO_KEEP,
+                 log_level=logging.INFO):
+        self.logger = LoggingUtil.init_logging("ORION.Common.NodeNormalizationCache",
+                                               level=log_level,
+                                               line_format='medium',
+                                               log_file_path=os.environ.get('ORION_LOGS'))
+        self.node_norm_version = node_norm_version
+        self.conflation = 1 if conflation else 0
+        self.versions_to_keep = versions_to_keep
+        self.cache_file_path = cache_file_path if cache_file_path else self.get_default_cache_file_path()
+        self.hits = 0
+        self.misses = 0
+
+        # multiple pipelines could be using the cache at once, WAL mode lets readers and a writer work concurrently
+        self.connection = sqlite3.connect(self.cache_file_path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS node_normalizations ('
+                                    'node_norm_version TEXT NOT NULL, '
+                                    'conflation INTEGER NOT NULL, '
+                                    'curie TEXT NOT NULL, '
+                                    'normalization BLOB, '
+                                    'PRIMARY KEY (node_norm_version, conflation, curie)) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cached_versions ('
+                                    'node_norm_version TEXT NOT NULL, '
+                                    'conflation INTEGER NOT NULL, '
+                                    'last_used TEXT NOT NULL, '
+                                    'PRIMARY KEY (node_norm_version, conflation))')
+        self.register_version()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def register_version(self):
+        is_new_version = self.connection.execute('SELECT 1 FROM cached_versions '
+                                                 'WHERE node_norm_version = ? AND conflation = ?',
+                                                 (self.node_norm_version, self.conflation)).fetchone() is None
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO cached_versions VALUES (?, ?, ?)',
+                                    (self.node_norm_version, self.conflation, datetime.now().isoformat()))
+        # a new node norm version means older cached results are probably stale, clean them up
+        if is_new_version:
+            self.evict_stale_versions()
+
+    def evict_stale_versions(self):
+        stale_versions = self.connection.execute('SELECT node_norm_version, conflation FROM cached_versions '
+                                                 'ORDER BY last_used DESC LIMIT -1 OFFSET ?',
+                                                 (self.versions_to_keep,)).fetchall()
+        if not stale_versions:
+            return 0
+        try:
+            with self.connection:
+                for stale_version, stale_conflation in stale_versions:
+                    self.logger.info(f'Evicting node norm cache entries for version {stale_version} '
+                                     f'(conflation: {bool(stale_conflation)})..')
+                    self.connection.execute('DELETE FROM node_normalizations '
+                                            'WHERE node_norm_version = ? AND conflation = ?',
+                                            (stale_version, stale_conflation))
+                    self.connection.execute('DELETE FROM cached_versions '
+                                            'WHERE node_norm_version = ? AND conflation = ?',
+                                            (stale_version, stale_conflation))
+            self.compact()
+        except sqlite3.OperationalError as e:
+            # another process is probably using the cache, this isn't critical, it can happen next time
+            self.logger.warning(f'Could not evict stale node norm cache versions: {e}')
+        return len(stale_versions)
+
+    def compact(self):
+        self.connection.execute('VACUUM')
+
+    def get_normalizations(self, curies: list) -> dict:
+        """
+        Looks up cached node norm results for a list of curies.
+
+        :param curies: the curies to look up
+        :return: a dictionary of curie -> node norm result (which can be None), for the curies that were found
+        """
+        cached_normalizations = {}
+        for curies_chunk in chunk_iterator(curies, CACHE_LOOKUP_CHUNK_SIZE):
+            query = f'SELECT curie, normalization FROM node_normalizations ' \
+                    f'WHERE node_norm_version = ? AND conflation = ? ' \
+                    f'AND curie IN ({",".join("?" * len(curies_chunk))})'
+            for curie, normalization in self.connection.execute(query,
+                                                                (self.node_norm_version,
+                                                                 self.conflation,
+                                                                 *curies_chunk)):
+                cached_normalizations[curie] = orjson.loads(normalization)
+        self.hits += len(cached_normalizations)
+        self.misses += len(curies) - len(cached_normalizations)
+        return cached_normalizations
+
+    def set_normalizations(self, normalizations: dict):
+        """
+        Stores node norm results in the cache.
+
+        :param normalizations: a dictionary of curie -> node norm result, as returned by node norm
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO node_normalizations VALUES (?, ?, ?, ?)',
+                                        ((self.node_norm_version, self.conflation, curie, orjson.dumps(normalization))
+                                         for curie, normalization in normalizations.items()))
+
+    def get_metadata(self):
+        return {'node_norm_cache_hits': self.hits,
+                'node_norm_cache_misses': self.misses}
+
+    @staticmethod
+    def get_default_cache_file_path():
+        # use a directory in the storage directory specified by the environment variable ORION_STORAGE
+        if "ORION_STORAGE" not in os.environ or not os.path.isdir(os.environ["ORION_STORAGE"]):
+            raise IOError(f'The node normalization cache requires a valid storage directory, '
+                          f'specify one with the environment variable ORION_STORAGE.')
+        cache_dir = os.path.join(os.environ["ORION_STORAGE"], NODE_NORM_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, NODE_NORM_CACHE_FILENAME)
+
+
+class NodeNormalizationLookupStore:
+    """
+    An on-disk stand-in for the node normalization lookup (original id -> list of normalized ids, or None), used by
+    low memory normalization so the full lookup doesn't need to be held in memory. It's scratch space for a single
+    normalization run, so durability is traded for speed, and the file is removed when the store is closed.
+    """
+
+    def __init__(self, store_file_path: str):
+        self.store_file_path = store_file_path
+        if os.path.exists(self.store_file_path):
+            os.remove(self.store_file_path)
+        self.connection = sqlite3.connect(self.store_file_path)
+        self.connection.execute('PRAGMA journal_mode=OFF')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        # keep sqlite's own page cache bounded (negative values are in KiB)
+        self.connection.execute('PRAGMA cache_size=-65536')
+        self.connection.execute('CREATE TABLE node_norm_lookup (original_id TEXT PRIMARY KEY, normalized_ids BLOB) '
+                                'WITHOUT ROWID')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM node_norm_lookup').fetchone()[0]
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+            os.remove(self.store_file_path)
+
+    def update(self, node_normalization_lookup: dict):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO node_norm_lookup VALUES (?, ?)',
+                                        ((original_id, orjson.dumps(normalized_ids))
+                                         for original_id, normalized_ids in node_normalization_lookup.items()))
+
+    def get_many(self, original_ids) -> dict:
+        """
+        :param original_ids: an iterable of original node ids
+        :return: a lookup dictionary of original id -> normalized ids, for the ids that were found
+        """
+        node_normalization_lookup = {}
+        for ids_chunk in chunk_iterator(original_ids, CACHE_LOOKUP_CHUNK_SIZE):
+            query = f'SELECT original_id, normalized_ids FROM node_norm_lookup ' \
+                    f'WHERE original_id IN ({",".join("?" * len(ids_chunk))})'
+            for original_id, normalized_ids in self.connection.execute(query, ids_chunk):
+                node_normalization_lookup[original_id] = orjson.loads(normalized_ids)
+        return node_normalization_lookup
+
+    def items(self):
+        for original_id, normalized_ids in self.connection.execute('SELECT original_id, normalized_ids '
+                                                                   'FROM node_norm_lookup'):
+            yield original_id, orjson.loads(normalized_ids)
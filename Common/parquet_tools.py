@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import orjson
+import polars as pl
+from collections import defaultdict
+from Common.utils import quick_jsonl_file_iterator
+from Common.biolink_constants import SUBJECT_ID, OBJECT_ID, PREDICATE, NODE_TYPES, PRIMARY_KNOWLEDGE_SOURCE, \
+    AGGREGATOR_KNOWLEDGE_SOURCES, KNOWLEDGE_LEVEL, AGENT_TYPE
+
+PARQUET_DUMP_DIRECTORY = 'parquet'
+
+# the max number of rows in each parquet file, the rows of a file are held in memory while it's written
+PARQUET_ROWS_PER_FILE = int(os.environ.get('PARQUET_ROWS_PER_FILE', 250_000))
+
+# properties that don't get their own column are stored as a json object in this column
+PARQUET_SPARSE_PROPERTIES_COLUMN = 'properties'
+
+# a property gets its own column if it's in at least this fraction of the rows of the first file
+PARQUET_DENSE_PROPERTY_THRESHOLD = 0.5
+
+# these always get their own columns
+PARQUET_REQUIRED_NODE_COLUMNS = ['id', 'name', NODE_TYPES]
+PARQUET_REQUIRED_EDGE_COLUMNS = [SUBJECT_ID, PREDICATE, OBJECT_ID, PRIMARY_KNOWLEDGE_SOURCE]
+
+# columns with a small set of repeated values, these are dictionary encoded
+PARQUET_NODE_DICTIONARY_COLUMNS = {NODE_TYPES}
+PARQUET_EDGE_DICTIONARY_COLUMNS = {PREDICATE, PRIMARY_KNOWLEDGE_SOURCE, AGGREGATOR_KNOWLEDGE_SOURCES,
+                                   KNOWLEDGE_LEVEL, AGENT_TYPE}
+
+# a placeholder type for empty lists, which fit in a column of any list type
+EMPTY_LIST = 'empty_list'
+
+
+def create_parquet_dump(nodes_filepath: str,
+                        edges_filepath: str,
+                        output_directory: str,
+                        graph_id: str = 'graph',
+                        graph_version: str = '',
+                        node_property_ignore_list: set = None,
+                        edge_property_ignore_list: set = None,
+                        logger=None):
+    parquet_directory = os.path.join(output_directory, PARQUET_DUMP_DIRECTORY)
+    if os.path.exists(parquet_directory):
+        if logger:
+            logger.info(f'Parquet files were already created for {graph_id}({graph_version})')
+    else:
+        if logger:
+            logger.info(f'Creating parquet files for {graph_id}({graph_version})...')
+        # write the files to a separate directory first and move it into place when they're all written,
+        # so the parquet directory only exists if the conversion completed
+        partial_directory = f'{parquet_directory}.partial'
+        try:
+            start_time = time.time()
+            shutil.rmtree(partial_directory, ignore_errors=True)
+            counts = convert_jsonl_to_parquet(nodes_input_file=nodes_filepath,
+                                              edges_input_file=edges_filepath,
+                                              output_directory=partial_directory,
+                                              node_property_ignore_list=node_property_ignore_list,
+                                              edge_property_ignore_list=edge_property_ignore_list)
+            os.replace(partial_directory, parquet_directory)
+        except Exception as e:
+            shutil.rmtree(partial_directory, ignore_errors=True)
+            if logger:
+                logger.error(f'create_parquet_dump() failed with exception: {e}')
+                return False
+            else:
+                raise e
+        if logger:
+            logger.info(f'Parquet files created for {graph_id}({graph_version}), {counts["nodes"]} nodes in '
+                        f'{counts["node_files"]} files and {counts["edges"]} edges in {counts["edge_files"]} files, '
+                        f'in {round(time.time() - start_time)} seconds.')
+    return True
+
+
+def convert_jsonl_to_parquet(nodes_input_file: str,
+                             edges_input_file: str,
+                             output_directory: str,
+                             node_property_ignore_list: set = None,
+                             edge_property_ignore_list: set = None,
+                             rows_per_file: int = PARQUET_ROWS_PER_FILE):
+    """
+    Convert nodes.jsonl and edges.jsonl into parquet files, in output_directory/nodes and output_directory/edges.
+
+    The schema is inferred from the first rows_per_file rows of each file while they're read: properties that are in
+    most of those rows get their own column, typed from their values, and every other property is stored in a json
+    column. Every file of nodes or edges has the same schema, values that don't fit their column's type go in the
+    json column too. Predicates, categories, knowledge sources and the like are dictionary encoded.
+
+    Returns
+    -------
+    dict of the number of nodes, edges, and files of each written
+    """
+    nodes, node_files = convert_jsonl_to_parquet_files(input_file=nodes_input_file,
+                                                       output_directory=os.path.join(output_directory, 'nodes'),
+                                                       required_columns=PARQUET_REQUIRED_NODE_COLUMNS,
+                                                       dictionary_columns=PARQUET_NODE_DICTIONARY_COLUMNS,
+                                                       property_ignore_list=node_property_ignore_list,
+                                                       rows_per_file=rows_per_file)
+    edges, edge_files = convert_jsonl_to_parquet_files(input_file=edges_input_file,
+                                                       output_directory=os.path.join(output_directory, 'edges'),
+                                                       required_columns=PARQUET_REQUIRED_EDGE_COLUMNS,
+                                                       dictionary_columns=PARQUET_EDGE_DICTIONARY_COLUMNS,
+                                                       property_ignore_list=edge_property_ignore_list,
+                                                       rows_per_file=rows_per_file)
+    return {'nodes': nodes, 'node_files': node_files, 'edges': edges, 'edge_files': edge_files}
+
+
+def convert_jsonl_to_parquet_files(input_file: str,
+                                   output_directory: str,
+                                   required_columns: list,
+                                   dictionary_columns: set,
+                                   property_ignore_list: set = None,
+                                   rows_per_file: int = PARQUET_ROWS_PER_FILE):
+    os.makedirs(output_directory, exist_ok=True)
+    schema = None
+    rows = []
+    row_count = 0
+    file_count = 0
+    for item in quick_jsonl_file_iterator(input_file):
+        if property_ignore_list:
+            for ignore_key in property_ignore_list:
+                item.pop(ignore_key, None)
+        rows.append(item)
+        if len(rows) >= rows_per_file:
+            if schema is None:
+                schema = infer_parquet_schema(rows, required_columns, dictionary_columns)
+            write_parquet_file(rows, schema, os.path.join(output_directory, f'part-{file_count:05}.parquet'))
+            row_count += len(rows)
+            file_count += 1
+            rows = []
+    if rows or not file_count:
+        if schema is None:
+            schema = infer_parquet_schema(rows, required_columns, dictionary_columns)
+        write_parquet_file(rows, schema, os.path.join(output_directory, f'part-{file_count:05}.parquet'))
+        row_count += len(rows)
+        file_count += 1
+    return row_count, file_count
+
+
+def infer_parquet_schema(rows: list, required_columns: list, dictionary_columns: set):
+    property_counts = defaultdict(int)
+    property_types = defaultdict(set)
+    for row in rows:
+        for key, value in row.items():
+            property_counts[key] += 1
+            property_types[key].add(get_parquet_value_type(value))
+
+    schema = {}
+    for key in required_columns:
+        # required columns with values that don't have a consistent type are stored as strings
+        schema[key] = resolve_parquet_column_type(property_types[key]) or pl.String
+    for key, count in property_counts.items():
+        if key in schema or key == PARQUET_SPARSE_PROPERTIES_COLUMN or \
+                count < len(rows) * PARQUET_DENSE_PROPERTY_THRESHOLD:
+            continue
+        column_type = resolve_parquet_column_type(property_types[key])
+        if column_type is not None:
+            schema[key] = column_type
+    for key in dictionary_columns:
+        if key in schema:
+            if schema[key] == pl.String:
+                schema[key] = pl.Categorical
+            elif schema[key] == pl.List(pl.String):
+                schema[key] = pl.List(pl.Categorical)
+    schema[PARQUET_SPARSE_PROPERTIES_COLUMN] = pl.String
+    return schema
+
+
+def get_parquet_value_type(value):
+    # bool needs to be checked before int, because bools are ints
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return pl.Boolean
+    if isinstance(value, int):
+        return pl.Int64
+    if isinstance(value, float):
+        return pl.Float64
+    if isinstance(value, str):
+        return pl.String
+    if isinstance(value, list):
+        if not value:
+            return EMPTY_LIST
+        if all(isinstance(list_value, str) for list_value in value):
+            return pl.List(pl.String)
+    return 'other'
+
+
+def resolve_parquet_column_type(value_types: set):
+    value_types = value_types - {None}
+    if value_types == {pl.Int64, pl.Float64}:
+        return pl.Float64
+    if EMPTY_LIST in value_types:
+        value_types = value_types - {EMPTY_LIST}
+        if not value_types:
+            return pl.List(pl.String)
+        if len(value_types) == 1 and next(iter(value_types)) == pl.List(pl.String):
+            return pl.List(pl.String)
+        return None
+    if not value_types:
+        return pl.String
+    if len(value_types) == 1 and 'other' not in value_types:
+        return next(iter(value_types))
+    return None
+
+
+def fits_parquet_column_type(value, column_type):
+    value_type = get_parquet_value_type(value)
+    if value_type is None or value_type == column_type:
+        return True
+    if column_type == pl.Categorical:
+        return value_type == pl.String
+    if isinstance(column_type, pl.List):
+        return value_type == EMPTY_LIST or value_type == pl.List(pl.String)
+    return column_type == pl.Float64 and value_type == pl.Int64
+
+
+def write_parquet_file(rows: list, schema: dict, file_path: str):
+    columns = {column: [] for column in schema}
+    sparse_properties_column = columns.pop(PARQUET_SPARSE_PROPERTIES_COLUMN)
+    for row in rows:
+        sparse_properties = {}
+        for key, value in row.items():
+            if key in columns and fits_parquet_column_type(value, schema[key]):
+                continue
+            sparse_properties[key] = value
+        for column, column_values in columns.items():
+            value = row.get(column, None)
+            if column in sparse_properties:
+                value = None
+            elif schema[column] == pl.Float64 and value is not None:
+                value = float(value)
+            column_values.append(value)
+        sparse_properties_column.append(orjson.dumps(sparse_properties).decode() if sparse_properties else None)
+    columns[PARQUET_SPARSE_PROPERTIES_COLUMN] = sparse_properties_column
+    pl.DataFrame(columns, schema=schema).write_parquet(file_path)
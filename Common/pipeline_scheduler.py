@@ -0,0 +1,177 @@
+import os
+import logging
+import multiprocessing
+from dataclasses import dataclass
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from Common.utils import LoggingUtil
+from Common.data_sources import RESOURCE_HOGS
+from Common.normalization import NormalizationScheme
+
+# the number of source pipelines that can run at once, 1 runs them one after another in the main process
+SOURCE_PIPELINE_WORKERS = int(os.environ.get('ORION_SOURCE_PIPELINE_WORKERS', 1))
+
+# every source pipeline belongs to a resource class, and the number of pipelines of each class that can run at once is
+# limited by these budgets (None for no limit besides the number of workers), so that the sources that need huge
+# amounts of memory or disk never run together
+RESOURCE_HOG_CLASS = 'resource_hog'
+STANDARD_CLASS = 'standard'
+RESOURCE_CLASS_BUDGETS = {RESOURCE_HOG_CLASS: 1, STANDARD_CLASS: None}
+
+# when pipelines run in worker processes each source gets its own log files, in this directory under ORION_LOGS
+SOURCE_PIPELINE_LOGS_DIRECTORY = 'source_pipelines'
+
+logger = LoggingUtil.init_logging("ORION.Common.SourcePipelineScheduler",
+                                  line_format='medium',
+                                  log_file_path=os.environ['ORION_LOGS'])
+
+
+@dataclass
+class SourcePipelineJob:
+    source_id: str
+    source_version: str
+    parsing_version: str
+    normalization_scheme: NormalizationScheme
+    supplementation_version: str
+
+    def get_resource_class(self):
+        return RESOURCE_HOG_CLASS if self.source_id in RESOURCE_HOGS else STANDARD_CLASS
+
+
+# the SourceDataManager used by pipeline worker processes, it's set in the parent process before the workers are forked
+shared_source_data_manager = None
+
+# the log directory of the parent process, pipeline workers put the log files of each source in a subdirectory of it
+parent_log_directory = os.environ.get('ORION_LOGS')
+
+
+def run_source_pipeline(job: SourcePipelineJob, source_data_manager=None):
+    source_data_manager = source_data_manager if source_data_manager is not None else shared_source_data_manager
+    return source_data_manager.run_pipeline(job.source_id,
+                                            source_version=job.source_version,
+                                            parsing_version=job.parsing_version,
+                                            normalization_scheme=job.normalization_scheme,
+                                            supplementation_version=job.supplementation_version)
+
+
+def run_source_pipeline_in_worker(job: SourcePipelineJob):
+    # runs in a worker process, exceptions are logged and reported as a failed pipeline
+    redirect_logs_to_source_directory(job.source_id)
+    try:
+        return run_source_pipeline(job)
+    except Exception as e:
+        logger.error(f'Pipeline for {job.source_id} failed with exception: {repr(e)}')
+        return False
+
+
+def redirect_logs_to_source_directory(source_id: str):
+    """
+    Point the log files of a worker process at a directory for the source it's running, so that pipelines running at
+    the same time don't write to, or rotate, the same files. Loggers created later, like the ones of parsers that get
+    imported by the pipeline, use the new directory through ORION_LOGS.
+    """
+    if not parent_log_directory:
+        return
+    source_log_directory = os.path.join(parent_log_directory, SOURCE_PIPELINE_LOGS_DIRECTORY, source_id)
+    os.makedirs(source_log_directory, exist_ok=True)
+    os.environ['ORION_LOGS'] = source_log_directory
+    for existing_logger in list(logging.Logger.manager.loggerDict.values()):
+        if not isinstance(existing_logger, logging.Logger):
+            continue
+        for handler in list(existing_logger.handlers):
+            if not isinstance(handler, RotatingFileHandler):
+                continue
+            source_handler = RotatingFileHandler(filename=os.path.join(source_log_directory,
+                                                                       os.path.basename(handler.baseFilename)),
+                                                 maxBytes=handler.maxBytes,
+                                                 backupCount=handler.backupCount)
+            source_handler.setFormatter(handler.formatter)
+            source_handler.setLevel(handler.level)
+            existing_logger.removeHandler(handler)
+            handler.close()
+            existing_logger.addHandler(source_handler)
+
+
+class SourcePipelineScheduler:
+    """
+    Runs source pipelines (fetch, parse, normalize, supplement) concurrently in a pool of worker processes. A pipeline
+    is started whenever a worker is free and starting it stays within the budget of its resource class, and never while
+    another pipeline for the same source is running, because they would share the source's directory and metadata.
+    Resource hogs are started first, they take the longest.
+    """
+
+    def __init__(self,
+                 source_data_manager,
+                 workers: int = SOURCE_PIPELINE_WORKERS,
+                 resource_class_budgets: dict = None):
+        self.source_data_manager = source_data_manager
+        self.workers = max(workers, 1)
+        self.resource_class_budgets = resource_class_budgets if resource_class_budgets is not None \
+            else RESOURCE_CLASS_BUDGETS
+
+    def run(self, jobs: list):
+        """
+        :param jobs: a list of SourcePipelineJob
+        :return: a dict of (source_id, source_version) -> the result of run_pipeline for it, the release version, or
+        False if it failed
+        """
+        if self.workers == 1 or len(jobs) <= 1:
+            return {(job.source_id, job.source_version): run_source_pipeline(job, self.source_data_manager)
+                    for job in jobs}
+
+        global shared_source_data_manager
+        shared_source_data_manager = self.source_data_manager
+        pending_jobs = sorted(jobs, key=lambda job: job.get_resource_class() != RESOURCE_HOG_CLASS)
+        running_jobs = {}
+        results = {}
+        logger.info(f'Running {len(jobs)} source pipelines with {self.workers} processes...')
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     mp_context=multiprocessing.get_context('fork')) as process_pool:
+                while pending_jobs or running_jobs:
+                    for job in self.get_jobs_to_start(pending_jobs, list(running_jobs.values())):
+                        pending_jobs.remove(job)
+                        logger.info(f'Starting pipeline for {job.source_id} ({job.get_resource_class()})...')
+                        running_jobs[process_pool.submit(run_source_pipeline_in_worker, job)] = job
+                    if not running_jobs:
+                        # nothing is running and nothing else can start, the remaining jobs don't fit any budget
+                        for job in pending_jobs:
+                            logger.error(f'Pipeline for {job.source_id} could not be started, the budget for '
+                                         f'{job.get_resource_class()} pipelines is {self.resource_class_budgets}.')
+                            results[(job.source_id, job.source_version)] = False
+                        break
+                    finished_jobs, _ = wait(running_jobs, return_when=FIRST_COMPLETED)
+                    for finished_job in finished_jobs:
+                        job = running_jobs.pop(finished_job)
+                        job_key = (job.source_id, job.source_version)
+                        try:
+                            results[job_key] = finished_job.result()
+                        except Exception as e:
+                            # the worker process itself failed, like if it ran out of memory
+                            logger.error(f'Pipeline for {job.source_id} failed with exception: {repr(e)}')
+                            results[job_key] = False
+                        logger.info(f'Pipeline for {job.source_id} finished '
+                                    f'{"successfully" if results[job_key] else "unsuccessfully"}.')
+        finally:
+            shared_source_data_manager = None
+        return results
+
+    def get_jobs_to_start(self, pending_jobs: list, running_jobs: list):
+        jobs_to_start = []
+        running_source_ids = {job.source_id for job in running_jobs}
+        resource_class_counts = {}
+        for job in running_jobs:
+            resource_class_counts[job.get_resource_class()] = resource_class_counts.get(job.get_resource_class(), 0) + 1
+        for job in pending_jobs:
+            if len(running_jobs) + len(jobs_to_start) >= self.workers:
+                break
+            resource_class = job.get_resource_class()
+            budget = self.resource_class_budgets.get(resource_class, None)
+            if (budget is not None and resource_class_counts.get(resource_class, 0) >= budget) or \
+                    job.source_id in running_source_ids:
+                continue
+            jobs_to_start.append(job)
+            running_source_ids.add(job.source_id)
+            resource_class_counts[resource_class] = resource_class_counts.get(resource_class, 0) + 1
+        return jobs_to_start
@@ -1,5 +1,4 @@
 import subprocess
-import jsonlines
 import json
 import os
 from os import path, environ
@@ -9,7 +8,7 @@ from zipfile import ZipFile
 from collections import defaultdict
 from Common.biolink_constants import *
 from Common.normalization import FALLBACK_EDGE_PREDICATE, NormalizationScheme
-from Common.utils import LoggingUtil
+from Common.utils import LoggingUtil, open_kgx_jsonlines
 from Common.kgx_file_writer import KGXFileWriter
 from Common.kgx_file_normalizer import KGXFileNormalizer
 
@@ -222,7 +221,7 @@ class SequenceVariantSupplementation:
                                       nodes_file_path: str,
                                       vcf_file_path: str):
         try:
-            with open(vcf_file_path, "w") as vcf_file, jsonlines.open(nodes_file_path) as source_json:
+            with open(vcf_file_path, "w") as vcf_file, open_kgx_jsonlines(nodes_file_path) as source_json:
                 vcf_headers = "\t".join(["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"])
                 vcf_file.write(f'#{vcf_headers}\n')
                 for node in source_json:
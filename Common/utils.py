@@ -4,18 +4,32 @@ import tarfile
 import gzip
 import requests
 import orjson
+import jsonlines
 from itertools import islice
+from contextlib import contextmanager
 from email.utils import parsedate_to_datetime
 
-from urllib import request
 from zipfile import ZipFile
-from io import TextIOWrapper
+from io import TextIOWrapper, BufferedReader
 from io import BytesIO
 from csv import DictReader
 from ftplib import FTP
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 
+from Common.downloader import FileDownloader, DownloadError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression options for kgx files, the compression of a file is determined by its extension
+KGX_FILE_COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# gzip's default level 9 is much slower and barely smaller for jsonl
+GZIP_COMPRESSION_LEVEL = 6
+
 
 class LoggingUtil(object):
     """
@@ -110,6 +124,9 @@ class GetData:
         # create a logger
         self.logger = LoggingUtil.init_logging("ORION.Common.GetData", level=log_level, line_format='medium', log_file_path=os.environ.get('ORION_LOGS'))
 
+        # downloads files in parallel parts and resumes interrupted downloads
+        self.downloader = FileDownloader(logger=self.logger)
+
     @staticmethod
     def pull_via_ftp_binary(ftp_site, ftp_dir, ftp_file):
         """
@@ -197,50 +214,24 @@ class GetData:
         :return: boolean pass/fail
         """
 
-        # init a retrieved file counter for the return
-        file_counter: int = 0
-
         try:
-            # open the FTP connection and go to the directory
-            ftp: FTP = FTP(ftp_site)
-            ftp.login()
-            ftp.cwd(ftp_dir)
-
             # if the target directory doesnt exist, create it
-            if not os.path.exists(data_file_path):
-                os.makedirs(data_file_path)
-
-            # for each file requested
-            for f in ftp_files:
-                self.logger.debug(f'Retrieving {ftp_site}{ftp_dir}{f} -> {data_file_path}')
-
-                # does the file exist and has data in it
-                try:
-                    # get the size of the file
-                    size: int = os.path.getsize(os.path.join(data_file_path, f))
-                except FileNotFoundError:
-                    size: int = 0
-
-                # if we have a size we done need to get the file
-                if size == 0:
-                    # open the file
-                    with open(os.path.join(data_file_path, f), 'wb') as fp:
-                        # get the file data into a file
-                        ftp.retrbinary(f'RETR {f}', fp.write)
-
-                # inform user of progress
-                file_counter += 1
-
-                # progress output
-                if file_counter % 50 == 0:
-                    self.logger.debug(f'{file_counter} files retrieved, {len(ftp_files) - file_counter} to go.')
+            os.makedirs(data_file_path, exist_ok=True)
 
-            self.logger.debug(f'{file_counter} file(s) retrieved of {len(ftp_files)} requested.')
+            # files that exist and have data in them were already retrieved
+            files_to_retrieve = [f for f in ftp_files
+                                 if not os.path.exists(os.path.join(data_file_path, f)) or
+                                 os.path.getsize(os.path.join(data_file_path, f)) == 0]
+            self.logger.debug(f'Retrieving {len(files_to_retrieve)} file(s) from {ftp_site}{ftp_dir} -> '
+                              f'{data_file_path}')
 
-            # close the ftp object
-            ftp.quit()
-        except Exception as e:
-            error_message = f'GetDataPullError pull_via_ftp() failed for {ftp_site}. Exception: {e}'
+            # get the files over a pool of ftp connections
+            self.downloader.download_ftp_files(ftp_site, ftp_dir, files_to_retrieve, data_file_path)
+
+            file_counter: int = len(ftp_files)
+            self.logger.debug(f'{file_counter} file(s) retrieved of {len(ftp_files)} requested.')
+        except DownloadError as e:
+            error_message = f'GetDataPullError pull_via_ftp() failed for {ftp_site}. Exception: {e.error_message}'
             self.logger.error(error_message)
             raise GetDataPullError(error_message)
 
@@ -279,41 +270,14 @@ class GetData:
         # get the name of the file to write
         data_file: str = saved_file_name if saved_file_name else url.split('/')[-1]
 
-        # this tracks how much, if any, of the file is downloaded
-        # (it's not really used anymore, it could be more simple)
-        byte_counter: int = 0
-
-        # check if the file exists already
+        # check if the file exists already, files only exist once they were downloaded completely
         if not os.path.exists(os.path.join(data_dir, data_file)):
 
             self.logger.debug(f'Retrieving {url} -> {data_dir}')
             try:
-                hdr = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'}
-                req = request.Request(url, headers=hdr)
-
-                # get the file data handle
-                file_data = request.urlopen(req)
-
-                with open(os.path.join(data_dir, data_file), 'wb') as fp:
-                    # specify the buffered data block size
-                    block = 131072
-
-                    # until all bytes read
-                    while True:
-                        # get some bytes
-                        buffer = file_data.read(block)
-
-                        # did we run out of data
-                        if not buffer:
-                            break
-
-                        # keep track of the number of bytes transferred
-                        byte_counter += len(buffer)
-
-                        # output the data to the file
-                        fp.write(buffer)
-            except Exception as e:
-                error_message = f'GetDataPullError pull_via_http() failed. URL: {url}. Exception: {e}'
+                byte_counter: int = self.downloader.download_http(url, os.path.join(data_dir, data_file))
+            except DownloadError as e:
+                error_message = f'GetDataPullError pull_via_http() failed. URL: {url}. Exception: {e.error_message}'
                 self.logger.error(error_message)
                 raise GetDataPullError(error_message)
 
@@ -323,6 +287,31 @@ class GetData:
         # return the number of bytes read
         return byte_counter
 
+    def pull_via_http_files(self, urls: list, data_dir: str, saved_file_names: list = None) -> int:
+        """
+        gets multiple files over http at once, skipping any that were already retrieved.
+
+        :param urls:
+        :param data_dir:
+        :param saved_file_names:
+        :return: the number of bytes read
+        """
+        saved_file_names = saved_file_names if saved_file_names else [url.split('/')[-1] for url in urls]
+        files_to_retrieve = [(url, saved_file_name) for url, saved_file_name in zip(urls, saved_file_names)
+                             if not os.path.exists(os.path.join(data_dir, saved_file_name))]
+        if not files_to_retrieve:
+            return 1
+
+        self.logger.debug(f'Retrieving {len(files_to_retrieve)} file(s) -> {data_dir}')
+        try:
+            return sum(self.downloader.download_http_files([url for url, _ in files_to_retrieve],
+                                                           data_dir,
+                                                           [saved_file_name for _, saved_file_name in files_to_retrieve]))
+        except DownloadError as e:
+            error_message = f'GetDataPullError pull_via_http_files() failed. Exception: {e.error_message}'
+            self.logger.error(error_message)
+            raise GetDataPullError(error_message)
+
     def get_swiss_prot_id_set(self, data_dir: str, debug_mode=False) -> set:
         """
         gets/parses the swiss-prot listing file and returns a set of uniprot kb ids from
@@ -535,10 +524,104 @@ def quick_json_loads(item):
 
 def quick_jsonl_file_iterator(json_file, is_gzip=False):
     with gzip.open(json_file, 'rt') if is_gzip \
-            else open(json_file, 'r', encoding='utf-8') as fp:
+            else open_kgx_file(json_file) as fp:
         for line in fp:
             yield orjson.loads(line)
 
+
+def get_kgx_file_compression(file_path: str):
+    for compression, extension in KGX_FILE_COMPRESSION_EXTENSIONS.items():
+        if file_path.endswith(extension):
+            return compression
+    return None
+
+
+def add_kgx_file_compression_extension(file_path: str, compression: str = None):
+    if not compression:
+        return file_path
+    if compression not in KGX_FILE_COMPRESSION_EXTENSIONS:
+        raise ValueError(f'Unsupported kgx file compression {compression}, '
+                         f'options are: {", ".join(KGX_FILE_COMPRESSION_EXTENSIONS)}')
+    return f'{file_path}{KGX_FILE_COMPRESSION_EXTENSIONS[compression]}'
+
+
+def open_kgx_file(file_path: str, mode: str = 'r'):
+    """
+    Opens a file for reading ('r'), writing ('w') or appending ('a'), in text mode or binary mode ('rb', 'wb', 'ab'),
+    compressing or decompressing it according to its extension: .gz for gzip, .zst for zstd, and anything else is a
+    plain file.
+    """
+    binary = 'b' in mode
+    encoding = None if binary else 'utf-8'
+    compression = get_kgx_file_compression(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, mode if binary else f'{mode}t', encoding=encoding,
+                         compresslevel=GZIP_COMPRESSION_LEVEL)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError(f'zstandard is required to read or write {file_path}, install it with pip.')
+        if mode.startswith('r'):
+            # appending to a zstd file adds another frame, so make sure all of them are read
+            reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'),
+                                                                read_across_frames=True,
+                                                                closefd=True)
+            # buffer binary readers too, so that they can be read line by line like the other binary files
+            return BufferedReader(reader) if binary else TextIOWrapper(reader, encoding=encoding)
+        return zstandard.open(file_path, mode, encoding=encoding)
+    return open(file_path, mode, encoding=encoding)
+
+
+@contextmanager
+def open_kgx_jsonlines(file_path: str, mode: str = 'r'):
+    # like jsonlines.open, but for possibly compressed files
+    with open_kgx_file(file_path, mode) as fp:
+        with jsonlines.Reader(fp) if mode == 'r' else jsonlines.Writer(fp) as jsonlines_file:
+            yield jsonlines_file
+
+
+def get_byte_range_shards(file_path: str, number_of_shards: int):
+    # split a file into roughly equal byte ranges, with every range starting at the beginning of a line
+    file_size = os.path.getsize(file_path)
+    if get_kgx_file_compression(file_path):
+        # compressed files can't be split by byte ranges, the whole file is one range with no end
+        return [(0, None)]
+    shard_starts = [0]
+    with open(file_path, 'rb') as input_file:
+        for shard in range(1, number_of_shards):
+            input_file.seek(max(file_size * shard // number_of_shards, shard_starts[-1]))
+            if input_file.tell() > 0:
+                # skip to the start of the next line
+                input_file.seek(input_file.tell() - 1)
+                input_file.readline()
+            shard_start = input_file.tell()
+            if shard_start >= file_size:
+                break
+            if shard_start > shard_starts[-1]:
+                shard_starts.append(shard_start)
+    shard_ends = shard_starts[1:] + [file_size]
+    return list(zip(shard_starts, shard_ends))
+
+
+def read_byte_range_lines(file_path: str, range_start: int, range_end: int):
+    # yields the non-empty lines of a byte range from get_byte_range_shards, as bytes, or str for compressed files
+    if range_end is None:
+        with open_kgx_file(file_path) as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield line
+        return
+    with open(file_path, 'rb') as input_file:
+        input_file.seek(range_start)
+        remaining_bytes = range_end - range_start
+        while remaining_bytes > 0:
+            line = input_file.readline()
+            if not line:
+                break
+            remaining_bytes -= len(line)
+            if line.strip():
+                yield line
+
+
 def chunk_iterator(iterable, chunk_size):
     iterator = iter(iterable)
     while True:
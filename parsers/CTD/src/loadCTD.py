@@ -138,11 +138,9 @@ class CTDLoader(SourceDataLoader):
         """
         # and get a reference to the data gatherer
         gd: GetData = GetData(self.logger.level)
-        for data_file in self.ctd_data_files:
-            gd.pull_via_http(f'{self.ctd_data_url}{data_file}', data_dir=self.data_path)
-
-        for data_file in self.hand_curated_files:
-            gd.pull_via_http(f'{self.hand_curated_data_url}{data_file}', data_dir=self.data_path)
+        data_file_urls = [f'{self.ctd_data_url}{data_file}' for data_file in self.ctd_data_files] + \
+                         [f'{self.hand_curated_data_url}{data_file}' for data_file in self.hand_curated_files]
+        gd.pull_via_http_files(data_file_urls, data_dir=self.data_path)
 
         return True
 
@@ -1,13 +1,25 @@
 import os
 import tarfile
 import gzip
+import shutil
 import argparse
-from urllib import request
+import multiprocessing
+import orjson
+import polars as pl
+from concurrent.futures import ProcessPoolExecutor
 from Common.normalization import NodeNormalizer
 from Common.loader_interface import SourceDataLoader
+from Common.kgx_file_writer import KGXFileWriter
 from Common.biolink_constants import *
 from Common.prefixes import HGVS, UBERON
-from Common.hgvs_utils import convert_variant_to_hgvs
+from Common.hgvs_utils import convert_variant_to_hgvs, convert_variants_to_hgvs
+from Common.utils import GetData, chunk_iterator
+
+# the number of processes used to parse the tissue files, 1 parses them one after another in the main process
+GTEX_PARSING_WORKERS = int(os.environ.get('GTEX_PARSING_WORKERS', 1))
+
+# the number of gtex records read at a time, the new variants in each batch are converted to HGVS all at once
+GTEX_HGVS_CONVERSION_BATCH_SIZE = 100_000
 
 
 class GTExLoader(SourceDataLoader):
@@ -15,6 +27,7 @@ class GTExLoader(SourceDataLoader):
     source_id = 'GTEx'
     provenance_id = 'infores:gtex'
     parsing_version = '1.3'
+    node_dedup_strategy = 'hashed'
     has_sequence_variants = True
 
     # this probably won't change very often - just hard code it for now
@@ -103,6 +116,8 @@ class GTExLoader(SourceDataLoader):
         self.gtex_variant_to_hgvs_lookup = {}
         self.variants_that_failed_hgvs_conversion = set()
         self.written_genes = set()
+        # hgvs values converted in a batch, before their variants are processed, see process_gtex_relationships
+        self.converted_hgvs_values = {}
 
         # the defaults for the types/category field
         self.variant_node_types = [SEQUENCE_VARIANT]
@@ -110,6 +125,11 @@ class GTExLoader(SourceDataLoader):
 
         self.parsing_errors = []
 
+        # tissue files are parsed in worker processes when this is more than 1, see parse_gtex_tar_in_parallel
+        self.parsing_workers = GTEX_PARSING_WORKERS
+        # the ids of the nodes written when the results of the workers are combined
+        self.reduced_node_ids = set()
+
     def get_latest_source_version(self):
         return self.GTEX_VERSION
 
@@ -118,16 +138,14 @@ class GTExLoader(SourceDataLoader):
         gtex_version = self.GTEX_VERSION
 
         eqtl_url = f'https://storage.googleapis.com/adult-gtex/bulk-qtl/v{gtex_version}/single-tissue-cis-qtl/{self.eqtl_tar_file_name}'
-        eqtl_tar_download_path = os.path.join(self.data_path, self.eqtl_tar_file_name)
-
         sqtl_url = f'https://storage.googleapis.com/adult-gtex/bulk-qtl/v{gtex_version}/single-tissue-cis-qtl/{self.sqtl_tar_file_name}'
-        sqtl_tar_download_path = os.path.join(self.data_path, self.sqtl_tar_file_name)
 
-        self.logger.info(f'Downloading raw GTEx data files from {eqtl_url}.')
-        self.fetch_and_save_tar(eqtl_url, eqtl_tar_download_path)
-
-        self.logger.info(f'Downloading raw GTEx data files from {sqtl_url}.')
-        self.fetch_and_save_tar(sqtl_url, sqtl_tar_download_path)
+        # the archives are large, they're downloaded at the same time in parallel parts
+        self.logger.info(f'Downloading raw GTEx data files from {eqtl_url} and {sqtl_url}.')
+        gd = GetData(self.logger.level)
+        gd.pull_via_http_files([eqtl_url, sqtl_url],
+                               data_dir=self.data_path,
+                               saved_file_names=[self.eqtl_tar_file_name, self.sqtl_tar_file_name])
 
     def parse_data(self):
 
@@ -156,24 +174,131 @@ class GTExLoader(SourceDataLoader):
                        tar_path: str,
                        load_metadata: dict,
                        is_sqtl: bool = False):
+        if self.parsing_workers > 1 and not self.test_mode:
+            self.parse_gtex_tar_in_parallel(tar_path, load_metadata, is_sqtl=is_sqtl)
+        else:
+            self.process_gtex_relationships(self.parse_file_and_yield_relationships(tar_path, is_sqtl=is_sqtl),
+                                            load_metadata,
+                                            is_sqtl=is_sqtl)
+
+    def process_gtex_relationships(self,
+                                   gtex_relationships,
+                                   load_metadata: dict,
+                                   is_sqtl: bool = False):
         record_counter = load_metadata['record_counter']
         skipped_record_counter = load_metadata['skipped_record_counter']
-        for gtex_relationship in self.parse_file_and_yield_relationships(tar_path, is_sqtl=is_sqtl):
-            # unpack the gtex_relationship tuple
-            anatomy_id, gtex_variant, gtex_gene, p_value, slope = gtex_relationship
-            # process and write the nodes
-            variant_id = self.process_variant(gtex_variant)
-            if variant_id:
-                gene_id = self.process_gene(gtex_gene)
-                self.create_edge(anatomy_id, variant_id, gene_id, p_value, slope, is_sqtl=is_sqtl)
-                record_counter += 1
-                if self.test_mode and record_counter % 50_000 == 0:
-                    break
-            else:
-                skipped_record_counter += 1
+        for gtex_relationships_batch in chunk_iterator(gtex_relationships, GTEX_HGVS_CONVERSION_BATCH_SIZE):
+            # convert the variants that haven't been seen before all at once
+            new_gtex_variant_ids = list(dict.fromkeys(gtex_relationship[1]
+                                                      for gtex_relationship in gtex_relationships_batch
+                                                      if gtex_relationship[1] not in self.gtex_variant_to_hgvs_lookup))
+            self.converted_hgvs_values.update(self.convert_gtex_variants_to_hgvs(new_gtex_variant_ids))
+            test_mode_limit_reached = False
+            for gtex_relationship in gtex_relationships_batch:
+                # unpack the gtex_relationship tuple
+                anatomy_id, gtex_variant, gtex_gene, p_value, slope = gtex_relationship
+                # process and write the nodes
+                variant_id = self.process_variant(gtex_variant)
+                if variant_id:
+                    gene_id = self.process_gene(gtex_gene)
+                    self.create_edge(anatomy_id, variant_id, gene_id, p_value, slope, is_sqtl=is_sqtl)
+                    record_counter += 1
+                    if self.test_mode and record_counter % 50_000 == 0:
+                        test_mode_limit_reached = True
+                        break
+                else:
+                    skipped_record_counter += 1
+            if test_mode_limit_reached:
+                break
+        self.converted_hgvs_values.clear()
         load_metadata['record_counter'] = record_counter
         load_metadata['skipped_record_counter'] = skipped_record_counter
 
+    @staticmethod
+    def convert_gtex_variants_to_hgvs(gtex_variant_ids: list):
+        """
+        Convert gtex variant ids to HGVS values in bulk.
+
+        :return: a dict of gtex variant id -> HGVS value, or '' when it can't be converted, for the ids that are well
+        formed. Any others are left out and converted one at a time by process_variant.
+        """
+        if not gtex_variant_ids:
+            return {}
+        # for gtex variant ids the format is: chr1_1413898_T_C_b38
+        # split the strings into their components (3: removes "chr" from the start)
+        variants = pl.DataFrame({'gtex_variant_id': pl.Series(gtex_variant_ids, dtype=pl.String)}).with_columns(
+            variant_data=pl.col('gtex_variant_id').str.slice(3).str.split('_'))
+        variants = variants.with_columns(
+            chromosome=pl.col('variant_data').list.get(0, null_on_oob=True),
+            position=pl.col('variant_data').list.get(1, null_on_oob=True),
+            ref_allele=pl.col('variant_data').list.get(2, null_on_oob=True),
+            alt_allele=pl.col('variant_data').list.get(3, null_on_oob=True),
+            reference_genome=pl.col('variant_data').list.get(4, null_on_oob=True)
+        ).filter(pl.col('reference_genome').is_not_null() &
+                 pl.col('position').str.contains(r'^[0-9]+$') &
+                 pl.col('chromosome').str.contains(r'^([0-9]+|X|Y)$'))
+        hgvs_values = convert_variants_to_hgvs(variants['chromosome'],
+                                               variants['position'].cast(pl.Int64),
+                                               variants['ref_allele'],
+                                               variants['alt_allele'],
+                                               reference_genomes=variants['reference_genome'],
+                                               reference_patches='p1')
+        return dict(zip(variants['gtex_variant_id'].to_list(), hgvs_values.to_list()))
+
+    def parse_gtex_tar_in_parallel(self,
+                                   tar_path: str,
+                                   load_metadata: dict,
+                                   is_sqtl: bool = False):
+        """
+        Parse each tissue file of a gtex tar in a pool of worker processes. Each worker converts the variants and
+        writes the nodes and edges of a tissue file to its own shard files, with nodes only written the first time they
+        show up in that tissue file. The shards are then combined in the order of the tissue files in the tar, writing
+        each node the first time it shows up across all of them, so the output is exactly the same as parsing the tar
+        in one process.
+        """
+        with tarfile.open(tar_path, 'r:') as tar_files:
+            tissue_files = [(tissue_file.name, anatomy_id) for tissue_file, anatomy_id in self.get_tissue_files(tar_files)]
+        shard_directory = os.path.join(self.data_path, f'{os.path.basename(tar_path)}_parsing_shards')
+        shutil.rmtree(shard_directory, ignore_errors=True)
+        os.makedirs(shard_directory)
+        self.logger.info(f'Parsing {len(tissue_files)} tissue files with {self.parsing_workers} processes...')
+
+        try:
+            # the workers are spawned rather than forked, polars can deadlock in a process forked after it was used
+            with ProcessPoolExecutor(max_workers=self.parsing_workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as process_pool:
+                shard_results = process_pool.map(parse_gtex_tissue_file,
+                                                 [tar_path] * len(tissue_files),
+                                                 [tissue_file_name for tissue_file_name, _ in tissue_files],
+                                                 [anatomy_id for _, anatomy_id in tissue_files],
+                                                 [is_sqtl] * len(tissue_files),
+                                                 [os.path.join(shard_directory, f'{i}_nodes.jsonl')
+                                                  for i in range(len(tissue_files))],
+                                                 [os.path.join(shard_directory, f'{i}_edges.jsonl')
+                                                  for i in range(len(tissue_files))])
+                # map returns the results in order, so shards are combined in order as soon as they're ready
+                for shard_result in shard_results:
+                    self.reduce_gtex_shard(shard_result, load_metadata)
+        finally:
+            shutil.rmtree(shard_directory, ignore_errors=True)
+
+    def reduce_gtex_shard(self, shard_result: dict, load_metadata: dict):
+        reduced_node_ids = self.reduced_node_ids
+        with open(shard_result['nodes_file_path'], 'rb') as nodes_shard:
+            for node_line in nodes_shard:
+                node_id = orjson.loads(node_line)['id']
+                if node_id not in reduced_node_ids:
+                    reduced_node_ids.add(node_id)
+                    self.output_file_writer.write_nodes([node_line], uniquify=False)
+        with open(shard_result['edges_file_path'], 'rb') as edges_shard:
+            self.output_file_writer.write_edges(edges_shard)
+        os.remove(shard_result['nodes_file_path'])
+        os.remove(shard_result['edges_file_path'])
+        load_metadata['record_counter'] += shard_result['record_counter']
+        load_metadata['skipped_record_counter'] += shard_result['skipped_record_counter']
+        self.variants_that_failed_hgvs_conversion.update(shard_result['failed_variants'])
+        self.parsing_errors.extend(shard_result['errors'])
+
     # given a gtex variant check to see if it has been encountered already
     # if so return the previously generated hgvs curie
     # otherwise generate a HGVS curie from the gtex variant and write the node to file
@@ -181,22 +306,26 @@ class GTExLoader(SourceDataLoader):
                         gtex_variant_id):
         # we might have gotten the variant from another file already
         if gtex_variant_id not in self.gtex_variant_to_hgvs_lookup:
-            # if not convert it to an HGVS value
-            # for gtex variant ids the format is: chr1_1413898_T_C_b38
-            # split the string into it's components (3: removes "chr" from the start)
-            variant_data = gtex_variant_id[3:].split('_')
-            chromosome = variant_data[0]
-            position = int(variant_data[1])
-            ref_allele = variant_data[2]
-            alt_allele = variant_data[3]
-            reference_genome = variant_data[4]
-            reference_patch = 'p1'
-            hgvs: str = convert_variant_to_hgvs(chromosome,
-                                                position,
-                                                ref_allele,
-                                                alt_allele,
-                                                reference_genome,
-                                                reference_patch)
+            if gtex_variant_id in self.converted_hgvs_values:
+                # it was already converted with the rest of its batch
+                hgvs: str = self.converted_hgvs_values.pop(gtex_variant_id)
+            else:
+                # if not convert it to an HGVS value
+                # for gtex variant ids the format is: chr1_1413898_T_C_b38
+                # split the string into it's components (3: removes "chr" from the start)
+                variant_data = gtex_variant_id[3:].split('_')
+                chromosome = variant_data[0]
+                position = int(variant_data[1])
+                ref_allele = variant_data[2]
+                alt_allele = variant_data[3]
+                reference_genome = variant_data[4]
+                reference_patch = 'p1'
+                hgvs: str = convert_variant_to_hgvs(chromosome,
+                                                    position,
+                                                    ref_allele,
+                                                    alt_allele,
+                                                    reference_genome,
+                                                    reference_patch)
             if hgvs:
                 # store the hgvs value and write the node to the kgx file
                 variant_id = f'{HGVS}:{hgvs}'
@@ -260,80 +389,88 @@ class GTExLoader(SourceDataLoader):
     def parse_file_and_yield_relationships(self,
                                            full_tar_path: str,
                                            is_sqtl: bool = False):
-        # column indexes for the gtex data files
-        variant_column_index = 0
-        gene_column_index = 1
-        pval_column_index = 6
-        slope_column_index = 7
-
         # read the gtex tar
         with tarfile.open(full_tar_path, 'r:') as tar_files:
             # each tissue has it's own file, iterate through them
-            for tissue_file in tar_files:
+            for tissue_file, anatomy_id in self.get_tissue_files(tar_files):
                 # get a handle for an extracted tissue file
                 tissue_handle = tar_files.extractfile(tissue_file)
+                yield from self.parse_tissue_file(tissue_handle, tissue_file.name, anatomy_id, is_sqtl=is_sqtl)
+
+    def get_tissue_files(self, tar_files: tarfile.TarFile):
+        # yields the members of a gtex tar that are tissue data files, and the anatomy id for each
+        for tissue_file in tar_files:
+            # is this a significant_variant-gene data file? expecting formats:
+            # eqtl - 'GTEx_Analysis_v8_eQTL/<tissue_name>.v8.signif_variant_gene_pairs.txt.gz'
+            # sqtl - 'GTEx_Analysis_v8_sQTL/<tissue_name>.v8.sqtl_signifpairs.txt.gz'
+            if tissue_file.name.find('signif') != -1:
+
+                # get the tissue name from the name of the file
+                tissue_name = tissue_file.name.split('/')[1].split('.')[0]
+
+                # check to make sure we know about this tissue
+                if tissue_name in self.anatomy_id_lookup:
+                    # determine anatomy ID
+                    yield tissue_file, self.anatomy_id_lookup[tissue_name]
+                else:
+                    self.logger.warning(f'Skipping unexpected tissue file {tissue_file.name}.')
+
+    def parse_tissue_file(self,
+                          tissue_handle,
+                          tissue_file_name: str,
+                          anatomy_id: str,
+                          is_sqtl: bool = False):
+        # column indexes for the gtex data files
+        variant_column_index = 0
+        gene_column_index = 1
+        pval_column_index = 6
+        slope_column_index = 7
 
-                # is this a significant_variant-gene data file? expecting formats:
-                # eqtl - 'GTEx_Analysis_v8_eQTL/<tissue_name>.v8.signif_variant_gene_pairs.txt.gz'
-                # sqtl - 'GTEx_Analysis_v8_sQTL/<tissue_name>.v8.sqtl_signifpairs.txt.gz'
-                if tissue_file.name.find('signif') != -1:
-                    self.logger.info(f'Reading tissue file {tissue_file.name}.')
-
-                    # get the tissue name from the name of the file
-                    tissue_name = tissue_file.name.split('/')[1].split('.')[0]
-
-                    # check to make sure we know about this tissue
-                    if tissue_name in self.anatomy_id_lookup:
-
-                        # determine anatomy ID
-                        anatomy_id = self.anatomy_id_lookup[tissue_name]
-
-                        # open up the compressed file
-                        with gzip.open(tissue_handle, 'rt') as compressed_file:
-                            # skip the headers line of the file
-                            next(compressed_file).split('\t')
-
-                            # for each line in the file
-                            for i, line in enumerate(compressed_file, start=1):
-
-                                # split line the into an array
-                                line_split: list = line.split('\t')
-
-                                # check the column count
-                                if len(line_split) != 12:
-                                    self.logger.error(f'Error with column count or delimiter in {tissue_file.name}. (line {i}:{line})')
-                                else:
-                                    try:
-                                        # get the variant gtex id
-                                        gtex_variant_id: str = line_split[variant_column_index]
-
-                                        if is_sqtl:
-                                            # for sqtl the phenotype id contains the ensembl id for the gene.
-                                            # it has the format: chr1:497299:498399:clu_51878:ENSG00000237094.11
-                                            phenotype_id: str = line_split[gene_column_index]
-                                            gene: str = phenotype_id.split(':')[4]
-                                            # remove the version number
-                                            gene_id: str = gene.split('.')[0]
-                                        else:
-                                            # for eqtl this should just be the ensembl gene id, remove the version number
-                                            gene_id: str = line_split[gene_column_index].split('.')[0]
-
-                                        gene_id = f'ENSEMBL:{gene_id}'
-                                        p_value = line_split[pval_column_index]
-                                        slope = line_split[slope_column_index]
-
-                                        yield (anatomy_id,
-                                               gtex_variant_id,
-                                               gene_id,
-                                               p_value,
-                                               slope)
-                                    except KeyError as e:
-                                        self.logger.error(f'KeyError parsing an edge line: {e} ')
-                                        self.parsing_errors.append(str(e))
-                                        continue
-
-                    else:
-                        self.logger.warning(f'Skipping unexpected tissue file {tissue_file.name}.')
+        self.logger.info(f'Reading tissue file {tissue_file_name}.')
+
+        # open up the compressed file
+        with gzip.open(tissue_handle, 'rt') as compressed_file:
+            # skip the headers line of the file
+            next(compressed_file).split('\t')
+
+            # for each line in the file
+            for i, line in enumerate(compressed_file, start=1):
+
+                # split line the into an array
+                line_split: list = line.split('\t')
+
+                # check the column count
+                if len(line_split) != 12:
+                    self.logger.error(f'Error with column count or delimiter in {tissue_file_name}. (line {i}:{line})')
+                else:
+                    try:
+                        # get the variant gtex id
+                        gtex_variant_id: str = line_split[variant_column_index]
+
+                        if is_sqtl:
+                            # for sqtl the phenotype id contains the ensembl id for the gene.
+                            # it has the format: chr1:497299:498399:clu_51878:ENSG00000237094.11
+                            phenotype_id: str = line_split[gene_column_index]
+                            gene: str = phenotype_id.split(':')[4]
+                            # remove the version number
+                            gene_id: str = gene.split('.')[0]
+                        else:
+                            # for eqtl this should just be the ensembl gene id, remove the version number
+                            gene_id: str = line_split[gene_column_index].split('.')[0]
+
+                        gene_id = f'ENSEMBL:{gene_id}'
+                        p_value = line_split[pval_column_index]
+                        slope = line_split[slope_column_index]
+
+                        yield (anatomy_id,
+                               gtex_variant_id,
+                               gene_id,
+                               p_value,
+                               slope)
+                    except KeyError as e:
+                        self.logger.error(f'KeyError parsing an edge line: {e} ')
+                        self.parsing_errors.append(str(e))
+                        continue
 
     # take the UBERON ids for the anatomy / tissues and normalize them with the normalization API
     # this step would normally happen post-parsing for nodes but the anatomy IDs are set as edge properties
@@ -349,22 +486,30 @@ class GTExLoader(SourceDataLoader):
             else:
                 self.logger.error(f'Anatomy normalization failed to normalize: {anatomy_id} ({anatomy_label})')
 
-    # download a tar file and write it locally
-    @staticmethod
-    def fetch_and_save_tar(url, dl_path):
-        # get a http handle to the file stream
-        http_handle = request.urlopen(url)
-
-        # open the file and save it
-        with open(dl_path, 'wb') as tar_file:
-            # while there is data
-            while True:
-                # read a block of data
-                data = http_handle.read(8192)
-
-                # if nothing read
-                if len(data) == 0:
-                    break
-
-                # write out the data to the output file
-                tar_file.write(data)
+
+def parse_gtex_tissue_file(tar_path: str,
+                           tissue_file_name: str,
+                           anatomy_id: str,
+                           is_sqtl: bool,
+                           nodes_file_path: str,
+                           edges_file_path: str):
+    # runs in a worker process, parses one tissue file of a gtex tar into shard files for the parent to combine
+    gtex_loader = GTExLoader()
+    shard_metadata = {'record_counter': 0,
+                      'skipped_record_counter': 0}
+    with KGXFileWriter(nodes_file_path, edges_file_path,
+                       node_dedup_strategy=gtex_loader.node_dedup_strategy) as shard_file_writer, \
+            tarfile.open(tar_path, 'r:') as tar_files:
+        gtex_loader.output_file_writer = shard_file_writer
+        tissue_handle = tar_files.extractfile(tar_files.getmember(tissue_file_name))
+        gtex_loader.process_gtex_relationships(gtex_loader.parse_tissue_file(tissue_handle,
+                                                                             tissue_file_name,
+                                                                             anatomy_id,
+                                                                             is_sqtl=is_sqtl),
+                                               shard_metadata,
+                                               is_sqtl=is_sqtl)
+    shard_metadata['nodes_file_path'] = nodes_file_path
+    shard_metadata['edges_file_path'] = edges_file_path
+    shard_metadata['failed_variants'] = list(gtex_loader.variants_that_failed_hgvs_conversion)
+    shard_metadata['errors'] = gtex_loader.parsing_errors
+    return shard_metadata
@@ -13,6 +13,7 @@ class UGLoader(SourceDataLoader):
     source_id = 'UbergraphNonredundant'
     provenance_id = 'infores:ubergraph'
     parsing_version: str = '1.5'
+    node_dedup_strategy: str = 'hashed'
 
     def __init__(self, test_mode: bool = False, source_data_dir: str = None):
         """
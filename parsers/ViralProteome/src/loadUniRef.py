@@ -24,6 +24,7 @@ class UniRefSimLoader(SourceDataLoader):
     source_id = 'UniRef'
     provenance_id = 'infores:uniref'
     parsing_version: str = '1.1'
+    node_dedup_strategy: str = 'hashed'
 
     def __init__(self, test_mode: bool = False, source_data_dir: str = None):
         """
@@ -119,7 +120,8 @@ class UniRefSimLoader(SourceDataLoader):
         final_record_count: int = 0
         final_skipped_count: int = 0
 
-        with KGXFileWriter(nodes_output_file_path, edges_output_file_path) as file_writer:
+        with KGXFileWriter(nodes_output_file_path, edges_output_file_path,
+                           node_dedup_strategy=self.node_dedup_strategy) as file_writer:
             # for each UniRef file to process
             for f in in_file_names:
                 self.logger.debug(f'Processing {f}.')
@@ -2,8 +2,9 @@ import os
 import argparse
 import requests
 import re
-import xml.etree.cElementTree as E_Tree
+import xml.etree.ElementTree as E_Tree
 
+from typing import Iterator
 from bs4 import BeautifulSoup
 from zipfile import ZipFile
 from Common.biolink_constants import *
@@ -84,15 +85,12 @@ class HMDBLoader(SourceDataLoader):
             # open the hmdb xml file
             with zf.open('hmdb_metabolites.xml', 'r') as fp:
 
-                # loop through, filtering for relevant elements
-                for record in self.read_xml_file(fp, 'metabolite'):
+                # loop through the metabolite elements as they are parsed
+                for el in self.read_xml_file(fp, 'metabolite'):
 
                     # increment the counter
                     record_counter += 1
 
-                    # convert the xml text into an object
-                    el: E_Tree.Element = E_Tree.fromstring(record)
-
                     # get the metabolite element
                     metabolite_accession: E_Tree.Element = el.find('accession')
 
@@ -135,7 +133,7 @@ class HMDBLoader(SourceDataLoader):
                         # increment the counter
                         skipped_record_counter += 1
 
-                        self.logger.debug(f'Record skipped due to invalid metabolite id: {record}')
+                        self.logger.debug(f'Record {record_counter} skipped due to invalid metabolite id.')
 
         self.logger.debug(f'Parsing XML data file complete.')
 
@@ -416,53 +414,40 @@ class HMDBLoader(SourceDataLoader):
         # return pass or fail
         return ret_val
 
-    def read_xml_file(self, fp, element) -> list:
+    def read_xml_file(self, fp, element) -> Iterator[E_Tree.Element]:
         """
-        Read the xml file and capture the metabolite elements.
+        Stream the xml file and yield the elements with the given tag, like the metabolite elements, as they are parsed.
 
-        TODO filter out more items that arent used
+        The namespace is removed from the tags so that the elements can be searched with plain tag names, and the tree
+        is cleared once the caller is done with each element, so the whole file is never held in memory.
 
+        :param fp: the xml file, a binary file object
+        :param element: the tag of the elements to yield
         """
-        # create the target xml fragment search tag
-        start_tag: str = f'<{element}>'
-        end_tag: str = f'</{element}>'
-
-        # flag to indicate we have identified a new xml fragment
-        tag_found: bool = False
-
-        # init the xml text to be captured
-        xml_string: str = ''
-
         # init a record counter
         counter: int = 0
 
-        # for every line in the file
-        for line in fp:
-
-            # convert to string and remove the unprintable characters
-            line = line.decode('utf-8')
+        # the root element, the yielded elements are its children
+        root: E_Tree.Element = None
 
-            # xml elements span multiple lines - are we starting a relevant one?
-            if start_tag in line:
-                tag_found = True
-                counter += 1
-                if counter % 25000 == 0:
-                    self.logger.debug(f'Loaded {counter} metabolites...')
+        for event, el in E_Tree.iterparse(fp, events=('start', 'end')):
+            if root is None:
+                root = el
 
-            # concatenate the relevant lines
-            if tag_found:
-                xml_string += line
+            if event == 'end':
+                # remove the namespace, ie. {http://www.hmdb.ca}metabolite becomes metabolite
+                if el.tag[0] == '{':
+                    el.tag = el.tag.rpartition('}')[2]
 
-            # did we read the end of the element
-            if end_tag in line:
-                # save the element in the list
-                yield xml_string
+                if el.tag == element:
+                    counter += 1
+                    if counter % 25000 == 0:
+                        self.logger.debug(f'Loaded {counter} metabolites...')
 
-                # reset the start flag
-                tag_found = False
+                    yield el
 
-                # reset the xml string
-                xml_string = ''
+                    # the caller is done with the element, free it and anything parsed before it
+                    root.clear()
 
         self.logger.debug(f'Loaded a total of {counter} metabolites.')
 
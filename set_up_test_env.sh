@@ -28,6 +28,26 @@ export PYTHONPATH="$PYTHONPATH:$PWD"
 #
 # export EDGE_NORMALIZATION_ENDPOINT=https://bl-lookup-sri.renci.org/
 # export NODE_NORMALIZATION_ENDPOINT=https://nodenormalization-sri.renci.org/
+# export NODE_NORMALIZATION_CONCURRENCY=4  # max node norm requests in flight at once, defaults to 1 (sequential)
+# export NODE_NORM_CACHE_VERSIONS_TO_KEEP=2  # node norm versions kept in the node norm cache in ORION_STORAGE
+# export ORION_INTERMEDIATE_FILE_COMPRESSION=zstd  # gzip or zstd (needs zstandard installed) for the kgx files of source pipelines
+# export KGX_NODE_DEDUP_STRATEGY=set  # set, hashed or exact, how parsers remember written node ids to skip repeats, sources with huge numbers of nodes use hashed regardless
+# export GTEX_PARSING_WORKERS=8  # processes used to parse the GTEx tissue files, defaults to 1 (main process)
+# export EDGE_NORMALIZATION_WORKERS=4  # processes used to normalize the edges of a source, defaults to 1 (main process)
+# export ORION_DOWNLOAD_CONNECTIONS=4  # connections used at once to download source data files, or the parts of one file
+# export ORION_DOWNLOAD_PART_SIZE=67108864  # bytes per part when downloading http files with range requests
+# export ORION_SOURCE_VERSION_WORKERS=8  # latest source versions retrieved at once when determining graph versions
+# export ORION_SOURCE_VERSION_TIMEOUT=300  # seconds allowed to retrieve the latest version of a source
+# export ORION_SOURCE_VERSION_CACHE_TTL=900  # seconds latest source versions are reused between runs, 0 to always check
+# export ORION_SOURCE_PIPELINE_WORKERS=4  # data source pipelines run at once when building graphs, resource hogs never run together
+# export DISK_MERGE_THRESHOLD_BYTES=21474836480  # merge on disk when the node or edge files to merge are bigger than this
+# export DISK_MERGE_CHUNK_SIZE=10000000  # entities per sorted temp file when merging large graphs on disk
+# export DISK_MERGE_WORKERS=1  # processes used to sort and write those temp files, defaults to 1 (main process)
+# export DISK_MERGE_COMPRESSION=zstd  # zlib, zstd or lz4 (the last two need zstandard or lz4 installed) for those temp files
+# export NEO4J_CSV_CONVERSION_WORKERS=8  # processes used to convert graphs to csv for neo4j, defaults to min(cpus, 8)
+# export MEMGRAPH_CYPHER_BATCH_SIZE=10000  # nodes or edges per UNWIND statement in memgraph cypher dumps
+# export MEMGRAPH_URI=bolt://localhost:7687  # a running memgraph, used to test importing memgraph cypher dumps
+# export PARQUET_ROWS_PER_FILE=250000  # max rows in each parquet file for the parquet graph output format
 # export NAMERES_URL=https://name-resolution-sri.renci.org/
 # export SAPBERT_URL=https://babel-sapbert.apps.renci.org/
 # export LITCOIN_PRED_MAPPING_URL=https://pred-mapping.apps.renci.org/
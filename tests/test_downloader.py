@@ -0,0 +1,225 @@
+import os
+import io
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import threading
+import pytest
+
+from ftplib import error_perm
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from Common import downloader
+from Common.downloader import FileDownloader, DownloadError, read_download_manifest, PARTIAL_DOWNLOAD_SUFFIX, \
+    PARTIAL_DOWNLOAD_STATE_SUFFIX
+from Common.utils import GetData, GetDataPullError
+
+TEMP_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) + '/workspace/downloader_test'
+
+TEST_FILES = {'/data.bin': os.urandom(1_000_000),
+              '/small.txt': b'a small file\n' * 100,
+              # served with Content-Encoding: gzip, like some servers do for .gz files
+              '/data.tsv.gz': gzip.compress(b'id\tvalue\n' + b'TEST:1\t1\n' * 100_000)}
+
+
+class StubFileRequestHandler(BaseHTTPRequestHandler):
+    # serves TEST_FILES, with or without range requests, and can cut off a response once to simulate an interruption
+    supports_ranges = True
+    interrupt_after_bytes = None
+    bytes_served = 0
+    lock = threading.Lock()
+
+    def do_HEAD(self):
+        self.send_file_headers()
+
+    def do_GET(self):
+        file_data = TEST_FILES.get(self.path, None)
+        if file_data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(file_data) - 1
+        range_match = re.match(r'bytes=(\d+)-(\d+)?', self.headers.get('Range', ''))
+        if range_match and self.supports_ranges:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2)) if range_match.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(file_data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_content_encoding_header()
+        self.end_headers()
+        response_data = file_data[start:end + 1]
+        with StubFileRequestHandler.lock:
+            interrupt_after_bytes = StubFileRequestHandler.interrupt_after_bytes
+            StubFileRequestHandler.interrupt_after_bytes = None
+        if interrupt_after_bytes is not None:
+            response_data = response_data[:interrupt_after_bytes]
+            self.close_connection = True
+        self.wfile.write(response_data)
+        with StubFileRequestHandler.lock:
+            StubFileRequestHandler.bytes_served += len(response_data)
+
+    def send_file_headers(self):
+        file_data = TEST_FILES.get(self.path, None)
+        if file_data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(file_data)))
+        self.send_header('ETag', f'"{hashlib.sha256(file_data).hexdigest()[:16]}"')
+        if self.supports_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_content_encoding_header()
+        self.end_headers()
+
+    def send_content_encoding_header(self):
+        if self.path.endswith('.gz'):
+            self.send_header('Content-Encoding', 'gzip')
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+@pytest.fixture
+def test_server_url():
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    StubFileRequestHandler.supports_ranges = True
+    StubFileRequestHandler.interrupt_after_bytes = None
+    StubFileRequestHandler.bytes_served = 0
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), StubFileRequestHandler)
+    server_thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    server_thread.start()
+    yield f'http://127.0.0.1:{http_server.server_address[1]}'
+    http_server.shutdown()
+    http_server.server_close()
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+
+
+def check_downloaded_file(file_name: str, server_path: str):
+    file_path = os.path.join(TEMP_DIRECTORY, file_name)
+    with open(file_path, 'rb') as downloaded_file:
+        assert downloaded_file.read() == TEST_FILES[server_path]
+    assert not os.path.exists(f'{file_path}{PARTIAL_DOWNLOAD_SUFFIX}')
+    assert not os.path.exists(f'{file_path}{PARTIAL_DOWNLOAD_STATE_SUFFIX}')
+    assert read_download_manifest(TEMP_DIRECTORY)[file_name]['size'] == len(TEST_FILES[server_path])
+    assert read_download_manifest(TEMP_DIRECTORY)[file_name]['sha256'] == \
+           hashlib.sha256(TEST_FILES[server_path]).hexdigest()
+
+
+def test_parallel_http_download(test_server_url):
+    file_downloader = FileDownloader(connections=4, part_size=100_000)
+    file_size = file_downloader.download_http(f'{test_server_url}/data.bin', os.path.join(TEMP_DIRECTORY, 'data.bin'))
+    assert file_size == len(TEST_FILES['/data.bin'])
+    check_downloaded_file('data.bin', '/data.bin')
+
+    # multiple files at once, and the same without range requests
+    StubFileRequestHandler.supports_ranges = False
+    file_downloader.download_http_files([f'{test_server_url}/data.bin', f'{test_server_url}/small.txt'],
+                                        TEMP_DIRECTORY,
+                                        file_names=['data_2.bin', 'small.txt'])
+    check_downloaded_file('data_2.bin', '/data.bin')
+    check_downloaded_file('small.txt', '/small.txt')
+
+
+def test_content_encoded_http_download(test_server_url):
+    # the file is saved as it is on the server, not decompressed
+    for supports_ranges, connections in [(True, 4), (False, 1)]:
+        StubFileRequestHandler.supports_ranges = supports_ranges
+        file_downloader = FileDownloader(connections=connections, part_size=len(TEST_FILES['/data.tsv.gz']) // 3)
+        file_downloader.download_http(f'{test_server_url}/data.tsv.gz', os.path.join(TEMP_DIRECTORY, 'data.tsv.gz'))
+        check_downloaded_file('data.tsv.gz', '/data.tsv.gz')
+        with gzip.open(os.path.join(TEMP_DIRECTORY, 'data.tsv.gz')) as downloaded_file:
+            assert downloaded_file.readline() == b'id\tvalue\n'
+        os.remove(os.path.join(TEMP_DIRECTORY, 'data.tsv.gz'))
+
+
+def test_resume_http_download(test_server_url):
+    file_path = os.path.join(TEMP_DIRECTORY, 'data.bin')
+    file_downloader = FileDownloader(connections=1, part_size=300_000)
+    # the connection closes part way through the first part
+    StubFileRequestHandler.interrupt_after_bytes = 250_000
+    with pytest.raises(DownloadError):
+        file_downloader.download_http(f'{test_server_url}/data.bin', file_path)
+    assert not os.path.exists(file_path)
+    assert os.path.exists(f'{file_path}{PARTIAL_DOWNLOAD_SUFFIX}')
+    with open(f'{file_path}{PARTIAL_DOWNLOAD_STATE_SUFFIX}') as state_file:
+        # everything that was read before the connection closed, besides the last read, was saved
+        downloaded_bytes = json.load(state_file)['parts'][0][2]
+    assert 250_000 - downloader.DOWNLOAD_READ_SIZE < downloaded_bytes <= 250_000
+
+    # the download picks up where it left off
+    StubFileRequestHandler.bytes_served = 0
+    file_downloader.download_http(f'{test_server_url}/data.bin', file_path)
+    assert StubFileRequestHandler.bytes_served == len(TEST_FILES['/data.bin']) - downloaded_bytes
+    check_downloaded_file('data.bin', '/data.bin')
+
+
+def test_get_data_pull_via_http(test_server_url):
+    gd = GetData()
+    assert gd.pull_via_http(f'{test_server_url}/small.txt', TEMP_DIRECTORY) == len(TEST_FILES['/small.txt'])
+    # files that were already retrieved aren't retrieved again
+    assert gd.pull_via_http(f'{test_server_url}/small.txt', TEMP_DIRECTORY) == 1
+    assert gd.pull_via_http_files([f'{test_server_url}/small.txt'], TEMP_DIRECTORY) == 1
+    check_downloaded_file('small.txt', '/small.txt')
+    with pytest.raises(GetDataPullError):
+        gd.pull_via_http(f'{test_server_url}/missing.txt', TEMP_DIRECTORY)
+    assert not os.path.exists(os.path.join(TEMP_DIRECTORY, 'missing.txt'))
+
+
+class StubFTP:
+    # serves TEST_FILES from memory, with the parts of ftplib.FTP that the downloader uses
+    connections = []
+
+    def __init__(self, ftp_site, timeout=None):
+        self.retrieved_bytes = 0
+        StubFTP.connections.append(self)
+
+    def login(self):
+        pass
+
+    def cwd(self, ftp_dir):
+        pass
+
+    def voidcmd(self, command):
+        return '200 OK'
+
+    def size(self, ftp_file):
+        if f'/{ftp_file}' not in TEST_FILES:
+            raise error_perm('550 No such file')
+        return len(TEST_FILES[f'/{ftp_file}'])
+
+    def retrbinary(self, command, callback, blocksize=8192, rest=None):
+        file_data = io.BytesIO(TEST_FILES[f'/{command.split()[1]}'][rest if rest else 0:])
+        while buffer := file_data.read(blocksize):
+            self.retrieved_bytes += len(buffer)
+            callback(buffer)
+
+    def quit(self):
+        pass
+
+
+def test_ftp_downloads(monkeypatch):
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    monkeypatch.setattr(downloader, 'FTP', StubFTP)
+    StubFTP.connections = []
+    # part of data.bin was downloaded before
+    with open(os.path.join(TEMP_DIRECTORY, f'data.bin{PARTIAL_DOWNLOAD_SUFFIX}'), 'wb') as partial_file:
+        partial_file.write(TEST_FILES['/data.bin'][:400_000])
+
+    gd = GetData()
+    gd.downloader = FileDownloader(connections=2)
+    assert gd.pull_via_ftp('ftp.test.org', '/pub/', ['data.bin', 'small.txt'], TEMP_DIRECTORY) == 2
+    check_downloaded_file('data.bin', '/data.bin')
+    check_downloaded_file('small.txt', '/small.txt')
+    assert sum(ftp.retrieved_bytes for ftp in StubFTP.connections) == \
+           len(TEST_FILES['/data.bin']) - 400_000 + len(TEST_FILES['/small.txt'])
+    assert read_download_manifest(TEMP_DIRECTORY)['small.txt']['url'] == 'ftp://ftp.test.org/pub/small.txt'
+
+    with pytest.raises(GetDataPullError):
+        gd.pull_via_ftp('ftp.test.org', '/pub/', ['missing.txt'], TEMP_DIRECTORY)
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
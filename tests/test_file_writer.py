@@ -1,7 +1,15 @@
 
 import os
-from Common.utils import quick_jsonl_file_iterator
-from Common.kgx_file_writer import KGXFileWriter
+import sys
+import time
+import pytest
+import logging
+import jsonlines
+from Common.utils import quick_jsonl_file_iterator, get_kgx_file_compression, add_kgx_file_compression_extension, \
+    zstandard
+from Common import kgx_file_writer
+from Common.kgx_file_writer import KGXFileWriter, HashedNodeIdSet, ConnectedNodeBitmap, NODE_DEDUP_STRATEGIES
+from Common.kgx_file_normalizer import remove_unconnected_nodes, write_connected_nodes
 from Common.kgxmodel import kgxnode, kgxedge
 from Common.biolink_constants import *
 
@@ -14,6 +22,8 @@ edges_file_path = test_workspace_dir + 'test_edges.jsonl'
 
 TEST_BUFFER_SIZE = 475
 
+logger = logging.getLogger(__name__)
+
 
 # TODO use kgx validation logic
 def is_valid_nodes_file(file_path: str):
@@ -167,3 +177,190 @@ def test_writing_json_lines():
     assert count_lines(edges_file_path) == 500
     remove_old_files()
 
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', pytest.param('zstd', marks=pytest.mark.skipif(
+    zstandard is None, reason='zstandard is not installed'))])
+def test_writing_compressed_files(compression):
+    compressed_nodes_file_path = add_kgx_file_compression_extension(nodes_file_path, compression)
+    compressed_edges_file_path = add_kgx_file_compression_extension(edges_file_path, compression)
+    with KGXFileWriter(compressed_nodes_file_path, compressed_edges_file_path) as test_file_writer:
+        for i in range(1, 101):
+            test_file_writer.write_node(f'TEST:{i}', f'Test Node {i}', [NAMED_THING])
+        for i in range(1, 51):
+            test_file_writer.write_edge(subject_id=f'TEST:{i}',
+                                        object_id=f'TEST:{i + 1}',
+                                        predicate='biolink:related_to',
+                                        primary_knowledge_source='infores:testing')
+    assert get_kgx_file_compression(compressed_nodes_file_path) == compression
+    assert is_valid_nodes_file(compressed_nodes_file_path)
+    assert is_valid_edges_file(compressed_edges_file_path)
+    if compression:
+        with open(compressed_nodes_file_path, 'rb') as compressed_file:
+            assert not compressed_file.read().startswith(b'{')
+
+    # the nodes file gets rewritten in place, and should keep its compression
+    assert remove_unconnected_nodes(compressed_nodes_file_path, compressed_edges_file_path) == 49
+    assert [node['id'] for node in quick_jsonl_file_iterator(compressed_nodes_file_path)] == \
+           [f'TEST:{i}' for i in range(1, 52)]
+    os.remove(compressed_nodes_file_path)
+    os.remove(compressed_edges_file_path)
+
+
+def test_writing_serialized_lines():
+    remove_old_files()
+    with KGXFileWriter(nodes_file_path, edges_file_path) as test_file_writer:
+        test_file_writer.write_nodes([{'id': 'TEST:1', 'name': 'Test Node 1', 'category': [NAMED_THING]},
+                                      {'id': 'TEST:1', 'name': 'Test Node 1', 'category': [NAMED_THING]},
+                                      b'{"id": "TEST:2", "name": "Test Node 2", "category": ["biolink:NamedThing"]}\n',
+                                      {'id': 'TEST:3', 'name': 'Test Node é', 'category': [NAMED_THING],
+                                       'big_number': 2 ** 70}])
+        test_file_writer.write_edges([{SUBJECT_ID: 'TEST:1', PREDICATE: 'biolink:related_to', OBJECT_ID: 'TEST:2'},
+                                      b'{"subject": "TEST:2", "predicate": "biolink:related_to", "object": "TEST:3"}'])
+    assert test_file_writer.nodes_written == 3
+    assert test_file_writer.repeat_node_count == 1
+    assert test_file_writer.edges_written == 2
+    nodes = list(quick_jsonl_file_iterator(nodes_file_path))
+    assert [node['id'] for node in nodes] == ['TEST:1', 'TEST:2', 'TEST:3']
+    assert nodes[2]['name'] == 'Test Node é' and nodes[2]['big_number'] == 2 ** 70
+    assert [edge[OBJECT_ID] for edge in quick_jsonl_file_iterator(edges_file_path)] == ['TEST:2', 'TEST:3']
+    remove_old_files()
+
+
+def test_writer_throughput_benchmark():
+    # the original writer backend, a jsonlines writer with a write call for every line
+    def reference_write(file_path, entities):
+        with open(file_path, 'w') as output_file:
+            jsonl_writer = jsonlines.Writer(output_file)
+            for entity in entities:
+                jsonl_writer.write(entity)
+            jsonl_writer.close()
+
+    test_edges = [{SUBJECT_ID: f'NCBIGene:{i % 5000}',
+                   PREDICATE: 'biolink:affects',
+                   OBJECT_ID: f'CHEBI:{i % 3000}',
+                   PRIMARY_KNOWLEDGE_SOURCE: 'infores:ctd',
+                   AGGREGATOR_KNOWLEDGE_SOURCES: ['infores:aragorn'],
+                   PUBLICATIONS: [f'PMID:{i}', f'PMID:{i + 1}'],
+                   'p_value': i / 100_000,
+                   'negated': False}
+                  for i in range(100_000)]
+
+    remove_old_files()
+    start_time = time.perf_counter()
+    reference_write(edges_file_path, test_edges)
+    reference_time = time.perf_counter() - start_time
+    reference_edges = list(quick_jsonl_file_iterator(edges_file_path))
+
+    remove_old_files()
+    start_time = time.perf_counter()
+    with KGXFileWriter(edges_output_file_path=edges_file_path) as test_file_writer:
+        test_file_writer.write_edges(test_edges)
+    elapsed_time = time.perf_counter() - start_time
+
+    # the timings depend on the machine, they're only reported, run pytest with --log-cli-level=INFO to see them
+    logger.info(f'KGXFileWriter: {len(test_edges) / reference_time:.0f} lines/second before, '
+                f'{len(test_edges) / elapsed_time:.0f} lines/second now')
+    assert list(quick_jsonl_file_iterator(edges_file_path)) == reference_edges
+    remove_old_files()
+
+
+@pytest.mark.parametrize('node_dedup_strategy', NODE_DEDUP_STRATEGIES)
+def test_node_dedup_strategies(node_dedup_strategy):
+    remove_old_files()
+    with KGXFileWriter(nodes_file_path, node_dedup_strategy=node_dedup_strategy) as test_file_writer:
+        for i in range(50_000):
+            test_file_writer.write_node(f'TEST:{i % 20_000}', f'Test Node {i % 20_000}', [NAMED_THING])
+        assert 'TEST:19999' in test_file_writer.written_nodes
+        assert 'TEST:20000' not in test_file_writer.written_nodes
+        assert len(test_file_writer.written_nodes) == 20_000
+    assert test_file_writer.nodes_written == 20_000
+    assert test_file_writer.repeat_node_count == 30_000
+    assert count_lines(nodes_file_path) == 20_000
+    assert not os.path.exists(f'{nodes_file_path}.node_ids.db')
+    remove_old_files()
+
+
+def test_exact_node_dedup_with_hash_collisions(monkeypatch):
+    # make every id hash to one of a few values, the exact check needs to tell them apart
+    monkeypatch.setattr(kgx_file_writer, 'xxh64_intdigest', lambda node_id: int(node_id.split(':')[1]) % 3 + 1)
+    monkeypatch.setattr(kgx_file_writer, 'EXACT_NODE_ID_BATCH_SIZE', 10)
+    node_ids = HashedNodeIdSet(exact_check_file_path=os.path.join(test_workspace_dir, 'test_node_ids.db'))
+    for i in range(100):
+        node_ids.add(f'TEST:{i}')
+        node_ids.add(f'TEST:{i}')
+    assert len(node_ids) == 100
+    assert all(f'TEST:{i}' in node_ids for i in range(100))
+    assert 'TEST:100' not in node_ids
+    node_ids.close()
+
+    # without the exact check the collisions are mistaken for repeats
+    node_ids = HashedNodeIdSet()
+    for i in range(100):
+        node_ids.add(f'TEST:{i}')
+    assert len(node_ids) == 3
+
+
+def test_hashed_node_dedup_memory():
+    node_count = 200_000
+    node_ids = [f'NCBIGene:{i}' for i in range(node_count)]
+    written_nodes = set()
+    hashed_written_nodes = HashedNodeIdSet()
+    for node_id in node_ids:
+        written_nodes.add(node_id)
+        hashed_written_nodes.add(node_id)
+    assert len(hashed_written_nodes) == len(written_nodes) == node_count
+    assert all(node_id in hashed_written_nodes for node_id in node_ids[::1000])
+    # a set keeps every id string, the hashed set only keeps a table of 64 bit hashes
+    set_size = sys.getsizeof(written_nodes) + sum(sys.getsizeof(node_id) for node_id in written_nodes)
+    hashed_set_size = sys.getsizeof(hashed_written_nodes.table)
+    assert hashed_set_size < set_size / 2
+
+
+def test_connected_node_bitmap_count():
+    connected_node_bitmap = ConnectedNodeBitmap()
+    for i in range(1000):
+        connected_node_bitmap.add_node(f'TEST:{i}')
+    # every bit of some bytes, and the first and last bits of the others
+    connected_positions = {position for position in range(1000) if (position >> 3) % 5 == 0 or position % 8 in (0, 7)}
+    for position in connected_positions:
+        connected_node_bitmap.mark_connected(f'TEST:{position}')
+    assert connected_node_bitmap.connected_count() == len(connected_positions) == \
+           sum(connected_node_bitmap.is_connected(position) for position in range(1000))
+
+
+def test_connected_node_bitmap(monkeypatch):
+    remove_old_files()
+    connected_node_bitmap = ConnectedNodeBitmap(initial_capacity=4)
+    with KGXFileWriter(nodes_file_path, connected_node_bitmap=connected_node_bitmap) as test_file_writer:
+        for i in range(1000):
+            test_file_writer.write_node(f'TEST:{i % 500}', f'Test Node {i % 500}', [NAMED_THING])
+    # only the nodes actually written are added, in the order they were written
+    assert len(connected_node_bitmap) == 500
+    for i in range(0, 500, 3):
+        connected_node_bitmap.mark_connected(f'TEST:{i}')
+    connected_node_bitmap.mark_connected('TEST:not_written')
+    assert connected_node_bitmap.connected_count() == 167
+    assert connected_node_bitmap.is_connected(3) and not connected_node_bitmap.is_connected(4)
+
+    # nodes connected in a copy, like one in another process, can be added back
+    other_bitmap = ConnectedNodeBitmap()
+    for i in range(500):
+        other_bitmap.add_node(f'TEST:{i}')
+    other_bitmap.mark_connected('TEST:499')
+    connected_node_bitmap.update(other_bitmap.bitmap)
+    assert connected_node_bitmap.connected_count() == 168
+
+    output_file_path = os.path.join(test_workspace_dir, 'test_connected_nodes.jsonl')
+    assert write_connected_nodes(nodes_file_path, output_file_path, connected_node_bitmap) == 332
+    assert not os.path.exists(nodes_file_path)
+    assert [node['id'] for node in quick_jsonl_file_iterator(output_file_path)] == \
+           [f'TEST:{i}' for i in range(500) if i % 3 == 0 or i == 499]
+    os.remove(output_file_path)
+
+    # nodes with the same hash as another node can't be told apart, so they're kept
+    monkeypatch.setattr(kgx_file_writer, 'xxh64_intdigest', lambda node_id: int(node_id.split(':')[1]) % 3 + 1)
+    connected_node_bitmap = ConnectedNodeBitmap()
+    for i in range(10):
+        connected_node_bitmap.add_node(f'TEST:{i}')
+    assert connected_node_bitmap.connected_count() == 7
@@ -0,0 +1,88 @@
+import os
+import json
+
+from Common import graph_analysis, kgx_validation, meta_kg
+from Common.biolink_constants import *
+from Common.biolink_utils import BiolinkUtils, INFORES_STATUS_VALID, INFORES_STATUS_INVALID
+from Common.graph_analysis import GraphAnalyzer
+from Common.kgx_validation import GraphQCConsumer
+from Common.meta_kg import MetaKnowledgeGraphBuilder
+
+
+class StubInformationResources:
+    def get_infores_status(self, infores_id):
+        return INFORES_STATUS_VALID if infores_id == 'infores:test' else INFORES_STATUS_INVALID
+
+
+def write_test_graph(test_directory: str):
+    nodes = [{'id': f'NCBIGene:{i}', 'name': f'Gene {i}', NODE_TYPES: [NAMED_THING, 'biolink:Gene']}
+             for i in range(10)]
+    nodes += [{'id': f'CHEBI:{i}', 'name': f'Chemical {i}', NODE_TYPES: ['biolink:SmallMolecule'], 'mass': i}
+              for i in range(10)]
+    edges = [{SUBJECT_ID: f'CHEBI:{i}',
+              PREDICATE: 'biolink:affects',
+              OBJECT_ID: f'NCBIGene:{i}',
+              PRIMARY_KNOWLEDGE_SOURCE: 'infores:test' if i % 2 else 'infores:not_real',
+              OBJECT_ASPECT_QUALIFIER: 'activity',
+              PUBLICATIONS: [f'PMID:{i}'] if i % 3 else []}
+             for i in range(10)]
+    nodes_file_path = os.path.join(test_directory, 'graph_analysis_nodes.jsonl')
+    edges_file_path = os.path.join(test_directory, 'graph_analysis_edges.jsonl')
+    with open(nodes_file_path, 'w') as nodes_file:
+        nodes_file.writelines(f'{json.dumps(node)}\n' for node in nodes)
+    with open(edges_file_path, 'w') as edges_file:
+        edges_file.writelines(f'{json.dumps(edge)}\n' for edge in edges)
+    return nodes_file_path, edges_file_path
+
+
+def test_single_pass_graph_analysis(monkeypatch, tmp_path):
+    monkeypatch.setattr(kgx_validation, 'BiolinkInformationResources', StubInformationResources)
+    nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+
+    # count how many times the files are read
+    files_read = []
+    original_file_iterator = graph_analysis.quick_jsonl_file_iterator
+
+    def counting_file_iterator(file_path):
+        files_read.append(file_path)
+        return original_file_iterator(file_path)
+    monkeypatch.setattr(graph_analysis, 'quick_jsonl_file_iterator', counting_file_iterator)
+
+    # count how many times the biolink model is loaded
+    bl_utils_created = []
+
+    class CountingBiolinkUtils(BiolinkUtils):
+        def __init__(self):
+            bl_utils_created.append(self)
+            super().__init__()
+    for module in [graph_analysis, kgx_validation, meta_kg]:
+        monkeypatch.setattr(module, 'BiolinkUtils', CountingBiolinkUtils)
+
+    graph_analyzer = GraphAnalyzer(nodes_file_path=nodes_file_path, edges_file_path=edges_file_path)
+    qc_consumer = GraphQCConsumer(graph_id='test_graph', graph_version='1', bl_utils=graph_analyzer.bl_utils)
+    meta_kg_builder = MetaKnowledgeGraphBuilder(bl_utils=graph_analyzer.bl_utils)
+    graph_analyzer.register_consumer(qc_consumer)
+    graph_analyzer.register_consumer(meta_kg_builder)
+    graph_analyzer.analyze()
+    assert files_read == [nodes_file_path, edges_file_path]
+    assert len(bl_utils_created) == 1
+    assert graph_analyzer.node_leaf_types['NCBIGene:1'] == {'biolink:Gene'}
+
+    qc_results = qc_consumer.get_qc_results()
+    assert qc_results['predicate_totals'] == {'biolink:affects': 10}
+    assert qc_results['node_curie_prefixes'] == {'NCBIGene': 10, 'CHEBI': 10}
+    assert qc_results['edges_with_publications'] == {'biolink:affects': 6}
+    assert qc_results['warnings']['invalid_knowledge_sources'] == ['infores:not_real']
+
+    # the meta kg should be the same as one built from its own scan of the files
+    standalone_meta_kg_builder = MetaKnowledgeGraphBuilder(nodes_file_path=nodes_file_path,
+                                                           edges_file_path=edges_file_path)
+    assert len(files_read) == 4
+    assert len(bl_utils_created) == 2
+    assert meta_kg_builder.meta_kg == standalone_meta_kg_builder.meta_kg
+    assert meta_kg_builder.testing_data == standalone_meta_kg_builder.testing_data
+    assert meta_kg_builder.example_edges == standalone_meta_kg_builder.example_edges
+    assert set(meta_kg_builder.meta_kg['nodes'].keys()) == {'biolink:Gene', 'biolink:SmallMolecule'}
+    assert len(meta_kg_builder.testing_data['edges']) == 1
+    assert meta_kg_builder.testing_data['edges'][0]['qualifiers'] == [
+        {'qualifier_type_id': 'biolink:object_aspect_qualifier', 'qualifier_value': 'activity'}]
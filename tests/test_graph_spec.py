@@ -1,9 +1,12 @@
 import os
+import threading
 import pytest
 import requests.exceptions
 
 from unittest.mock import MagicMock
+from Common import load_manager
 from Common.build_manager import GraphBuilder, GraphSpecError
+from Common.load_manager import SourceDataManager
 
 
 def clear_graph_spec_config():
@@ -116,3 +119,83 @@ def test_graph_spec_invalid_subgraph_version():
     testing_graph_spec = graph_builder.graph_specs.get('Testing_Graph_4', None)
     graph_builder.determine_graph_version(testing_graph_spec)
     assert graph_builder.build_graph(testing_graph_spec) is False
+
+
+# latest source versions for a graph and its subgraph are retrieved at the same time
+def test_graph_spec_concurrent_versions():
+    reset_graph_spec_config()
+    graph_builder = GraphBuilder(graph_specs_dir=get_testing_graph_spec_dir(), source_version_workers=3)
+    graph_builder.source_data_manager = get_source_data_manager_mock()
+
+    # every lookup waits for the other two, so the barrier only gets through if all three run at the same time
+    lookup_barrier = threading.Barrier(3)
+
+    def get_concurrent_latest_source_version(source_id):
+        lookup_barrier.wait(timeout=30)
+        return source_id + '_v1'
+    graph_builder.source_data_manager.get_latest_source_version.side_effect = get_concurrent_latest_source_version
+
+    testing_graph_spec = graph_builder.graph_specs.get('Testing_Graph_2', None)
+    graph_builder.determine_graph_version(testing_graph_spec)
+    assert not lookup_barrier.broken
+    assert graph_builder.source_data_manager.get_latest_source_version.call_count == 3
+    for graph_id in ['Testing_Graph', 'Testing_Graph_2']:
+        for source in graph_builder.graph_specs[graph_id].sources:
+            assert source.source_version == source.id + '_v1'
+
+
+# a source that takes too long to return its latest version fails the graph version
+def test_graph_spec_version_timeout():
+    reset_graph_spec_config()
+    graph_builder = GraphBuilder(graph_specs_dir=get_testing_graph_spec_dir(), source_version_timeout=1)
+    graph_builder.source_data_manager = get_source_data_manager_mock()
+
+    # the CTD lookup hangs until it's released at the end of the test
+    release_lookup = threading.Event()
+    hanging_lookup_threads = []
+
+    def get_hanging_latest_source_version(source_id):
+        if source_id == 'CTD':
+            hanging_lookup_threads.append(threading.current_thread())
+            release_lookup.wait(timeout=30)
+        return source_id + '_v1'
+    graph_builder.source_data_manager.get_latest_source_version.side_effect = get_hanging_latest_source_version
+
+    testing_graph_spec = graph_builder.graph_specs.get('Testing_Graph', None)
+    with pytest.raises(GraphSpecError) as error:
+        graph_builder.determine_graph_version(testing_graph_spec)
+    assert 'Timed out after 1 seconds' in error.value.error_message and 'CTD' in error.value.error_message
+    assert graph_builder.latest_source_versions == {'HGNC': 'HGNC_v1'}
+    # the lookup thread was abandoned while still waiting on CTD, it's a daemon so it can't keep the process running
+    assert len(hanging_lookup_threads) == 1
+    assert hanging_lookup_threads[0].is_alive() and hanging_lookup_threads[0].daemon
+    release_lookup.set()
+    hanging_lookup_threads[0].join()
+
+
+# latest source versions are kept in ORION_STORAGE for a little while, so other runs don't retrieve them again
+def test_latest_source_version_cache(monkeypatch):
+    retrieved_versions = []
+
+    class StubLoader:
+        def __init__(self, test_mode=False):
+            pass
+
+        def get_latest_source_version(self):
+            retrieved_versions.append('v1')
+            return 'v1'
+
+    monkeypatch.setattr(load_manager, 'SOURCE_DATA_LOADER_CLASSES', {'Stub_Source': StubLoader})
+    source_data_manager = SourceDataManager()
+    versions_file_path = source_data_manager.get_latest_source_versions_file_path()
+    if os.path.exists(versions_file_path):
+        os.remove(versions_file_path)
+
+    assert source_data_manager.get_latest_source_version('Stub_Source') == 'v1'
+    assert SourceDataManager().get_latest_source_version('Stub_Source') == 'v1'
+    assert len(retrieved_versions) == 1
+    # once the ttl passes, or in fresh start mode, the version is retrieved again
+    assert SourceDataManager(latest_source_version_cache_ttl=0).get_latest_source_version('Stub_Source') == 'v1'
+    assert SourceDataManager(fresh_start_mode=True).get_latest_source_version('Stub_Source') == 'v1'
+    assert len(retrieved_versions) == 3
+    os.remove(versions_file_path)
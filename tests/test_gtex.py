@@ -52,4 +52,78 @@ def old_test_gtex_load():
             os.remove(os.path.join(test_dir, 'gtex_test_edges.json'))
         if os.path.isfile(os.path.join(test_dir, 'gtex_test_nodes.json')):
             os.remove(os.path.join(test_dir, 'gtex_test_nodes.json'))
-"""
\ No newline at end of file
+"""
+
+import io
+import gzip
+import shutil
+import tarfile
+
+from Common.kgx_file_writer import KGXFileWriter
+from parsers.GTEx.src import loadGTEx
+from parsers.GTEx.src.loadGTEx import GTExLoader
+
+TEMP_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) + '/workspace/gtex_test'
+
+
+def write_gtex_tar(tar_path: str, is_sqtl: bool = False):
+    header = '\t'.join(f'column_{i}' for i in range(12))
+    qtl_type = 'sQTL' if is_sqtl else 'eQTL'
+    with tarfile.open(tar_path, 'w') as tar_file:
+        for tissue_index, tissue_name in enumerate(['Brain_Cortex', 'Liver', 'Not_A_Tissue', 'Whole_Blood']):
+            lines = [header]
+            for i in range(200):
+                # variants and genes repeat within and across tissues
+                variant = f'chr{(i % 3) + 1}_{1000 + (i * 7 + tissue_index * 50) % 400}_A_G_b38'
+                if i % 50 == 0:
+                    # a chromosome without a reference sequence, the variant can't be converted
+                    variant = f'chr30_{i}_A_G_b38'
+                gene = f'ENSG{(i * 11 + tissue_index) % 60:011}.4'
+                if is_sqtl:
+                    gene = f'chr1:100:200:clu_{i}:{gene}'
+                slope = -0.5 if i % 4 else 0.5
+                lines.append('\t'.join([variant, gene, '0', '0', '0', '0', f'1e-{i % 9 + 1}', str(slope),
+                                        '0', '0', '0', '0']))
+            lines.append('too\tfew\tcolumns')
+            tissue_file_name = f'GTEx_Analysis_v8_{qtl_type}/{tissue_name}.v8.signif_variant_gene_pairs.txt.gz'
+            tissue_file_data = gzip.compress(('\n'.join(lines) + '\n').encode())
+            tissue_file_info = tarfile.TarInfo(tissue_file_name)
+            tissue_file_info.size = len(tissue_file_data)
+            tar_file.addfile(tissue_file_info, io.BytesIO(tissue_file_data))
+
+
+def test_gtex_parallel_parsing_matches_serial(monkeypatch):
+    # small batches, so variants are converted to hgvs in many batches
+    monkeypatch.setattr(loadGTEx, 'GTEX_HGVS_CONVERSION_BATCH_SIZE', 64)
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    eqtl_tar_path = os.path.join(TEMP_DIRECTORY, 'eqtl.tar')
+    sqtl_tar_path = os.path.join(TEMP_DIRECTORY, 'sqtl.tar')
+    write_gtex_tar(eqtl_tar_path)
+    write_gtex_tar(sqtl_tar_path, is_sqtl=True)
+
+    output_files = {}
+    parsing_metadata = {}
+    for workers in [1, 3]:
+        gtex_loader = GTExLoader(source_data_dir=TEMP_DIRECTORY)
+        gtex_loader.parsing_workers = workers
+        nodes_file_path = os.path.join(TEMP_DIRECTORY, f'nodes_{workers}.jsonl')
+        edges_file_path = os.path.join(TEMP_DIRECTORY, f'edges_{workers}.jsonl')
+        load_metadata = {'record_counter': 0, 'skipped_record_counter': 0}
+        with KGXFileWriter(nodes_file_path, edges_file_path) as output_file_writer:
+            gtex_loader.output_file_writer = output_file_writer
+            gtex_loader.parse_gtex_tar(eqtl_tar_path, load_metadata)
+            gtex_loader.parse_gtex_tar(sqtl_tar_path, load_metadata, is_sqtl=True)
+        with open(nodes_file_path) as nodes_file, open(edges_file_path) as edges_file:
+            output_files[workers] = (nodes_file.read(), edges_file.read())
+        parsing_metadata[workers] = (load_metadata, sorted(gtex_loader.variants_that_failed_hgvs_conversion))
+
+    # three tissues in each tar, with four unconvertable variants each
+    assert parsing_metadata[1][0] == {'record_counter': 2 * 3 * 196, 'skipped_record_counter': 2 * 3 * 4}
+    assert parsing_metadata[3] == parsing_metadata[1]
+    assert output_files[3] == output_files[1]
+    nodes = [json.loads(node_line) for node_line in output_files[1][0].splitlines()]
+    assert len(nodes) == len({node['id'] for node in nodes})
+    assert not [file_name for file_name in os.listdir(os.path.join(TEMP_DIRECTORY, 'source'))
+                if 'shards' in file_name]
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
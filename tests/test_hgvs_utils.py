@@ -0,0 +1,37 @@
+import itertools
+import pytest
+import polars as pl
+
+from Common.hgvs_utils import convert_variant_to_hgvs, convert_variants_to_hgvs
+
+
+def test_convert_variants_to_hgvs_matches_scalar():
+    chromosomes = ['1', '22', 'X', 'Y', '23', '25', '0', '07', 3, ' 4']
+    alleles = ['A', 'C', 'G', '.', '<DEL>', '', 'AC', 'CA', 'ACG', 'ACGTT', 'AG']
+    reference_builds = [('b38', 'p1'), ('b37', 'p1'), ('GRCh38', 'p13'), ('GRCh38', 'p1'), ('hg19', 'p1')]
+    variants = [(chromosome, 1_000_000 + i, ref_allele, alt_allele, reference_genome, reference_patch)
+                for i, (chromosome, ref_allele, alt_allele, (reference_genome, reference_patch))
+                in enumerate(itertools.product(chromosomes, alleles, alleles, reference_builds))]
+    expected_hgvs = [convert_variant_to_hgvs(*variant) for variant in variants]
+    assert any(expected_hgvs) and not all(expected_hgvs)
+
+    chromosome_column, positions, ref_alleles, alt_alleles, reference_genomes, reference_patches = zip(*variants)
+    hgvs = convert_variants_to_hgvs(chromosome_column, positions, ref_alleles, alt_alleles,
+                                    reference_genomes=reference_genomes, reference_patches=reference_patches)
+    assert hgvs.to_list() == expected_hgvs
+
+    # polars columns and a single reference build work too
+    b38_variants = [variant for variant in variants if variant[4] == 'b38' and isinstance(variant[0], str)]
+    hgvs = convert_variants_to_hgvs(pl.Series([variant[0] for variant in b38_variants]),
+                                    pl.Series([variant[1] for variant in b38_variants]),
+                                    pl.Series([variant[2] for variant in b38_variants]),
+                                    pl.Series([variant[3] for variant in b38_variants]))
+    assert hgvs.to_list() == [convert_variant_to_hgvs(*variant) for variant in b38_variants]
+
+
+def test_convert_variants_to_hgvs_invalid_chromosome():
+    # the scalar version raises a ValueError for chromosomes that aren't numbers, X or Y, and so does the batch version
+    with pytest.raises(ValueError):
+        convert_variant_to_hgvs('Z', 100, 'A', 'C')
+    with pytest.raises(ValueError):
+        convert_variants_to_hgvs(['1', 'Z'], [100, 200], ['A', 'A'], ['C', 'C'])
@@ -0,0 +1,158 @@
+import os
+import time
+import shutil
+import tracemalloc
+import xml.etree.ElementTree as E_Tree
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from Common.kgx_file_writer import KGXFileWriter
+from parsers.hmdb.src.loadHMDB import HMDBLoader
+
+TEMP_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) + '/workspace/hmdb_test'
+
+# set this to the path of a real hmdb_metabolites.zip to benchmark parsing the full file
+HMDB_BENCHMARK_FILE = os.environ.get('HMDB_BENCHMARK_FILE', None)
+
+
+def write_hmdb_zip(zip_path: str, metabolite_count: int, concentration_count: int = 5):
+    # metabolites like the ones in hmdb_metabolites.xml, with a namespace and lots of elements that aren't parsed
+    with ZipFile(zip_path, 'w', compression=ZIP_DEFLATED) as zip_file:
+        with zip_file.open('hmdb_metabolites.xml', 'w') as xml_file:
+            xml_file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<hmdb xmlns="http://www.hmdb.ca">\n')
+            for i in range(metabolite_count):
+                lines = ['<metabolite>',
+                         '  <version>5.0</version>',
+                         # every tenth metabolite has no accession
+                         f'  <accession>HMDB{i:07}</accession>' if i % 10 else '  <accession></accession>',
+                         f'  <name>Metabolite {i} &amp; café</name>',
+                         '  <normal_concentrations>']
+                for j in range(concentration_count):
+                    lines += ['    <concentration>',
+                              '      <biospecimen>Blood</biospecimen>',
+                              f'      <concentration_value>{j}.5 +/- 0.1</concentration_value>',
+                              '      <subject_condition>Normal</subject_condition>',
+                              '    </concentration>']
+                lines += ['  </normal_concentrations>',
+                          '  <biological_properties>',
+                          '    <pathways>']
+                if i % 3 == 0:
+                    lines += ['      <pathway>',
+                              f'        <name>Pathway {i % 50}</name>',
+                              f'        <smpdb_id>SMP{i % 50:05}</smpdb_id>',
+                              '      </pathway>']
+                lines += ['    </pathways>',
+                          '  </biological_properties>',
+                          '  <diseases>']
+                if i % 4 == 0:
+                    lines += ['    <disease>',
+                              f'      <name>Disease {i % 30}</name>',
+                              f'      <omim_id>{600000 + i % 30}</omim_id>',
+                              '      <references>',
+                              f'        <reference><pubmed_id>{i}</pubmed_id></reference>',
+                              '      </references>',
+                              '    </disease>']
+                lines += ['  </diseases>',
+                          '  <protein_associations>']
+                if i % 5 == 0:
+                    for protein_type in ['Enzyme', 'Transporter', 'Unknown']:
+                        lines += ['    <protein>',
+                                  f'      <name>{protein_type} {i % 40}</name>',
+                                  f'      <uniprot_id>P{i % 40:05}</uniprot_id>',
+                                  f'      <protein_type>{protein_type}</protein_type>',
+                                  '    </protein>']
+                lines += ['  </protein_associations>',
+                          '</metabolite>\n']
+                xml_file.write('\n'.join(lines).encode('utf-8'))
+            xml_file.write(b'</hmdb>\n')
+
+
+def reference_read_xml_file(fp, element):
+    # the original reader, it rebuilt the text of every element from the lines of the file
+    start_tag = f'<{element}>'
+    end_tag = f'</{element}>'
+    tag_found = False
+    xml_string = ''
+    for line in fp:
+        line = line.decode('utf-8')
+        if start_tag in line:
+            tag_found = True
+        if tag_found:
+            xml_string += line
+        if end_tag in line:
+            yield xml_string
+            tag_found = False
+            xml_string = ''
+
+
+def parse_hmdb_zip(hmdb_loader: HMDBLoader, output_name: str):
+    nodes_file_path = os.path.join(TEMP_DIRECTORY, f'{output_name}_nodes.jsonl')
+    edges_file_path = os.path.join(TEMP_DIRECTORY, f'{output_name}_edges.jsonl')
+    with KGXFileWriter(nodes_file_path, edges_file_path) as output_file_writer:
+        hmdb_loader.output_file_writer = output_file_writer
+        load_metadata = hmdb_loader.parse_data()
+    with open(nodes_file_path) as nodes_file, open(edges_file_path) as edges_file:
+        return load_metadata, nodes_file.read(), edges_file.read()
+
+
+def test_hmdb_streaming_parser_matches_reference():
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    hmdb_loader = HMDBLoader(source_data_dir=TEMP_DIRECTORY)
+    write_hmdb_zip(os.path.join(hmdb_loader.data_path, hmdb_loader.data_file), metabolite_count=300)
+    load_metadata, nodes, edges = parse_hmdb_zip(hmdb_loader, 'streaming')
+
+    # the same parsing with the elements parsed from the text the original reader captured
+    hmdb_loader.read_xml_file = lambda fp, element: (E_Tree.fromstring(xml_string)
+                                                     for xml_string in reference_read_xml_file(fp, element))
+    reference_load_metadata, reference_nodes, reference_edges = parse_hmdb_zip(hmdb_loader, 'reference')
+
+    assert load_metadata == reference_load_metadata
+    assert nodes == reference_nodes
+    assert edges == reference_edges
+    # metabolites without an accession, or without pathways, diseases or proteins, are skipped
+    assert load_metadata['num_source_lines'] == 300
+    assert load_metadata['unusable_source_lines'] == 30 + sum(1 for i in range(300)
+                                                              if i % 10 and i % 3 and i % 4 and i % 5)
+    assert 'HMDB:HMDB0000001' not in nodes and 'HMDB:HMDB0000003' in nodes
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+
+
+def test_hmdb_parsing_benchmark():
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    hmdb_loader = HMDBLoader(source_data_dir=TEMP_DIRECTORY)
+    if HMDB_BENCHMARK_FILE:
+        hmdb_zip_path = HMDB_BENCHMARK_FILE
+    else:
+        # real metabolites have hundreds of concentrations, spectra, references etc.
+        hmdb_zip_path = os.path.join(TEMP_DIRECTORY, hmdb_loader.data_file)
+        write_hmdb_zip(hmdb_zip_path, metabolite_count=500, concentration_count=200)
+
+    def reference_read_metabolites(fp):
+        for xml_string in reference_read_xml_file(fp, 'metabolite'):
+            yield E_Tree.fromstring(xml_string)
+
+    def read_metabolites(fp):
+        return hmdb_loader.read_xml_file(fp, 'metabolite')
+
+    parsing_results = {}
+    for reader_name, metabolite_reader in [('reference', reference_read_metabolites), ('streaming', read_metabolites)]:
+        for measure_memory in [False, True]:
+            if measure_memory:
+                tracemalloc.start()
+            start_time = time.perf_counter()
+            with ZipFile(hmdb_zip_path) as zip_file, zip_file.open('hmdb_metabolites.xml', 'r') as xml_file:
+                accessions = [metabolite.findtext('accession') for metabolite in metabolite_reader(xml_file)]
+            elapsed_time = time.perf_counter() - start_time
+            if measure_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                parsing_results[reader_name] = (accessions, elapsed_time)
+        print(f'HMDB {reader_name} reader: {len(accessions) / parsing_results[reader_name][1]:.0f} metabolites/second, '
+              f'{os.path.getsize(hmdb_zip_path) / parsing_results[reader_name][1] / 1_000_000:.1f} MB/second of the '
+              f'zip file, peak memory {peak_memory / 1_000_000:.1f} MB')
+
+    assert parsing_results['streaming'][0] == parsing_results['reference'][0]
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
@@ -0,0 +1,143 @@
+import os
+import csv
+import json
+import pytest
+
+from Common.biolink_constants import *
+from Common.kgx_file_converter import convert_jsonl_to_neo4j_csv, convert_jsonl_to_neo4j_csv_parts, \
+    get_neo4j_import_file_groups, convert_jsonl_to_memgraph_cypher_batched
+from Common import kgx_file_converter
+from Common.utils import open_kgx_file
+
+def write_test_graph(test_directory: str):
+    nodes = []
+    for i in range(500):
+        node = {'id': f'NODE:{i}', 'name': f'Node {i}' if i % 10 else None, NODE_TYPES: [NAMED_THING]}
+        if i > 300:
+            # a property that only shows up late in the file, in some shards and not others
+            node['information_content'] = i if i % 2 else float(i)
+        if i % 7 == 0:
+            node['equivalent_identifiers'] = [f'OTHER:{i}', f'ANOTHER:{i}']
+        if i % 5 == 0:
+            node['description'] = 'a description, with\ttabs and "quotes"'
+        nodes.append(node)
+    edges = [{SUBJECT_ID: f'NODE:{i}',
+              PREDICATE: 'biolink:related_to',
+              OBJECT_ID: f'NODE:{i + 1}',
+              PRIMARY_KNOWLEDGE_SOURCE: 'infores:test',
+              PUBLICATIONS: [f'PMID:{i}'] if i % 3 else [],
+              'robokop_variant_id': 'ignore me',
+              'negated': i % 4 == 0,
+              'p_value': None}
+             for i in range(499)]
+    nodes_file_path = os.path.join(test_directory, 'nodes.jsonl')
+    edges_file_path = os.path.join(test_directory, 'edges.jsonl')
+    with open(nodes_file_path, 'w') as nodes_file:
+        nodes_file.writelines(f'{json.dumps(node)}\n' for node in nodes)
+    with open(edges_file_path, 'w') as edges_file:
+        edges_file.writelines(f'{json.dumps(edge)}\n' for edge in edges)
+    return nodes_file_path, edges_file_path
+
+
+def read_neo4j_csv_rows(csv_file_path):
+    # read all the rows of a csv file or csv parts into dictionaries of header -> value, leaving out empty values
+    rows = []
+    for file_group in get_neo4j_import_file_groups(csv_file_path):
+        file_paths = [os.path.join(os.path.dirname(csv_file_path), file_name) for file_name in file_group.split(',')]
+        header = None
+        for file_path in file_paths:
+            with open(file_path, newline='') as csv_file:
+                for row in csv.reader(csv_file, delimiter='\t'):
+                    if header is None:
+                        header = row
+                        continue
+                    assert len(row) == len(header)
+                    rows.append({column: value for column, value in zip(header, row) if value})
+    return sorted(rows, key=lambda row: json.dumps(row, sort_keys=True))
+
+
+def test_neo4j_csv_parts_match_single_csv(monkeypatch, tmp_path):
+    # use small chunks so that new parts get started when new properties show up
+    monkeypatch.setattr(kgx_file_converter, 'NEO4J_CSV_CONVERSION_CHUNK_SIZE', 50)
+    nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    single_nodes_csv = os.path.join(str(tmp_path), 'single_nodes.csv')
+    single_edges_csv = os.path.join(str(tmp_path), 'single_edges.csv')
+    convert_jsonl_to_neo4j_csv(nodes_input_file=nodes_file_path,
+                               edges_input_file=edges_file_path,
+                               nodes_output_file=single_nodes_csv,
+                               edges_output_file=single_edges_csv,
+                               edge_property_ignore_list={'robokop_variant_id'})
+    expected_nodes = read_neo4j_csv_rows(single_nodes_csv)
+    expected_edges = read_neo4j_csv_rows(single_edges_csv)
+    assert len(expected_nodes) == 500 and len(expected_edges) == 499
+
+    for workers in [1, 3]:
+        parts_nodes_csv = os.path.join(str(tmp_path), f'parts_{workers}_nodes.csv')
+        parts_edges_csv = os.path.join(str(tmp_path), f'parts_{workers}_edges.csv')
+        convert_jsonl_to_neo4j_csv_parts(nodes_input_file=nodes_file_path,
+                                         edges_input_file=edges_file_path,
+                                         nodes_output_file=parts_nodes_csv,
+                                         edges_output_file=parts_edges_csv,
+                                         edge_property_ignore_list={'robokop_variant_id'},
+                                         workers=workers)
+        node_file_groups = get_neo4j_import_file_groups(parts_nodes_csv)
+        assert len(node_file_groups) >= workers
+        assert read_neo4j_csv_rows(parts_nodes_csv) == expected_nodes
+        assert read_neo4j_csv_rows(parts_edges_csv) == expected_edges
+
+    assert get_neo4j_import_file_groups(single_nodes_csv) == ['single_nodes.csv']
+
+
+def test_memgraph_cypher_batched(tmp_path):
+    nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    cypher_file_path = os.path.join(str(tmp_path), 'memgraph.cypher')
+    counts = convert_jsonl_to_memgraph_cypher_batched(nodes_input_file=nodes_file_path,
+                                                      edges_input_file=edges_file_path,
+                                                      output_cypher_file=cypher_file_path,
+                                                      edge_property_ignore_list={'robokop_variant_id'},
+                                                      batch_size=200)
+    assert counts == {'nodes': 500, 'edges': 499, 'statements': 2 + 3 + 3}
+    with open(cypher_file_path) as cypher_file:
+        statements = cypher_file.read().splitlines()
+    assert len(statements) == counts['statements']
+    # indexes and constraints come before any data
+    assert statements[0].startswith('CREATE INDEX ON')
+    assert statements[1].startswith('CREATE CONSTRAINT ON')
+    node_statements = [statement for statement in statements if 'CREATE (n:' in statement]
+    edge_statements = [statement for statement in statements if 'MATCH' in statement]
+    assert len(node_statements) == 3 and len(edge_statements) == 3
+    assert all(statement.startswith('UNWIND [') for statement in node_statements + edge_statements)
+    assert statements.index(edge_statements[0]) > statements.index(node_statements[-1])
+    assert '(a)-[r:`biolink:related_to`]->(b)' in edge_statements[0]
+    assert '`description`: "a description, with\\ttabs and \\"quotes\\""' in node_statements[0]
+    assert 'robokop_variant_id' not in edge_statements[0]
+
+
+@pytest.mark.skipif('MEMGRAPH_URI' not in os.environ,
+                    reason='requires a running memgraph, e.g. docker run -p 7687:7687 memgraph/memgraph')
+def test_memgraph_cypher_import(tmp_path):
+    from Common.memgraph_tools import create_memgraph_dump, import_memgraph_cypher_file
+    nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    create_memgraph_dump(nodes_file_path, edges_file_path, str(tmp_path), graph_id='test', batch_size=200)
+    import_results = import_memgraph_cypher_file(os.path.join(str(tmp_path), 'memgraph_test_.cypher'))
+    assert import_results['nodes'] == 500
+    assert import_results['edges'] == 499
+
+
+def test_neo4j_csv_parts_from_compressed_files(tmp_path):
+    nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    compressed_file_paths = []
+    for file_path in [nodes_file_path, edges_file_path]:
+        with open(file_path) as input_file, open_kgx_file(f'{file_path}.gz', 'w') as compressed_file:
+            compressed_file.write(input_file.read())
+        compressed_file_paths.append(f'{file_path}.gz')
+    for input_file_paths, output_prefix in [((nodes_file_path, edges_file_path), 'plain'),
+                                            (compressed_file_paths, 'compressed')]:
+        convert_jsonl_to_neo4j_csv_parts(nodes_input_file=input_file_paths[0],
+                                         edges_input_file=input_file_paths[1],
+                                         nodes_output_file=os.path.join(str(tmp_path), f'{output_prefix}_nodes.csv'),
+                                         edges_output_file=os.path.join(str(tmp_path), f'{output_prefix}_edges.csv'),
+                                         workers=2)
+    for entity_type in ['nodes', 'edges']:
+        assert read_neo4j_csv_rows(os.path.join(str(tmp_path), f'compressed_{entity_type}.csv')) == \
+               read_neo4j_csv_rows(os.path.join(str(tmp_path), f'plain_{entity_type}.csv'))
@@ -1,7 +1,20 @@
-from Common.merging import GraphMerger, MemoryGraphMerger, DiskGraphMerger
+from Common.merging import GraphMerger, MemoryGraphMerger, DiskGraphMerger, EDGE_ENTITY_TYPE, edge_key_function, bmt
+from Common.merging import TEMP_FILE_COMPRESSION_CODECS, CompactIdIndex, zstandard, lz4
+from Common.merging import entity_merging_function, EDGE_PROPERTIES_THAT_SHOULD_BE_SETS
+from Common import kgx_file_merger
+from Common.kgx_file_merger import KGXFileMerger
+from Common.kgxmodel import GraphSpec, GraphSource
+from Common.utils import quick_jsonl_file_iterator, quick_json_dumps, open_kgx_file, \
+    add_kgx_file_compression_extension
+from itertools import chain
+from dataclasses import dataclass
+from xxhash import xxh64_hexdigest
 from Common.biolink_constants import *
 import os
 import json
+import time
+import pytest
+import tracemalloc
 
 TEMP_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) + '/workspace'
 
@@ -243,3 +256,333 @@ def test_qualifier_edge_merging():
     assert passed_tests == 3
 
 
+
+
+def get_benchmark_edges(edge_count: int):
+    # edges with lots of duplicates, in an arbitrary order, so that every sorted temp file has some of each key
+    return [{SUBJECT_ID: f'NODE:{(i * 7919) % 1000}',
+             PREDICATE: 'biolink:related_to',
+             OBJECT_ID: f'NODE:{(i * 104729) % 1000 + 1000}',
+             PRIMARY_KNOWLEDGE_SOURCE: 'infores:test',
+             PUBLICATIONS: [f'PMID:{i}']}
+            for i in range(edge_count)]
+
+
+def test_multi_pass_disk_merging():
+    test_edges = get_benchmark_edges(2000)
+
+    memory_graph_merger = MemoryGraphMerger()
+    memory_graph_merger.merge_edges(test_edges)
+    expected_edges = sorted(memory_graph_merger.get_merged_edges_jsonl())
+
+    # 2000 edges in chunks of 10 makes 200 sorted temp files, merging 4 at a time takes several passes
+    disk_graph_merger = DiskGraphMerger(temp_directory=TEMP_DIRECTORY, chunk_size=10, max_merge_fan_in=4)
+    disk_graph_merger.merge_edges(test_edges)
+    assert len(disk_graph_merger.temp_file_paths[EDGE_ENTITY_TYPE]) == 200
+    merged_edges = sorted(disk_graph_merger.get_merged_edges_jsonl())
+    assert len(disk_graph_merger.temp_file_paths[EDGE_ENTITY_TYPE]) <= 4
+    assert merged_edges == expected_edges
+    assert disk_graph_merger.merged_edge_counter == memory_graph_merger.merged_edge_counter
+    assert not [file_name for file_name in os.listdir(TEMP_DIRECTORY) if '.temp' in file_name]
+
+
+def test_disk_merging_long_ids():
+    # node ids and keys longer than 65535 bytes
+    long_id = 'NODE:' + 'X' * 70_000
+    test_nodes = [{'id': long_id, 'name': 'Long Node', 'testing_prop': [i]} for i in range(3)]
+    test_nodes.append({'id': 'NODE:1', 'name': 'Node 1'})
+
+    disk_graph_merger = DiskGraphMerger(temp_directory=TEMP_DIRECTORY, chunk_size=1)
+    disk_graph_merger.merge_nodes(test_nodes)
+    merged_nodes = [json.loads(node_line) for node_line in disk_graph_merger.get_merged_nodes_jsonl()]
+    assert sorted(node['id'] for node in merged_nodes) == ['NODE:1', long_id]
+    assert next(node for node in merged_nodes if node['id'] == long_id)['testing_prop'] == [0, 1, 2]
+
+
+def test_parallel_disk_merging():
+    test_nodes = [{'id': f'NODE:{i % 300}', 'name': f'Node {i % 300}', 'testing_prop': [i]} for i in range(1000)]
+    test_edges = get_benchmark_edges(1000)
+
+    expected_results = []
+    for workers in [1, 3]:
+        disk_graph_merger = DiskGraphMerger(temp_directory=TEMP_DIRECTORY, chunk_size=50, workers=workers)
+        disk_graph_merger.merge_nodes(test_nodes)
+        disk_graph_merger.merge_edges(test_edges, add_edge_id=True)
+        if workers > 1:
+            assert disk_graph_merger.temp_file_compression
+        merged_results = (list(disk_graph_merger.get_merged_nodes_jsonl()),
+                          list(disk_graph_merger.get_merged_edges_jsonl()),
+                          disk_graph_merger.merged_node_counter,
+                          disk_graph_merger.merged_edge_counter)
+        if not expected_results:
+            expected_results = merged_results
+        else:
+            assert merged_results == expected_results
+    assert not [file_name for file_name in os.listdir(TEMP_DIRECTORY) if '.temp' in file_name]
+
+
+def test_disk_merging_throughput_by_number_of_runs():
+    edge_count = 20_000
+    test_edges = get_benchmark_edges(edge_count)
+
+    merged_results = []
+    for number_of_runs in [1, 10, 100, 400]:
+        disk_graph_merger = DiskGraphMerger(temp_directory=TEMP_DIRECTORY,
+                                            chunk_size=edge_count // number_of_runs,
+                                            max_merge_fan_in=100)
+        disk_graph_merger.merge_edges(test_edges)
+        assert len(disk_graph_merger.temp_file_paths[EDGE_ENTITY_TYPE]) == number_of_runs
+        start_time = time.perf_counter()
+        merged_edges = list(disk_graph_merger.get_merged_edges_jsonl())
+        elapsed_time = time.perf_counter() - start_time
+        print(f'Merged {edge_count} edges from {number_of_runs} sorted runs: '
+              f'{edge_count / elapsed_time:.0f} edges/second')
+        merged_results.append(merged_edges)
+
+    # the results should be identical no matter how many sorted runs were merged
+    assert all(merged_result == merged_results[0] for merged_result in merged_results)
+
+
+def test_edge_key_function_benchmark():
+    # the original implementation of edge_key_function, the keys must not change because they're used as edge ids
+    def reference_edge_key_function(edge, custom_key_attributes=None):
+        qualifiers = [f'{key}{value}' for key, value in edge.items() if bmt.is_qualifier(key)]
+        standard_attributes = (f'{edge[SUBJECT_ID]}{edge[PREDICATE]}{edge[OBJECT_ID]}'
+                               f'{edge.get(PRIMARY_KNOWLEDGE_SOURCE, "")}{"".join(qualifiers)}')
+        if custom_key_attributes:
+            custom_attributes = [edge[attr] if attr in edge else '' for attr in custom_key_attributes]
+            return xxh64_hexdigest(f'{standard_attributes}{"".join(custom_attributes)}')
+        else:
+            return xxh64_hexdigest(standard_attributes)
+
+    test_edges = []
+    for i in range(20_000):
+        test_edge = {SUBJECT_ID: f'NCBIGene:{i % 5000}',
+                     PREDICATE: 'biolink:affects' if i % 2 else 'biolink:interacts_with',
+                     OBJECT_ID: f'CHEBI:{i % 3000}',
+                     PRIMARY_KNOWLEDGE_SOURCE: 'infores:ctd',
+                     AGGREGATOR_KNOWLEDGE_SOURCES: ['infores:aragorn'],
+                     KNOWLEDGE_LEVEL: 'knowledge_assertion',
+                     AGENT_TYPE: 'manual_agent',
+                     PUBLICATIONS: [f'PMID:{i}', f'PMID:{i + 1}'],
+                     'abstract_id': f'ABS:{i % 7}'}
+        if i % 2:
+            test_edge[QUALIFIED_PREDICATE] = 'biolink:causes'
+            test_edge[OBJECT_ASPECT_QUALIFIER] = 'activity'
+            test_edge[OBJECT_DIRECTION_QUALIFIER] = 'increased' if i % 3 else 'decreased'
+        test_edges.append(test_edge)
+
+    for custom_key_attributes in [None, ['abstract_id']]:
+        start_time = time.perf_counter()
+        reference_keys = [reference_edge_key_function(edge, custom_key_attributes) for edge in test_edges]
+        reference_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        edge_keys = [edge_key_function(edge, custom_key_attributes) for edge in test_edges]
+        elapsed_time = time.perf_counter() - start_time
+
+        print(f'Edge keys (custom key attributes: {custom_key_attributes}): '
+              f'{len(test_edges) / reference_time:.0f} edges/second before, '
+              f'{len(test_edges) / elapsed_time:.0f} edges/second now')
+        assert edge_keys == reference_keys
+
+
+def test_disk_merging_temp_file_compression():
+    test_edges = get_benchmark_edges(5000)
+
+    memory_graph_merger = MemoryGraphMerger()
+    memory_graph_merger.merge_edges(test_edges)
+    expected_edges = sorted(memory_graph_merger.get_merged_edges_jsonl())
+
+    for compression in TEMP_FILE_COMPRESSION_CODECS:
+        if (compression == 'zstd' and zstandard is None) or (compression == 'lz4' and lz4 is None):
+            continue
+        disk_graph_merger = DiskGraphMerger(temp_directory=TEMP_DIRECTORY,
+                                            chunk_size=500,
+                                            temp_file_compression=compression)
+        disk_graph_merger.merge_edges(test_edges)
+        temp_file_size = sum(os.path.getsize(file_path)
+                             for file_path in disk_graph_merger.temp_file_paths[EDGE_ENTITY_TYPE])
+        print(f'Temp file size with compression {compression}: {temp_file_size} bytes')
+        assert sorted(disk_graph_merger.get_merged_edges_jsonl()) == expected_edges
+
+
+def test_compact_id_index():
+    node_ids = [f'NODE:{i}' for i in range(0, 1000, 2)]
+    id_index = CompactIdIndex(node_ids + node_ids[:10])
+    assert len(id_index) == 500
+    assert 'NODE:2' in id_index and 'NODE:3' not in id_index
+    lookup_ids = [f'NODE:{i}' for i in range(1000)] + ['OTHER:1', '']
+    assert id_index.contains_many(lookup_ids) == [i % 2 == 0 for i in range(1000)] + [False, False]
+    assert CompactIdIndex([]).contains_many(['NODE:1']) == [False]
+
+
+def write_test_kgx_file(file_path, entities):
+    with open_kgx_file(file_path, 'w') as kgx_file:
+        for entity in entities:
+            kgx_file.write(f'{json.dumps(entity)}\n')
+    return file_path
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', pytest.param('zstd', marks=pytest.mark.skipif(
+    zstandard is None, reason='zstandard is not installed'))])
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_kgx_file_merger_connected_edge_subset(on_disk, compression, monkeypatch, tmp_path):
+    if on_disk:
+        monkeypatch.setattr(kgx_file_merger, 'DISK_MERGE_THRESHOLD_BYTES', 0)
+    test_directory = str(tmp_path)
+
+    def kgx_file_path(file_name):
+        return os.path.join(test_directory, add_kgx_file_compression_extension(file_name, compression))
+
+    def test_edge(subject_id, object_id):
+        return {SUBJECT_ID: subject_id, PREDICATE: 'biolink:related_to', OBJECT_ID: object_id,
+                PRIMARY_KNOWLEDGE_SOURCE: 'infores:test'}
+
+    primary_source = GraphSource(id='primary', file_paths=[
+        write_test_kgx_file(kgx_file_path('primary_nodes.jsonl'),
+                            [{'id': f'NODE:{i}', NODE_TYPES: [NAMED_THING]} for i in range(1, 11)]),
+        write_test_kgx_file(kgx_file_path('primary_edges.jsonl'),
+                            [test_edge(f'NODE:{i}', f'NODE:{i + 1}') for i in range(1, 10)])])
+    secondary_source = GraphSource(id='secondary', merge_strategy='connected_edge_subset', file_paths=[
+        write_test_kgx_file(kgx_file_path('secondary_nodes.jsonl'),
+                            [{'id': f'NODE:{i}', NODE_TYPES: [NAMED_THING], 'secondary': True}
+                             for i in range(5, 31)]),
+        write_test_kgx_file(kgx_file_path('secondary_edges.jsonl'),
+                            [test_edge(f'NODE:{i}', f'NODE:{i + 10}') for i in range(5, 21)])])
+    graph_spec = GraphSpec(graph_id='test_graph', graph_name='', graph_description='', graph_url='',
+                           graph_version='1', graph_output_format='jsonl',
+                           sources=[primary_source, secondary_source], subgraphs=[])
+
+    file_merger = KGXFileMerger(graph_spec=graph_spec,
+                                output_directory=test_directory,
+                                nodes_output_filename=os.path.basename(kgx_file_path('merged_nodes.jsonl')),
+                                edges_output_filename=os.path.basename(kgx_file_path('merged_edges.jsonl')))
+    assert isinstance(file_merger.node_graph_merger, DiskGraphMerger if on_disk else MemoryGraphMerger)
+    file_merger.merge()
+    merge_metadata = file_merger.get_merge_metadata()
+    assert 'merge_error' not in merge_metadata
+
+    # secondary edges from NODE:5 - NODE:10 connect to primary nodes, and bring in NODE:15 - NODE:20
+    secondary_metadata = merge_metadata['sources']['secondary']
+    assert secondary_metadata[os.path.basename(kgx_file_path('secondary_edges.jsonl'))] == {'edges': 6}
+    assert secondary_metadata[os.path.basename(kgx_file_path('secondary_nodes.jsonl'))] == {'nodes': 6}
+    assert merge_metadata['final_node_count'] == 16
+    assert merge_metadata['final_edge_count'] == 15
+    merged_node_ids = {node['id'] for node in quick_jsonl_file_iterator(kgx_file_path('merged_nodes.jsonl'))}
+    assert merged_node_ids == {f'NODE:{i}' for i in chain(range(1, 11), range(15, 21))}
+    assert [file_name for file_name in os.listdir(test_directory) if '.temp' in file_name] == []
+
+
+def test_memory_graph_merger_bytes_per_edge():
+    # the original MemoryGraphMerger edge storage, json strings keyed by hex digest edge keys
+    def reference_merge_edges(edges, reference_edges):
+        for edge in edges:
+            edge_key = edge_key_function(edge)
+            if edge_key in reference_edges:
+                merged_edge = entity_merging_function(json.loads(reference_edges[edge_key]),
+                                                      edge,
+                                                      EDGE_PROPERTIES_THAT_SHOULD_BE_SETS)
+                merged_edge[EDGE_ID] = edge_key
+                reference_edges[edge_key] = quick_json_dumps(merged_edge)
+            else:
+                edge[EDGE_ID] = edge_key
+                reference_edges[edge_key] = quick_json_dumps(edge)
+
+    def get_test_edges():
+        test_edges = get_benchmark_edges(20_000)
+        for i, test_edge in enumerate(test_edges):
+            test_edge[KNOWLEDGE_LEVEL] = 'knowledge_assertion'
+            test_edge[AGENT_TYPE] = 'manual_agent'
+            if i % 2:
+                test_edge[OBJECT_ASPECT_QUALIFIER] = 'activity'
+                test_edge[OBJECT_DIRECTION_QUALIFIER] = 'increased'
+        return test_edges
+
+    # create the edges before measuring so only the merged edges are counted
+    test_edges = get_test_edges()
+    reference_edges = {}
+    tracemalloc.start()
+    reference_merge_edges(test_edges, reference_edges)
+    reference_memory_usage = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    test_edges = get_test_edges()
+    graph_merger = MemoryGraphMerger()
+    tracemalloc.start()
+    graph_merger.merge_edges(test_edges, add_edge_id=True)
+    memory_usage = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    edge_count = len(reference_edges)
+    print(f'MemoryGraphMerger bytes per edge: {reference_memory_usage / edge_count:.0f} before, '
+          f'{memory_usage / edge_count:.0f} now')
+    assert memory_usage < reference_memory_usage
+    assert list(graph_merger.get_merged_edges_jsonl()) == [f'{edge}\n' for edge in reference_edges.values()]
+
+
+@dataclass
+class VersionedGraphSource(GraphSource):
+    source_version: str = None
+
+    def generate_version(self):
+        return self.source_version
+
+
+def test_incremental_kgx_file_merging(monkeypatch, tmp_path):
+    monkeypatch.setattr(kgx_file_merger, 'DISK_MERGE_THRESHOLD_BYTES', 0)
+    test_directory = str(tmp_path)
+    contribution_index_directory = os.path.join(test_directory, 'source_contributions')
+
+    def test_source(source_id, source_version, node_range, edge_range, **source_args):
+        return VersionedGraphSource(id=source_id, source_version=source_version, file_paths=[
+            write_test_kgx_file(os.path.join(test_directory, f'{source_id}_{source_version}_nodes.jsonl'),
+                                [{'id': f'NODE:{i}', NODE_TYPES: [NAMED_THING], SYNONYMS: [f'{source_id}_{i}'],
+                                  'source': source_id} for i in node_range]),
+            write_test_kgx_file(os.path.join(test_directory, f'{source_id}_{source_version}_edges.jsonl'),
+                                [{SUBJECT_ID: f'NODE:{i}', PREDICATE: 'biolink:related_to', OBJECT_ID: f'NODE:{i + 1}',
+                                  PRIMARY_KNOWLEDGE_SOURCE: 'infores:test', PUBLICATIONS: [f'PMID:{source_id}_{i}']}
+                                 for i in edge_range])], **source_args)
+
+    def merge(sources, output_name, incremental):
+        graph_spec = GraphSpec(graph_id='test_graph', graph_name='', graph_description='', graph_url='',
+                               graph_version=output_name, graph_output_format='jsonl', sources=sources, subgraphs=[])
+        file_merger = KGXFileMerger(graph_spec=graph_spec,
+                                    output_directory=test_directory,
+                                    nodes_output_filename=f'{output_name}_nodes.jsonl',
+                                    edges_output_filename=f'{output_name}_edges.jsonl',
+                                    contribution_index_directory=contribution_index_directory if incremental else None)
+        file_merger.merge()
+        merge_metadata = file_merger.get_merge_metadata()
+        assert 'merge_error' not in merge_metadata
+        with open(os.path.join(test_directory, f'{output_name}_nodes.jsonl')) as nodes_file, \
+                open(os.path.join(test_directory, f'{output_name}_edges.jsonl')) as edges_file:
+            return merge_metadata, nodes_file.read(), edges_file.read()
+
+    source_a = test_source('source_a', '1', range(0, 50), range(0, 40))
+    source_b = test_source('source_b', '1', range(30, 80), range(30, 70), edge_merging_attributes=['source'])
+    source_c = test_source('source_c', '1', range(60, 100), range(60, 90))
+    secondary = test_source('secondary', '1', range(90, 120), range(95, 115), merge_strategy='connected_edge_subset')
+    sources = [source_a, source_b, source_c, secondary]
+
+    full_merge = merge(sources, 'full_1', incremental=False)
+    incremental_merge = merge(sources, 'incremental_1', incremental=True)
+    assert incremental_merge[0]['incremental_merge'] == {'reused_sources': [],
+                                                         'indexed_sources': ['source_a', 'source_b', 'source_c'],
+                                                         'retracted_sources': []}
+    # the sorted runs of each source merge to exactly the same files as merging everything at once
+    assert incremental_merge[1:] == full_merge[1:]
+    assert incremental_merge[0]['sources'] == full_merge[0]['sources']
+    assert incremental_merge[0]['final_edge_count'] == full_merge[0]['final_edge_count']
+
+    # a new version of one source only needs that source sorted again, and the old version gets retracted
+    sources[1] = test_source('source_b', '2', range(40, 85), range(45, 80), edge_merging_attributes=['source'])
+    full_merge = merge(sources, 'full_2', incremental=False)
+    incremental_merge = merge(sources, 'incremental_2', incremental=True)
+    assert incremental_merge[0]['incremental_merge'] == {'reused_sources': ['source_a', 'source_c'],
+                                                         'indexed_sources': ['source_b'],
+                                                         'retracted_sources': ['source_b']}
+    assert incremental_merge[1:] == full_merge[1:]
+    assert incremental_merge[0]['merged_nodes'] == full_merge[0]['merged_nodes']
+    assert len(os.listdir(contribution_index_directory)) == 4
+    assert [file_name for file_name in os.listdir(test_directory) if '.temp' in file_name] == []
@@ -1,8 +1,18 @@
+import os
+import copy
+import json
+import threading
 import pytest
+import Common.normalization
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from Common.biolink_constants import *
 from Common.normalization import NodeNormalizer, EdgeNormalizer, EdgeNormalizationResult, \
     FALLBACK_EDGE_PREDICATE, CUSTOM_NODE_TYPES
-from Common.kgx_file_normalizer import invert_edge
+from Common.normalization_cache import NodeNormalizationCache
+from Common.biolink_utils import BiolinkInformationResources
+from Common.kgx_file_normalizer import KGXFileNormalizer, invert_edge
+from Common.utils import quick_jsonl_file_iterator
 
 INVALID_NODE_TYPE = "testing:Type1"
 
@@ -83,6 +93,275 @@ def test_node_norm_lenient(test_nodes):
     assert normalized_node['name'] == 'nameless'
 
 
+class StubNodeNormHandler(BaseHTTPRequestHandler):
+    # a tiny stand-in for node norm, curies normalize to upper case versions of themselves unless they contain "bogus"
+    # when the server is flaky every third request gets a 503 or a 403, and every fifth one has its connection dropped
+    # it also stands in for edge norm and the infores catalog, predicates normalize to themselves
+
+    def do_GET(self):
+        parsed_url = urlparse(self.path)
+        if parsed_url.path == '/openapi.json':
+            response = {'info': {'version': 'stub_version'}}
+        elif parsed_url.path == '/versions':
+            response = ['stub_version']
+        elif parsed_url.path == '/resolve_predicate':
+            response = {predicate: {'identifier': predicate}
+                        for predicate in parse_qs(parsed_url.query)['predicate']}
+        elif parsed_url.path == '/infores_catalog.yaml':
+            response = {'information_resources': [{'id': 'infores:stub', 'status': 'released'}]}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        response_body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def do_POST(self):
+        request_body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.request_count += 1
+            request_number = self.server.request_count
+        if self.server.flaky and request_number % 5 == 0:
+            self.close_connection = True
+            self.connection.close()
+            return
+        if self.server.flaky and request_number % 3 == 0:
+            # node norm throttles requests with 403s
+            self.send_response(403 if request_number % 2 else 503)
+            self.end_headers()
+            return
+        results = {}
+        for curie in request_body['curies']:
+            if 'bogus' in curie:
+                results[curie] = None
+            else:
+                normalized_id = curie.upper()
+                results[curie] = {'id': {'identifier': normalized_id, 'label': f'label {normalized_id}'},
+                                  'type': [GENE, NAMED_THING],
+                                  'equivalent_identifiers': [{'identifier': normalized_id},
+                                                             {'identifier': curie}]}
+        response_body = json.dumps(results).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_node_norm_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNodeNormHandler)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.flaky = False
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    server_url = f'http://127.0.0.1:{server.server_port}/'
+    monkeypatch.setattr(Common.normalization, 'NODE_NORMALIZATION_URL', server_url)
+    monkeypatch.setenv('EDGE_NORMALIZATION_ENDPOINT', server_url)
+    monkeypatch.setattr(BiolinkInformationResources, 'infores_catalog_url', f'{server_url}infores_catalog.yaml')
+    monkeypatch.setattr(Common.normalization, 'NODE_NORM_BACKOFF_FACTOR', 0.01)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_node_norm_matches_sequential(stub_node_norm_server):
+    nodes = [{'id': f'test:{i}' if i % 7 else f'bogus:{i}', 'name': '', NODE_TYPES: [GENE]} for i in range(1, 2001)]
+    sequential_nodes = copy.deepcopy(nodes)
+    concurrent_nodes = copy.deepcopy(nodes)
+
+    sequential_normalizer = NodeNormalizer(max_concurrent_requests=1)
+    sequential_failures = sequential_normalizer.normalize_node_data(sequential_nodes, batch_size=50)
+    assert stub_node_norm_server.request_count == 40
+
+    stub_node_norm_server.flaky = True
+    concurrent_normalizer = NodeNormalizer(max_concurrent_requests=8)
+    concurrent_failures = concurrent_normalizer.normalize_node_data(concurrent_nodes, batch_size=50)
+    # the failed requests should have been retried
+    assert stub_node_norm_server.request_count > 80
+
+    assert concurrent_normalizer.node_normalization_lookup == sequential_normalizer.node_normalization_lookup
+    assert list(concurrent_normalizer.node_normalization_lookup) == \
+           list(sequential_normalizer.node_normalization_lookup)
+    assert concurrent_nodes == sequential_nodes
+    assert concurrent_failures == sequential_failures
+    assert concurrent_normalizer.node_normalization_lookup['test:1'] == ['TEST:1']
+    assert concurrent_normalizer.node_normalization_lookup['bogus:7'] is None
+
+
+def test_cached_node_normalization(stub_node_norm_server, tmp_path):
+    cache_file_path = str(tmp_path / 'node_norm_cache.db')
+    nodes = [{'id': f'test:{i}' if i % 7 else f'bogus:{i}', 'name': '', NODE_TYPES: [GENE]} for i in range(1, 101)]
+    uncached_nodes = copy.deepcopy(nodes)
+    cached_nodes = copy.deepcopy(nodes)
+
+    with NodeNormalizationCache('1.0', cache_file_path=cache_file_path) as node_norm_cache:
+        uncached_normalizer = NodeNormalizer(node_norm_cache=node_norm_cache)
+        uncached_normalizer.normalize_node_data(copy.deepcopy(nodes[:50]), batch_size=10)
+        assert node_norm_cache.get_metadata() == {'node_norm_cache_hits': 0, 'node_norm_cache_misses': 50}
+    assert stub_node_norm_server.request_count == 5
+
+    # a new cache for the same version should only need to request the curies it hasn't seen
+    with NodeNormalizationCache('1.0', cache_file_path=cache_file_path) as node_norm_cache:
+        cached_normalizer = NodeNormalizer(node_norm_cache=node_norm_cache)
+        cached_normalizer.normalize_node_data(cached_nodes, batch_size=10)
+        assert node_norm_cache.get_metadata() == {'node_norm_cache_hits': 50, 'node_norm_cache_misses': 50}
+    assert stub_node_norm_server.request_count == 10
+
+    uncached_normalizer = NodeNormalizer()
+    uncached_normalizer.normalize_node_data(uncached_nodes, batch_size=10)
+    assert cached_nodes == uncached_nodes
+    assert cached_normalizer.node_normalization_lookup == uncached_normalizer.node_normalization_lookup
+    assert cached_normalizer.failed_to_normalize_ids == uncached_normalizer.failed_to_normalize_ids
+
+    # results from other versions or conflation settings should not be used
+    with NodeNormalizationCache('1.0', conflation=True, cache_file_path=cache_file_path) as node_norm_cache:
+        assert not node_norm_cache.get_normalizations(['test:1'])
+    with NodeNormalizationCache('2.0', cache_file_path=cache_file_path, versions_to_keep=1) as node_norm_cache:
+        assert not node_norm_cache.get_normalizations(['test:1'])
+    # creating a new version with versions_to_keep=1 should have evicted the older versions
+    with NodeNormalizationCache('1.0', cache_file_path=cache_file_path) as node_norm_cache:
+        assert not node_norm_cache.get_normalizations(['test:1'])
+
+
+def write_source_kgx_files(tmp_path):
+    source_nodes_path = str(tmp_path / 'source_nodes.jsonl')
+    source_edges_path = str(tmp_path / 'source_edges.jsonl')
+    with open(source_nodes_path, 'w') as source_nodes_file:
+        for i in range(1, 101):
+            node_id = f'test:{i}' if i % 7 else f'bogus:{i}'
+            source_nodes_file.write(json.dumps({'id': node_id, 'name': '', NODE_TYPES: [GENE]}) + '\n')
+    with open(source_edges_path, 'w') as source_edges_file:
+        for i in range(1, 100):
+            subject_id = f'test:{i}' if i % 7 else f'bogus:{i}'
+            source_edges_file.write(json.dumps({SUBJECT_ID: subject_id,
+                                                PREDICATE: 'biolink:related_to',
+                                                OBJECT_ID: f'test:{i + 1}' if (i + 1) % 7 else f'bogus:{i + 1}',
+                                                PRIMARY_KNOWLEDGE_SOURCE: 'infores:stub'}) + '\n')
+    return source_nodes_path, source_edges_path
+
+
+@pytest.mark.parametrize('process_in_memory', [True, False])
+def test_kgx_file_normalization(stub_node_norm_server, tmp_path, process_in_memory):
+    source_nodes_path, source_edges_path = write_source_kgx_files(tmp_path)
+
+    file_normalizer = KGXFileNormalizer(source_nodes_path,
+                                        str(tmp_path / 'nodes.jsonl'),
+                                        str(tmp_path / 'norm_node_map.json'),
+                                        str(tmp_path / 'norm_node_failures.log'),
+                                        source_edges_path,
+                                        str(tmp_path / 'edges.jsonl'),
+                                        str(tmp_path / 'norm_predicate_map.json'),
+                                        process_in_memory=process_in_memory,
+                                        use_node_norm_cache=False)
+    normalization_metadata = file_normalizer.normalize_kgx_files()
+
+    assert normalization_metadata['node_norm_lookup_in_memory'] == process_in_memory
+    assert normalization_metadata['node_norm_lookup_size'] == 100
+    assert normalization_metadata['regular_node_norm_failures'] == 14
+    assert normalization_metadata['final_normalized_nodes'] == 86
+    # the two edges touching each bogus node fail
+    assert normalization_metadata['edges_failed_due_to_nodes'] == 28
+    assert normalization_metadata['final_normalized_edges'] == 71
+    assert normalization_metadata['peak_memory_usage_mb'] > 0
+    assert not (tmp_path / 'norm_node_map.json.lookup.db').exists()
+    assert normalization_metadata['unconnected_nodes_removed'] == 0
+    assert not (tmp_path / 'temp_nodes.jsonl').exists()
+
+    with open(tmp_path / 'norm_node_map.json') as norm_map_file:
+        normalization_map = json.load(norm_map_file)['normalization_map']
+    assert normalization_map['test:1'] == ['TEST:1']
+    assert normalization_map['bogus:7'] is None
+    edges = list(quick_jsonl_file_iterator(str(tmp_path / 'edges.jsonl')))
+    assert edges[0][SUBJECT_ID] == 'TEST:1' and edges[0][OBJECT_ID] == 'TEST:2'
+    assert edges[0][ORIGINAL_SUBJECT] == 'test:1'
+
+
+
+def test_parallel_edge_normalization_matches_serial(stub_node_norm_server, tmp_path):
+    source_nodes_path, source_edges_path = write_source_kgx_files(tmp_path)
+    with open(source_nodes_path, 'a') as source_nodes_file:
+        # a couple of nodes without any edges
+        for i in range(200, 202):
+            source_nodes_file.write(json.dumps({'id': f'test:{i}', 'name': '', NODE_TYPES: [GENE]}) + '\n')
+    normalization_results = {}
+    for workers in [1, 3]:
+        output_path = tmp_path / f'workers_{workers}'
+        output_path.mkdir()
+        file_normalizer = KGXFileNormalizer(source_nodes_path,
+                                            str(output_path / 'nodes.jsonl'),
+                                            str(output_path / 'norm_node_map.json'),
+                                            str(output_path / 'norm_node_failures.log'),
+                                            source_edges_path,
+                                            str(output_path / 'edges.jsonl'),
+                                            str(output_path / 'norm_predicate_map.json'),
+                                            use_node_norm_cache=False,
+                                            edge_normalization_workers=workers)
+        normalization_metadata = file_normalizer.normalize_kgx_files()
+        normalization_metadata.pop('peak_memory_usage_mb')
+        with open(output_path / 'nodes.jsonl') as nodes_file, open(output_path / 'edges.jsonl') as edges_file:
+            normalization_results[workers] = (normalization_metadata, nodes_file.read(), edges_file.read())
+    # the shard outputs should be concatenated in order and the counts should add up to the serial ones
+    assert normalization_results[3] == normalization_results[1]
+    assert normalization_results[3][0]['final_normalized_edges'] == 71
+    # the nodes of the edges are tracked during the edge pass and only those are kept
+    assert normalization_results[3][0]['unconnected_nodes_removed'] == 2
+    assert 'TEST:200' not in normalization_results[3][1] and 'TEST:1"' in normalization_results[3][1]
+    assert sorted(os.listdir(tmp_path / 'workers_3')) == sorted(os.listdir(tmp_path / 'workers_1'))
+
+
+def test_parallel_edge_normalization_unseen_predicates(stub_node_norm_server, tmp_path, monkeypatch):
+    source_nodes_path, source_edges_path = write_source_kgx_files(tmp_path)
+    with open(source_edges_path) as source_edges_file:
+        source_edges = [json.loads(line) for line in source_edges_file]
+    with open(source_edges_path, 'w') as source_edges_file:
+        for i, edge in enumerate(source_edges):
+            # a predicate that only shows up at the end of the file
+            if i >= 90:
+                edge[PREDICATE] = 'biolink:affects'
+            source_edges_file.write(json.dumps(edge) + '\n')
+    normalized_predicates = []
+    normalize_edge_data = EdgeNormalizer.normalize_edge_data
+
+    def recording_normalize_edge_data(edge_normalizer, edge_list, *args, **kwargs):
+        normalized_predicates.append(sorted({edge[PREDICATE] for edge in edge_list
+                                             if edge[PREDICATE] not in edge_normalizer.edge_normalization_lookup}))
+        return normalize_edge_data(edge_normalizer, edge_list, *args, **kwargs)
+    monkeypatch.setattr(EdgeNormalizer, 'normalize_edge_data', recording_normalize_edge_data)
+
+    normalization_results = {}
+    for workers in [1, 3]:
+        output_path = tmp_path / f'workers_{workers}'
+        output_path.mkdir()
+        file_normalizer = KGXFileNormalizer(source_nodes_path,
+                                            str(output_path / 'nodes.jsonl'),
+                                            str(output_path / 'norm_node_map.json'),
+                                            str(output_path / 'norm_node_failures.log'),
+                                            source_edges_path,
+                                            str(output_path / 'edges.jsonl'),
+                                            str(output_path / 'norm_predicate_map.json'),
+                                            use_node_norm_cache=False,
+                                            edge_normalization_workers=workers)
+        file_normalizer.edge_normalizer.edge_normalization_lookup['biolink:related_to'] = \
+            EdgeNormalizationResult(predicate='biolink:related_to')
+        normalized_predicates.clear()
+        normalization_metadata = file_normalizer.normalize_kgx_files()
+        normalization_metadata.pop('peak_memory_usage_mb')
+        with open(output_path / 'edges.jsonl') as edges_file, \
+                open(output_path / 'norm_predicate_map.json') as predicate_map_file:
+            normalization_results[workers] = (normalization_metadata, edges_file.read(), predicate_map_file.read())
+    # only the predicate missing from the lookup was normalized, and the shards that found it were done again
+    assert [predicates for predicates in normalized_predicates if predicates] == [['biolink:affects']]
+    assert normalization_results[3] == normalization_results[1]
+    assert '"biolink:affects"' in normalization_results[3][1]
+
 def test_variant_node_norm():
 
     variant_nodes = [
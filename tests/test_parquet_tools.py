@@ -0,0 +1,98 @@
+import os
+import json
+import orjson
+import pytest
+import polars as pl
+
+from Common.biolink_constants import *
+from Common.parquet_tools import convert_jsonl_to_parquet, create_parquet_dump, PARQUET_SPARSE_PROPERTIES_COLUMN, \
+    PARQUET_DUMP_DIRECTORY
+
+def write_test_graph(test_directory: str):
+    nodes = []
+    for i in range(100):
+        node = {'id': f'NODE:{i}', 'name': f'Node {i}', NODE_TYPES: [NAMED_THING, 'biolink:Gene']}
+        if i % 10:
+            node['information_content'] = i if i % 2 else float(i)
+        if i == 50:
+            # a rare property, and a value with a different type than the rest of its column
+            node['rare'] = {'nested': True}
+            node['information_content'] = 'high'
+        nodes.append(node)
+    edges = [{SUBJECT_ID: f'NODE:{i}',
+              PREDICATE: 'biolink:related_to' if i % 2 else 'biolink:affects',
+              OBJECT_ID: f'NODE:{i + 1}',
+              PRIMARY_KNOWLEDGE_SOURCE: 'infores:test',
+              PUBLICATIONS: [f'PMID:{i}'] if i % 3 else [],
+              'ignored': 'ignore me',
+              'negated': i % 4 == 0,
+              'p_value': None}
+             for i in range(99)]
+    nodes_file_path = os.path.join(test_directory, 'nodes.jsonl')
+    edges_file_path = os.path.join(test_directory, 'edges.jsonl')
+    with open(nodes_file_path, 'w') as nodes_file:
+        nodes_file.writelines(f'{json.dumps(node)}\n' for node in nodes)
+    with open(edges_file_path, 'w') as edges_file:
+        edges_file.writelines(f'{json.dumps(edge)}\n' for edge in edges)
+    return nodes, edges, nodes_file_path, edges_file_path
+
+
+def read_parquet_rows(parquet_directory):
+    # read the parquet files back into dictionaries like the original jsonl, leaving out nulls
+    rows = []
+    for row in pl.read_parquet(os.path.join(parquet_directory, '*.parquet')).to_dicts():
+        sparse_properties = row.pop(PARQUET_SPARSE_PROPERTIES_COLUMN)
+        row = {key: value for key, value in row.items() if value is not None}
+        if sparse_properties:
+            row.update(orjson.loads(sparse_properties))
+        rows.append(row)
+    return rows
+
+
+def test_convert_jsonl_to_parquet(tmp_path):
+    nodes, edges, nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    parquet_directory = os.path.join(str(tmp_path), 'parquet')
+    counts = convert_jsonl_to_parquet(nodes_input_file=nodes_file_path,
+                                      edges_input_file=edges_file_path,
+                                      output_directory=parquet_directory,
+                                      edge_property_ignore_list={'ignored'},
+                                      rows_per_file=40)
+    assert counts == {'nodes': 100, 'node_files': 3, 'edges': 99, 'edge_files': 3}
+
+    node_schema = pl.read_parquet_schema(os.path.join(parquet_directory, 'nodes', 'part-00000.parquet'))
+    assert node_schema[NODE_TYPES] == pl.List(pl.Categorical)
+    assert node_schema['information_content'] == pl.Float64
+    assert 'rare' not in node_schema
+    edge_schema = pl.read_parquet_schema(os.path.join(parquet_directory, 'edges', 'part-00000.parquet'))
+    assert edge_schema[PREDICATE] == pl.Categorical
+    assert edge_schema[PRIMARY_KNOWLEDGE_SOURCE] == pl.Categorical
+    assert edge_schema[PUBLICATIONS] == pl.List(pl.String)
+    assert edge_schema['negated'] == pl.Boolean
+    assert 'ignored' not in edge_schema
+
+    parquet_nodes = read_parquet_rows(os.path.join(parquet_directory, 'nodes'))
+    assert parquet_nodes == nodes
+    assert parquet_nodes[50]['information_content'] == 'high'
+    parquet_edges = read_parquet_rows(os.path.join(parquet_directory, 'edges'))
+    for edge in edges:
+        del edge['ignored']
+        del edge['p_value']
+    assert parquet_edges == edges
+
+
+def test_create_parquet_dump_only_when_complete(tmp_path):
+    nodes, edges, nodes_file_path, edges_file_path = write_test_graph(str(tmp_path))
+    parquet_directory = os.path.join(str(tmp_path), PARQUET_DUMP_DIRECTORY)
+    # a conversion that fails part way through shouldn't leave a parquet directory that looks complete
+    with pytest.raises(FileNotFoundError):
+        create_parquet_dump(nodes_filepath=nodes_file_path,
+                            edges_filepath=os.path.join(str(tmp_path), 'missing_edges.jsonl'),
+                            output_directory=str(tmp_path))
+    assert not os.path.exists(parquet_directory)
+    assert not os.path.exists(f'{parquet_directory}.partial')
+
+    assert create_parquet_dump(nodes_filepath=nodes_file_path,
+                               edges_filepath=edges_file_path,
+                               output_directory=str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['edges.jsonl', 'nodes.jsonl', PARQUET_DUMP_DIRECTORY]
+    assert read_parquet_rows(os.path.join(parquet_directory, 'nodes')) == nodes
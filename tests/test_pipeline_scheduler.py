@@ -0,0 +1,88 @@
+import os
+import time
+import json
+import shutil
+import pytest
+
+from Common import pipeline_scheduler
+from Common.data_sources import RESOURCE_HOGS
+from Common.pipeline_scheduler import SourcePipelineScheduler, SourcePipelineJob, SOURCE_PIPELINE_LOGS_DIRECTORY
+
+TEMP_DIRECTORY = os.path.dirname(os.path.abspath(__file__)) + '/workspace/pipeline_scheduler_test'
+
+
+class StubSourceDataManager:
+    # records when each pipeline ran in a file, the pipelines run in other processes
+    def __init__(self, pipeline_seconds: float = 0.3):
+        self.pipeline_seconds = pipeline_seconds
+
+    def run_pipeline(self, source_id, source_version, parsing_version, normalization_scheme, supplementation_version):
+        start_time = time.time()
+        time.sleep(self.pipeline_seconds)
+        if source_id == 'failing_source':
+            raise ValueError('this source is broken')
+        with open(os.path.join(TEMP_DIRECTORY, f'{source_id}.json'), 'w') as pipeline_file:
+            json.dump({'start': start_time, 'end': time.time(), 'pid': os.getpid(),
+                       'log_directory': os.environ['ORION_LOGS']}, pipeline_file)
+        return f'{source_id}_release'
+
+
+def get_pipeline_job(source_id):
+    return SourcePipelineJob(source_id=source_id, source_version='1', parsing_version='1',
+                             normalization_scheme=None, supplementation_version='1')
+
+
+@pytest.fixture
+def pipeline_test_directory(monkeypatch):
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+    os.makedirs(TEMP_DIRECTORY)
+    monkeypatch.setattr(pipeline_scheduler, 'parent_log_directory', TEMP_DIRECTORY)
+    yield TEMP_DIRECTORY
+    shutil.rmtree(TEMP_DIRECTORY, ignore_errors=True)
+
+
+def test_source_pipeline_scheduler(pipeline_test_directory):
+    hog_source_ids = RESOURCE_HOGS[:2]
+    standard_source_ids = ['source_1', 'source_2', 'source_3', 'failing_source']
+    jobs = [get_pipeline_job(source_id) for source_id in standard_source_ids + hog_source_ids]
+
+    scheduler = SourcePipelineScheduler(source_data_manager=StubSourceDataManager(), workers=3)
+    pipeline_results = scheduler.run(jobs)
+
+    assert pipeline_results == {(source_id, '1'): False if source_id == 'failing_source' else f'{source_id}_release'
+                                for source_id in standard_source_ids + hog_source_ids}
+    pipeline_runs = {}
+    for source_id in standard_source_ids[:3] + hog_source_ids:
+        with open(os.path.join(pipeline_test_directory, f'{source_id}.json')) as pipeline_file:
+            pipeline_runs[source_id] = json.load(pipeline_file)
+    assert all(pipeline_run['pid'] != os.getpid() for pipeline_run in pipeline_runs.values())
+    # the pipelines ran in multiple processes at the same time, with the two resource hogs running one after the other
+    assert len({pipeline_run['pid'] for pipeline_run in pipeline_runs.values()}) > 1
+    assert any(pipeline_run['start'] < other_run['end'] and other_run['start'] < pipeline_run['end']
+               for source_id, pipeline_run in pipeline_runs.items()
+               for other_source_id, other_run in pipeline_runs.items() if source_id != other_source_id)
+    first_hog, second_hog = sorted((pipeline_runs[source_id] for source_id in hog_source_ids),
+                                   key=lambda pipeline_run: pipeline_run['start'])
+    assert first_hog['end'] <= second_hog['start']
+
+    # every source logs to its own directory
+    for source_id, pipeline_run in pipeline_runs.items():
+        assert pipeline_run['log_directory'] == os.path.join(pipeline_test_directory, SOURCE_PIPELINE_LOGS_DIRECTORY,
+                                                             source_id)
+
+
+def test_source_pipeline_scheduler_budgets(pipeline_test_directory):
+    scheduler = SourcePipelineScheduler(source_data_manager=StubSourceDataManager(), workers=4,
+                                        resource_class_budgets={pipeline_scheduler.STANDARD_CLASS: 2})
+    running_jobs = [get_pipeline_job('source_1'), get_pipeline_job(RESOURCE_HOGS[0])]
+    pending_jobs = [get_pipeline_job('source_1'), get_pipeline_job('source_2'), get_pipeline_job('source_3'),
+                    get_pipeline_job(RESOURCE_HOGS[1])]
+    # the same source can't run twice at once, and only one more standard source fits the budget
+    assert [job.source_id for job in scheduler.get_jobs_to_start(pending_jobs, running_jobs)] == \
+           ['source_2', RESOURCE_HOGS[1]]
+
+    # one worker runs the pipelines one after another in this process
+    scheduler = SourcePipelineScheduler(source_data_manager=StubSourceDataManager(pipeline_seconds=0), workers=1)
+    assert scheduler.run([get_pipeline_job('source_1')]) == {('source_1', '1'): 'source_1_release'}
+    with open(os.path.join(pipeline_test_directory, 'source_1.json')) as pipeline_file:
+        assert json.load(pipeline_file)['pid'] == os.getpid()